@@ -0,0 +1,48 @@
+"""Background event loop shared by warm invocations.
+
+The Gemini SDK caches its grpc_asyncio client on each model, and those
+channels are bound to the loop that created them, so all async work runs
+on one long-lived loop instead of a fresh asyncio.run() per request.
+"""
+from typing import Any, Awaitable, Callable, Optional
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+# Threads for blocking work started from the loop: Storage uploads, transcoding and rate
+# limit leases. Gemini calls are capped per instance at PACK_MAX_CONCURRENCY, so every image
+# in flight can be saved at once, plus a few threads for leases. asyncio's default executor
+# is only min(32, cpus + 4), shared with everything else.
+BLOCKING_WORKERS = int(os.environ.get('PACK_MAX_CONCURRENCY', 32)) + 4
+
+_loop_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_executor = concurrent.futures.ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix='async-blocking')
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared loop, starting its thread on first use."""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='async-runtime', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def run(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """Run a coroutine on the shared loop and block until it finishes."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any) -> Any:
+    """Run a blocking function on the runtime's own thread pool and await its result."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
@@ -45,3 +45,10 @@ class AuthContext:
         self.email = req.auth.token.get('email', '')
         self.name = req.auth.token.get('name', '')
         self.token = req.auth.token
+        # Custom claim mirrored from users/{uid}.role; it can be an hour stale (or missing after a console
+        # edit), so it's only a hint for the client, never an authorization check
+        self.role_claim = req.auth.token.get('role')
+    
+    def is_admin(self, firestore_service) -> bool:
+        """Check admin access against users/{uid}.role, the source of truth, rather than the token claim."""
+        return firestore_service.get_user_context(self.uid).role == 'admin'
@@ -0,0 +1,101 @@
+"""Per-model circuit breaker so callers can fall back instantly while Gemini is degraded."""
+from typing import Optional
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """The model's circuit is open; the call was not attempted."""
+
+
+class CircuitBreaker:
+    """
+    Tracks the last `window` calls to one model. Failures and calls slower than
+    slow_call_seconds both count as bad; once at least min_calls have been seen
+    and the bad share reaches failure_rate, the circuit opens and allow() returns
+    False for open_seconds. After that it is half-open: one trial call at a time
+    is let through, and its outcome closes or reopens the circuit. Thread-safe.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 10.0,
+        window: int = 20,
+        min_calls: int = 5,
+        open_seconds: float = 30.0
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at: Optional[float] = None
+        self._probe_started_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at < self.open_seconds:
+            return 'open'
+        return 'half-open'
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead right now."""
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(now)
+            if state == 'closed':
+                return True
+            if state == 'open':
+                return False
+            # Half-open: one trial at a time; a trial that never reported back is given up after open_seconds
+            if self._probe_started_at is not None and now - self._probe_started_at < self.open_seconds:
+                return False
+            self._probe_started_at = now
+            return True
+
+    def release(self) -> None:
+        """Report an allowed call whose outcome says nothing about the model, freeing the trial slot if it held it."""
+        with self._lock:
+            if self._state(time.monotonic()) == 'half-open':
+                self._probe_started_at = None
+
+    def record(self, success: bool, latency: Optional[float] = None) -> None:
+        """Report the outcome of an allowed call."""
+        bad = not success or (latency is not None and latency > self.slow_call_seconds)
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(now)
+            if state == 'open':
+                # A call started before the circuit opened; it says nothing about recovery
+                return
+            if state == 'half-open':
+                self._probe_started_at = None
+                if bad:
+                    self._opened_at = now
+                    logger.warning(f"Circuit for {self.name} trial call failed, staying open")
+                else:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                    logger.info(f"Circuit for {self.name} closed")
+                return
+
+            self._outcomes.append(bad)
+            if len(self._outcomes) >= self.min_calls and sum(self._outcomes) / len(self._outcomes) >= self.failure_rate:
+                self._opened_at = now
+                logger.warning(
+                    f"Circuit for {self.name} opened: {sum(self._outcomes)}/{len(self._outcomes)} recent calls failed or were slow"
+                )
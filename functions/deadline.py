@@ -0,0 +1,17 @@
+"""Time budget of a request, passed from the handler down to the work it starts."""
+import time
+
+
+class Deadline:
+    """A point in time, on the monotonic clock, by which work must be finished."""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """Seconds left, never negative."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
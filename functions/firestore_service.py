@@ -1,90 +1,281 @@
 """Firestore service for token and subscription management."""
-from firebase_admin import firestore, storage
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, Tuple
+from firebase_functions import https_fn
+from firebase_admin import firestore
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
 import logging
-import base64
+import os
+import threading
 import uuid
 
+from user_context import UserContext, WEEKLY_GENERATION_LIMIT, iso_week
+
 logger = logging.getLogger(__name__)
 
+TOKENS_PER_IMAGE = 1
+
+# Tokens granted when a subscription starts or renews, and again every week it stays active
+SUBSCRIPTION_WEEKLY_TOKENS = 140
+REFILL_INTERVAL = timedelta(days=7)
+
+# Firestore allows 500 writes per transaction; pending writes beyond this go through a BulkWriter
+MAX_TRANSACTION_WRITES = 450
+
+# ACL applied at upload time. Set to '' when the bucket grants public read through
+# bucket-level IAM (uniform access), where object ACLs are rejected.
+UPLOAD_PREDEFINED_ACL = os.environ.get('UPLOAD_PREDEFINED_ACL', 'publicRead') or None
+
+# Generated images are stored in this format; must match a key of image_processing.OUTPUT_FORMATS or be 'original'
+SUPPORTED_OUTPUT_IMAGE_FORMATS = ('webp', 'avif', 'jpeg', 'png', 'original')
+OUTPUT_IMAGE_FORMAT = os.environ.get('OUTPUT_IMAGE_FORMAT', 'webp').lower()
+if OUTPUT_IMAGE_FORMAT not in SUPPORTED_OUTPUT_IMAGE_FORMATS:
+    logger.warning(f"Unsupported OUTPUT_IMAGE_FORMAT {OUTPUT_IMAGE_FORMAT!r}, storing images as webp")
+    OUTPUT_IMAGE_FORMAT = 'webp'
+OUTPUT_IMAGE_QUALITY = int(os.environ.get('OUTPUT_IMAGE_QUALITY', 85))
+
+# Longest edges of the grid thumbnails stored next to each generated image
+THUMBNAIL_SIZES = [int(size) for size in os.environ.get('THUMBNAIL_SIZES', '256,512').split(',')]
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+
+
+class TokenReservation:
+    """Hold on a user's tokens and weekly allowance for one generation request."""
+    
+    def __init__(self, user: UserContext, hold_id: str, images: int, tokens: int):
+        self.user = user
+        self.hold_id = hold_id
+        self.images = images
+        self.tokens = tokens
+        self.hold_ref = user.doc_ref.collection('token_holds').document(hold_id)
+
+
+def is_refill_due(last_token_add: Optional[datetime]) -> bool:
+    """True when an active subscriber's last token grant is missing or more than a week old."""
+    if not last_token_add:
+        return True
+    if last_token_add.tzinfo is None:
+        last_token_add = last_token_add.replace(tzinfo=timezone.utc)
+    return last_token_add < datetime.now(timezone.utc) - REFILL_INTERVAL
+
+
+_service_lock = threading.Lock()
+_service: Optional['FirestoreService'] = None
+
+
+def get_firestore_service() -> 'FirestoreService':
+    """Return the service shared by warm invocations."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = FirestoreService()
+    return _service
+
+
 class FirestoreService:
     def __init__(self):
         self.db = firestore.client()
+        self._bucket = None
+        self._bucket_lock = threading.Lock()
     
-    def get_user_balance(self, uid: str) -> int:
-        """Get current token balance for user."""
-        try:
-            doc_ref = self.db.collection('users').document(uid)
-            doc = doc_ref.get()
-            
-            if not doc.exists:
-                # Create new user document with default values
-                self._create_user_document(uid)
-                return 0
-            
-            data = doc.to_dict()
-            return data.get('balance', 0)
-        except Exception as e:
-            logger.error(f"Failed to get user balance for {uid}: {str(e)}")
-            raise
+    @property
+    def bucket(self):
+        """Default Storage bucket handle, created once and reused across uploads."""
+        if self._bucket is None:
+            with self._bucket_lock:
+                if self._bucket is None:
+                    from firebase_admin import storage
+                    self._bucket = storage.bucket()
+        return self._bucket
+    
+    def get_user_context(self, uid: str) -> UserContext:
+        """Create a request-scoped snapshot of the user document, read on first use."""
+        return UserContext(self.db, uid)
     
-    def deduct_tokens(self, uid: str, amount: int) -> bool:
+    def reserve_tokens(self, user: UserContext, images: int, hold_seconds: int) -> TokenReservation:
         """
-        Deduct tokens from user balance.
-        Returns True if successful, False if insufficient balance.
+        Check balance and weekly limit and place a hold in one transaction.
+        Admin users bypass both checks, premium users bypass the token check.
+        The hold expires after hold_seconds, by when its request must have settled it; a hold
+        still there after that belongs to a request that died, and is refunded by the user's
+        next reservation (expired holds are given back first) or the daily ledger pass.
         """
-        try:
-            doc_ref = self.db.collection('users').document(uid)
-            
-            # Get current document
-            doc = doc_ref.get()
-            
-            if not doc.exists:
-                self._create_user_document(uid)
-                return False
+        reservation = TokenReservation(user, str(uuid.uuid4()), images, 0)
+        
+        @firestore.transactional
+        def reserve(transaction):
+            user.refresh(user.doc_ref.get(transaction=transaction))
+            balance, weekly_generated = self._refund_expired_holds(user, transaction)
+            role = user.role
+            
+            tokens = 0 if role in ['admin', 'premium'] else images * TOKENS_PER_IMAGE
+            if tokens and balance < tokens:
+                logger.warning(f"Insufficient tokens for user {user.uid}: {balance} < {tokens}")
+                raise https_fn.HttpsError('failed-precondition', 'Insufficient tokens', {
+                    'needsTokens': True,
+                    'balance': balance,
+                    'required': tokens
+                })
             
-            current_balance = doc.to_dict().get('balance', 0)
+            if role != 'admin' and weekly_generated + images > WEEKLY_GENERATION_LIMIT:
+                logger.warning(f"Weekly generation limit exceeded for user {user.uid}")
+                raise https_fn.HttpsError('failed-precondition', 'Weekly generation limit exceeded', {
+                    'weeklyLimitExceeded': True,
+                    'weeklyLimit': WEEKLY_GENERATION_LIMIT,
+                    'imagesRequested': images
+                })
             
-            if current_balance < amount:
-                return False
+            # The count belongs to generationWeek; a new week starts from zero without a reset pass
+            now = datetime.utcnow()
+            update_data = {
+                'balance': balance - tokens,
+                'weeklyGenerated': weekly_generated + images,
+                'generationWeek': iso_week(),
+                'lastUpdated': now
+            }
             
-            # Use Firestore increment for atomic operation
-            try:
-                doc_ref.update({
-                    'balance': firestore.Increment(-amount),
+            transaction.set(user.doc_ref, update_data, merge=True)
+            transaction.set(reservation.hold_ref, {
+                'images': images,
+                'tokens': tokens,
+                'week': update_data['generationWeek'],
+                'createdAt': now,
+                'expiresAt': now + timedelta(seconds=hold_seconds)
+            })
+            user.data.update(update_data)
+            reservation.tokens = tokens
+        
+        reserve(self.db.transaction())
+        user.writes += 2
+        return reservation
+    
+    def _refund_expired_holds(self, user: UserContext, transaction) -> Tuple[int, int]:
+        """
+        Stage deletion of the user's expired holds in transaction, after its reads.
+        Returns the balance and this week's generated count with those holds given back.
+        """
+        balance, weekly_generated = user.balance, user.weekly_generated
+        expired = (
+            user.doc_ref.collection('token_holds')
+            .where('expiresAt', '<', datetime.utcnow())
+            .stream(transaction=transaction)
+        )
+        for hold in expired:
+            held = hold.to_dict()
+            balance += held['tokens']
+            if held.get('week') == iso_week():
+                weekly_generated = max(weekly_generated - held['images'], 0)
+            transaction.delete(hold.reference)
+            logger.warning(f"Refunded expired token hold {hold.id} for user {user.uid}: {held['tokens']} tokens")
+        return balance, weekly_generated
+    
+    def release_expired_holds(self, user: UserContext) -> None:
+        """Refund the user's expired holds, for users who don't make another reservation."""
+        @firestore.transactional
+        def release(transaction):
+            user.refresh(user.doc_ref.get(transaction=transaction))
+            balance, weekly_generated = self._refund_expired_holds(user, transaction)
+            if balance != user.balance or weekly_generated != user.weekly_generated:
+                transaction.update(user.doc_ref, {
+                    'balance': balance,
+                    'weeklyGenerated': weekly_generated,
                     'lastUpdated': datetime.utcnow()
                 })
-                
-                # Record transaction after successful deduction
-                self._record_transaction(uid, 'deduction', -amount, f'Image generation: {amount} tokens')
-                return True
-                
-            except Exception as e:
-                logger.error(f"Failed to update balance for {uid}: {str(e)}")
-                return False
+        
+        release(self.db.transaction())
+    
+    def commit_reservation(self, reservation: TokenReservation, images_generated: int) -> int:
+        """
+        Settle a hold for the images actually generated, refunding the rest.
+        The user's pending writes (e.g. image metadata) land in the same transaction.
+        Returns the user's new balance. Settling an already settled hold is a no-op.
+        """
+        user = reservation.user
+        pending_writes = user.pending_writes
+        
+        # Very large requests would overflow the transaction, so flush the excess first
+        if len(pending_writes) > MAX_TRANSACTION_WRITES:
+            bulk_writer = self.db.bulk_writer()
+            for doc_ref, data in pending_writes[MAX_TRANSACTION_WRITES:]:
+                bulk_writer.set(doc_ref, data)
+            bulk_writer.close()
+            user.writes += len(pending_writes) - MAX_TRANSACTION_WRITES
+            pending_writes = pending_writes[:MAX_TRANSACTION_WRITES]
+        
+        @firestore.transactional
+        def settle(transaction):
+            hold = reservation.hold_ref.get(transaction=transaction)
+            user.refresh(user.doc_ref.get(transaction=transaction))
+            if not hold.exists:
+                logger.warning(f"Token hold {reservation.hold_id} for user {user.uid} already settled")
+                return 0
             
+            held = hold.to_dict()
+            unused_images = held['images'] - images_generated
+            charged_tokens = min(held['tokens'], images_generated * TOKENS_PER_IMAGE) if held['tokens'] else 0
+            
+            update_data = {
+                'balance': user.balance + held['tokens'] - charged_tokens,
+                'totalGenerated': user.data.get('totalGenerated', 0) + images_generated,
+                'lastUpdated': datetime.utcnow()
+            }
+            # Unused images go back to the week they were held in, unless that week is over
+            if unused_images and user.data.get('generationWeek') == held.get('week'):
+                update_data['weeklyGenerated'] = max(user.data.get('weeklyGenerated', 0) - unused_images, 0)
+            transaction.set(user.doc_ref, update_data, merge=True)
+            transaction.delete(reservation.hold_ref)
+            writes = 2
+            
+            for doc_ref, data in pending_writes:
+                transaction.set(doc_ref, data)
+            writes += len(pending_writes)
+            
+            if charged_tokens:
+                transaction.set(user.doc_ref.collection('transactions').document(), {
+                    'event': 'deduction',
+                    'amount': -charged_tokens,
+                    'description': f'Image generation: {charged_tokens} tokens',
+                    'timestamp': datetime.utcnow()
+                })
+                writes += 1
+            
+            user.data.update(update_data)
+            return writes
+        
+        user.writes += settle(self.db.transaction())
+        user.pending_writes = []
+        return user.balance
+    
+    def release_reservation(self, reservation: TokenReservation) -> None:
+        """Return a hold in full after a failed generation."""
+        try:
+            self.commit_reservation(reservation, 0)
         except Exception as e:
-            logger.error(f"Failed to deduct tokens for {uid}: {str(e)}")
-            raise
+            logger.error(f"Failed to release token hold {reservation.hold_id} for {reservation.user.uid}: {str(e)}")
     
-    def add_tokens(self, uid: str, amount: int, source: str = 'purchase') -> None:
-        """Add tokens to user balance."""
+    def add_tokens(self, uid: str, amount: int, source: str = 'purchase', batch=None) -> None:
+        """Add tokens to user balance. With batch (or a transaction), the writes are staged there instead of committed."""
         try:
             doc_ref = self.db.collection('users').document(uid)
             
+            commit = batch is None
+            if commit:
+                batch = self.db.batch()
+            
             # Check if document exists, create if it doesn't
             doc = doc_ref.get()
             if not doc.exists:
-                self._create_user_document(uid)
+                self._create_user_document(uid, batch)
             
-            doc_ref.update({
+            batch.update(doc_ref, {
                 'balance': firestore.Increment(amount),
                 'lastUpdated': datetime.utcnow()
             })
             
             # Record transaction
-            self._record_transaction(uid, source, amount, f'Tokens added: {amount} from {source}')
+            self._record_transaction(uid, source, amount, f'Tokens added: {amount} from {source}', batch)
+            if commit:
+                batch.commit()
             
         except Exception as e:
             logger.error(f"Failed to add tokens for {uid}: {str(e)}")
@@ -95,16 +286,24 @@ class FirestoreService:
         uid: str, 
         status: str, 
         product_id: str = None,
-        grant_tokens: bool = True
+        grant_tokens: bool = True,
+        batch=None
     ) -> None:
-        """Update user subscription status and optionally grant tokens."""
+        """
+        Update user subscription status and optionally grant tokens.
+        With batch (or a transaction), the writes are staged there instead of committed.
+        """
         try:
             doc_ref = self.db.collection('users').document(uid)
             
+            commit = batch is None
+            if commit:
+                batch = self.db.batch()
+            
             # Check if document exists, create if it doesn't
             doc = doc_ref.get()
             if not doc.exists:
-                self._create_user_document(uid)
+                self._create_user_document(uid, batch)
             
             update_data = {
                 'subscriptionStatus': status,
@@ -116,13 +315,15 @@ class FirestoreService:
             
             # Grant tokens for new active subscriptions
             if status == 'active' and grant_tokens:
-                update_data['balance'] = firestore.Increment(140)  # Weekly tokens
+                update_data['balance'] = firestore.Increment(SUBSCRIPTION_WEEKLY_TOKENS)
                 update_data['lastTokenAdd'] = datetime.utcnow()
                 
                 # Record transaction
-                self._record_transaction(uid, 'subscription', 140, f'Subscription tokens: {product_id}')
+                self._record_transaction(uid, 'subscription', SUBSCRIPTION_WEEKLY_TOKENS, f'Subscription tokens: {product_id}', batch)
             
-            doc_ref.update(update_data)
+            batch.update(doc_ref, update_data)
+            if commit:
+                batch.commit()
             
         except Exception as e:
             logger.error(f"Failed to update subscription for {uid}: {str(e)}")
@@ -143,18 +344,7 @@ class FirestoreService:
             if data.get('subscriptionStatus') != 'active':
                 return False
             
-            # Check last token add time
-            last_token_add = data.get('lastTokenAdd')
-            if not last_token_add:
-                return True
-            
-            # Convert to datetime if it's a Firestore timestamp
-            if hasattr(last_token_add, 'date'):
-                last_token_add = last_token_add.date()
-            
-            # Check if a week has passed
-            one_week_ago = datetime.utcnow() - timedelta(days=7)
-            return last_token_add < one_week_ago
+            return is_refill_due(data.get('lastTokenAdd'))
             
         except Exception as e:
             logger.error(f"Failed to check refill status for {uid}: {str(e)}")
@@ -167,14 +357,16 @@ class FirestoreService:
                 return False
             
             doc_ref = self.db.collection('users').document(uid)
-            doc_ref.update({
-                'balance': firestore.Increment(140),
+            batch = self.db.batch()
+            batch.update(doc_ref, {
+                'balance': firestore.Increment(SUBSCRIPTION_WEEKLY_TOKENS),
                 'lastTokenAdd': datetime.utcnow(),
                 'lastUpdated': datetime.utcnow()
             })
             
             # Record transaction
-            self._record_transaction(uid, 'subscription_refill', 140, 'Weekly subscription token refill')
+            self._record_transaction(uid, 'subscription_refill', SUBSCRIPTION_WEEKLY_TOKENS, 'Weekly subscription token refill', batch)
+            batch.commit()
             
             return True
             
@@ -182,10 +374,10 @@ class FirestoreService:
             logger.error(f"Failed to refill subscription tokens for {uid}: {str(e)}")
             raise
     
-    def _create_user_document(self, uid: str) -> None:
-        """Create a new user document with default values."""
+    def _create_user_document(self, uid: str, batch) -> None:
+        """Add creation of a user document with default values to a batch."""
         doc_ref = self.db.collection('users').document(uid)
-        doc_ref.set({
+        batch.set(doc_ref, {
             'balance': 0,
             'subscriptionStatus': 'none',
             'subscriptionProductId': None,
@@ -193,144 +385,128 @@ class FirestoreService:
             'lastTokenAdd': None,
             'totalGenerated': 0,
             'weeklyGenerated': 0,
-            'weekStartDate': datetime.utcnow()
+            'generationWeek': iso_week()
         })
     
-    def save_image_to_firebase(self, image_data_base64: str, user_id: str, prompt: str) -> Tuple[str, str]:
-        """Save image to Firebase Storage and Firestore, return (image_url, document_id)."""
+    def save_image_to_firebase(
+        self,
+        image_bytes: bytes,
+        user_id: str,
+        prompt: str,
+        pending_writes: Optional[List[Tuple[Any, Dict[str, Any]]]] = None
+    ) -> Tuple[str, str]:
+        """
+        Save image to Firebase Storage and Firestore, return (image_url, document_id).
+        When pending_writes is given, the metadata document is appended there for a
+        later batched commit instead of being written now.
+        """
         try:
-            # Decode base64 image
-            image_bytes = base64.b64decode(image_data_base64)
+            from image_processing import extension_for, transcode_image
+            
+            # Store in the configured format, named and typed after what the bytes really are
+            source_bytes = image_bytes
+            image_bytes, mime_type = transcode_image(image_bytes, OUTPUT_IMAGE_FORMAT, OUTPUT_IMAGE_QUALITY)
             
             # Generate unique filename
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             unique_id = str(uuid.uuid4())[:8]
-            filename = f"user_images/{user_id}/{timestamp}_{unique_id}.jpg"
+            filename = f"user_images/{user_id}/{timestamp}_{unique_id}.{extension_for(mime_type)}"
             
-            # Upload to Firebase Storage
-            bucket = storage.bucket()
-            blob = bucket.blob(filename)
-            blob.upload_from_string(image_bytes, content_type='image/jpeg')
-            
-            # Make the blob publicly accessible
-            blob.make_public()
+            # Upload to Firebase Storage, public in the same request (no separate make_public call)
+            blob = self.bucket.blob(filename)
+            blob.upload_from_string(image_bytes, content_type=mime_type, predefined_acl=UPLOAD_PREDEFINED_ACL)
             image_url = blob.public_url
             
             # Save metadata to Firestore
-            doc_ref = self.db.collection('user_images').add({
+            doc_ref = self.db.collection('user_images').document()
+            metadata = {
                 'userId': user_id,
                 'imageUrl': image_url,
                 'fileName': filename,
                 'prompts': [prompt],
+                'mimeType': mime_type,
+                'byteSize': len(image_bytes),
                 'createdAt': firestore.SERVER_TIMESTAMP,
-            })
+            }
+            metadata.update(self._save_previews(source_bytes, filename))
+            if pending_writes is None:
+                doc_ref.set(metadata)
+            else:
+                pending_writes.append((doc_ref, metadata))
             
             logger.info(f"Successfully saved image for user {user_id}: {image_url}")
-            return image_url, doc_ref[1].id
+            return image_url, doc_ref.id
             
         except Exception as e:
             logger.error(f"Failed to save image to Firebase: {str(e)}")
             raise
 
-    def check_weekly_generation_limit(self, uid: str, images_to_generate: int) -> bool:
-        """Check if user can generate the requested number of images within weekly limit."""
-        try:
-            doc_ref = self.db.collection('users').document(uid)
-            doc = doc_ref.get()
-            
-            if not doc.exists:
-                self._create_user_document(uid)
-                return images_to_generate <= 300
-            
-            data = doc.to_dict()
-            
-            # Reset weekly count if a new week has started
-            self._reset_weekly_count_if_needed(uid, data)
-            
-            # Get current weekly count (refresh data after potential reset)
-            doc = doc_ref.get()
-            data = doc.to_dict()
-            current_weekly = data.get('weeklyGenerated', 0)
-            
-            # Check if adding new images would exceed limit
-            return (current_weekly + images_to_generate) <= 300
-            
-        except Exception as e:
-            logger.error(f"Failed to check weekly generation limit for {uid}: {str(e)}")
-            return False
+    def _save_previews(self, image_bytes: bytes, filename: str) -> Dict[str, Any]:
+        """Upload grid thumbnails for an image and return the metadata fields describing them."""
+        from image_processing import create_previews, extension_for
+        
+        thumbnail_format = 'jpeg' if OUTPUT_IMAGE_FORMAT == 'original' else OUTPUT_IMAGE_FORMAT
+        previews = create_previews(image_bytes, THUMBNAIL_SIZES, THUMBNAIL_QUALITY, thumbnail_format)
+        if previews is None:
+            return {}
+        
+        stem = filename.rsplit('.', 1)[0]
+        thumbnails = {}
+        thumbnail_paths = []
+        for size, (data, mime_type) in previews['thumbnails'].items():
+            blob = self.bucket.blob(f"{stem}_{size}.{extension_for(mime_type)}")
+            blob.upload_from_string(data, content_type=mime_type, predefined_acl=UPLOAD_PREDEFINED_ACL)
+            thumbnails[str(size)] = blob.public_url
+            thumbnail_paths.append(blob.name)
+        
+        # Storage paths, so deleting the image can delete its thumbnails too
+        return {
+            'width': previews['width'],
+            'height': previews['height'],
+            'blurhash': previews['blurhash'],
+            'thumbnails': thumbnails,
+            'thumbnailPaths': thumbnail_paths,
+        }
     
-    def increment_generation_counts(self, uid: str, count: int) -> None:
-        """Increment both total and weekly generation counts."""
-        try:
-            doc_ref = self.db.collection('users').document(uid)
-            
-            # Check if document exists, create if it doesn't
-            doc = doc_ref.get()
-            if not doc.exists:
-                self._create_user_document(uid)
-            
-            # Reset weekly count if needed before incrementing
+    def list_user_images(self, uid: str, page_size: int, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """
+        One page of the user's gallery, newest first, with only the fields a grid needs.
+        nextCursor is the last document id, or None on the last page.
+        """
+        images = self.db.collection('user_images')
+        query = (
+            images
+            .where('userId', '==', uid)
+            .order_by('createdAt', direction=firestore.Query.DESCENDING)
+            .select(['imageUrl', 'thumbnails', 'blurhash', 'width', 'height', 'prompts', 'createdAt'])
+            .limit(page_size)
+        )
+        if cursor:
+            cursor_doc = images.document(cursor).get()
+            if not cursor_doc.exists or cursor_doc.get('userId') != uid:
+                raise ValueError('Unknown cursor')
+            query = query.start_after(cursor_doc)
+        
+        docs = list(query.stream())
+        page = []
+        for doc in docs:
             data = doc.to_dict()
-            self._reset_weekly_count_if_needed(uid, data)
-            
-            # Increment counters
-            doc_ref.update({
-                'totalGenerated': firestore.Increment(count),
-                'weeklyGenerated': firestore.Increment(count),
-                'lastUpdated': datetime.utcnow()
+            created_at = data.get('createdAt')
+            page.append({
+                'id': doc.id,
+                'imageUrl': data.get('imageUrl'),
+                'thumbnails': data.get('thumbnails', {}),
+                'blurhash': data.get('blurhash'),
+                'width': data.get('width'),
+                'height': data.get('height'),
+                'prompt': (data.get('prompts') or [None])[0],
+                'createdAt': created_at.isoformat() if created_at else None,
             })
-            
-            logger.info(f"Incremented generation counts for {uid}: +{count}")
-            
-        except Exception as e:
-            logger.error(f"Failed to increment generation counts for {uid}: {str(e)}")
-            raise
+        
+        return {'images': page, 'nextCursor': docs[-1].id if len(docs) == page_size else None}
     
-    def _reset_weekly_count_if_needed(self, uid: str, user_data: Dict[str, Any]) -> None:
-        """Reset weekly generation count if a new week has started."""
-        try:
-            week_start_date = user_data.get('weekStartDate')
-            if not week_start_date:
-                # No week start date, set it to now
-                doc_ref = self.db.collection('users').document(uid)
-                doc_ref.update({
-                    'weekStartDate': datetime.utcnow(),
-                    'weeklyGenerated': 0
-                })
-                return
-            
-            # Convert Firestore timestamp to datetime if needed
-            if hasattr(week_start_date, 'date'):
-                # This is a Firestore timestamp, convert to datetime
-                week_start_date = week_start_date.date()
-            
-            # Ensure we're comparing the same types
-            current_time = datetime.utcnow()
-            one_week_ago = current_time - timedelta(days=7)
-            
-            # Convert both to datetime for comparison
-            if isinstance(week_start_date, datetime):
-                week_start_datetime = week_start_date
-            else:
-                # If it's a date, convert to datetime at start of day
-                week_start_datetime = datetime.combine(week_start_date, datetime.min.time())
-            
-            if week_start_datetime < one_week_ago:
-                # Reset weekly count and update week start date
-                doc_ref = self.db.collection('users').document(uid)
-                doc_ref.update({
-                    'weekStartDate': current_time,
-                    'weeklyGenerated': 0,
-                    'lastUpdated': current_time
-                })
-                logger.info(f"Reset weekly generation count for user {uid}")
-            
-        except Exception as e:
-            logger.error(f"Failed to reset weekly count for {uid}: {str(e)}")
-            # Don't raise - this shouldn't break the main operation
-
-    def _record_transaction(self, uid: str, event: str, amount: int, description: str = None) -> None:
-        """Record a transaction in the user's transaction history."""
+    def _record_transaction(self, uid: str, event: str, amount: int, description: str = None, batch=None) -> None:
+        """Record a transaction in the user's transaction history, as part of batch if given."""
         try:
             transaction_data = {
                 'event': event,
@@ -341,7 +517,11 @@ class FirestoreService:
             if description:
                 transaction_data['description'] = description
             
-            self.db.collection('users').document(uid).collection('transactions').add(transaction_data)
+            transaction_ref = self.db.collection('users').document(uid).collection('transactions').document()
+            if batch is not None:
+                batch.set(transaction_ref, transaction_data)
+            else:
+                transaction_ref.set(transaction_data)
             
         except Exception as e:
             logger.error(f"Failed to record transaction for {uid}: {str(e)}")
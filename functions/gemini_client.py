@@ -1,21 +1,29 @@
 """Client for interacting with Google Gemini API using the native SDK."""
+import asyncio
 import json
 import base64
 import os
-from typing import Dict, Any, List, Optional
+import threading
+import time
+from typing import Dict, Any, List, NamedTuple, Optional, Union
 from firebase_functions import https_fn
+from google.api_core import exceptions as google_exceptions
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
 from prompts import ImagePrompts, SuggestionPrompts, FallbackSuggestions
+from image_processing import normalize_image
+from rate_limiter import FirestoreBudgetStore, InMemoryBudgetStore, RateLimiter, RateLimitTimeout
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from deadline import Deadline
+from gemini_retry import LatencyTracker, TransientResponseError, is_retryable, with_retries
+import async_runtime
+from suggestions_cache import SuggestionsCache, cache_key, cache_version
 
 
 class Config:
     """Configuration class for Firebase Functions."""
     
-    # Google AI API Configuration  
-    GOOGLE_AI_API_KEY = os.environ.get('GOOGLE_AI_API_KEY')
-    
     # Gemini Model Names
     GEMINI_IMAGE_MODEL = 'gemini-2.5-flash-image-preview'
     GEMINI_VISION_MODEL = 'gemini-2.5-flash'
@@ -28,6 +36,47 @@ class Config:
         'max_output_tokens': 1024
     }
     
+    # Input images are downscaled to this longest edge and re-encoded before upload
+    INPUT_IMAGE_MAX_EDGE = int(os.environ.get('INPUT_IMAGE_MAX_EDGE', 1536))
+    INPUT_IMAGE_QUALITY = int(os.environ.get('INPUT_IMAGE_QUALITY', 85))
+    
+    # Starting and maximum concurrent Gemini calls for pack generation
+    PACK_INITIAL_CONCURRENCY = int(os.environ.get('PACK_INITIAL_CONCURRENCY', 6))
+    PACK_MAX_CONCURRENCY = int(os.environ.get('PACK_MAX_CONCURRENCY', 32))
+    
+    # Image generation retries transient failures with jittered backoff, and hedges
+    # a duplicate request once an attempt runs past the observed p95 latency
+    GEMINI_MAX_ATTEMPTS = int(os.environ.get('GEMINI_MAX_ATTEMPTS', 3))
+    GEMINI_RETRY_BASE_DELAY = float(os.environ.get('GEMINI_RETRY_BASE_DELAY', 1.0))
+    GEMINI_RETRY_MAX_DELAY = float(os.environ.get('GEMINI_RETRY_MAX_DELAY', 8.0))
+    GEMINI_HEDGE_ENABLED = os.environ.get('GEMINI_HEDGE_ENABLED', 'true').lower() == 'true'
+    
+    # Assumed duration of one image generation until enough calls have been timed
+    IMAGE_GENERATION_ESTIMATE_SECONDS = float(os.environ.get('IMAGE_GENERATION_ESTIMATE_SECONDS', 15.0))
+    
+    # Project-wide image request budget shared by all instances, leased in chunks.
+    # Requests queue up to GEMINI_RATE_LIMIT_MAX_WAIT seconds for budget before failing.
+    GEMINI_IMAGE_RPM = int(os.environ.get('GEMINI_IMAGE_RPM', 500))
+    GEMINI_RATE_LIMIT_CHUNK = int(os.environ.get('GEMINI_RATE_LIMIT_CHUNK', 10))
+    GEMINI_RATE_LIMIT_MAX_WAIT = float(os.environ.get('GEMINI_RATE_LIMIT_MAX_WAIT', 10.0))
+    GEMINI_RATE_LIMIT_STORE = os.environ.get('GEMINI_RATE_LIMIT_STORE', 'firestore')
+    
+    # Per-model circuit breaker: opens when the share of failed or slow calls in the
+    # recent window reaches the threshold, then lets a trial call through after the cool-down
+    CIRCUIT_FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', 0.5))
+    CIRCUIT_SLOW_CALL_SECONDS = {
+        GEMINI_IMAGE_MODEL: float(os.environ.get('CIRCUIT_IMAGE_SLOW_CALL_SECONDS', 30.0)),
+        GEMINI_VISION_MODEL: float(os.environ.get('CIRCUIT_VISION_SLOW_CALL_SECONDS', 8.0)),
+    }
+    CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 30.0))
+    
+    # Upper bound on a single suggestions request, instead of the SDK default
+    GEMINI_VISION_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_VISION_TIMEOUT_SECONDS', 20.0))
+    
+    # Suggestions are cached per image content and prompt/schema version
+    SUGGESTIONS_CACHE_MAX_ENTRIES = int(os.environ.get('SUGGESTIONS_CACHE_MAX_ENTRIES', 256))
+    SUGGESTIONS_CACHE_TTL_SECONDS = int(os.environ.get('SUGGESTIONS_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+    
     SUGGESTIONS_GENERATION_CONFIG = {
         'temperature': 0.8,
         'top_k': 40,
@@ -36,22 +85,124 @@ class Config:
         'response_mime_type': 'application/json'
     }
     
+    @staticmethod
+    def get_api_key() -> Optional[str]:
+        """Read the API key at call time so a rotated secret is picked up."""
+        return os.environ.get('GOOGLE_AI_API_KEY')
+    
     @classmethod
     def validate(cls):
         """Validate that all required configuration is present."""
-        if not cls.GOOGLE_AI_API_KEY:
+        if not cls.get_api_key():
             raise ValueError("GOOGLE_AI_API_KEY environment variable is required")
 
 
+def is_overload_error(error: BaseException) -> bool:
+    """True for quota (429) and unavailable (503) errors, including ones wrapped in HttpsError."""
+    cause = error.__cause__ or error
+    return isinstance(cause, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable
+    ))
+
+
+class ImagePart(NamedTuple):
+    """Decoded, normalized image that can be shared by many Gemini requests."""
+    mime_type: str
+    data: bytes
+    
+    def to_content_part(self) -> Dict[str, Any]:
+        """Content part referencing the shared bytes without copying them."""
+        return {
+            'mime_type': self.mime_type,
+            'data': self.data
+        }
+
+
+# Finish reasons that mean the output was filtered; retrying the same request won't help
+SAFETY_FINISH_REASONS = {'SAFETY', 'PROHIBITED_CONTENT', 'BLOCKLIST', 'SPII', 'IMAGE_SAFETY'}
+
+_circuit_breakers = {
+    model: CircuitBreaker(
+        model,
+        failure_rate=Config.CIRCUIT_FAILURE_RATE,
+        slow_call_seconds=slow_call_seconds,
+        open_seconds=Config.CIRCUIT_OPEN_SECONDS
+    )
+    for model, slow_call_seconds in Config.CIRCUIT_SLOW_CALL_SECONDS.items()
+}
+
+
+def _record_error(breaker: CircuitBreaker, error: Exception, timeout: Optional[float] = None) -> None:
+    """
+    Count error against the model only when it reflects the model's health (server, overload
+    and timeout errors). Client errors such as bad input images, and timeouts set by the
+    caller's deadline below the model's slow-call threshold, are not the model's fault.
+    """
+    timed_out = isinstance(error, (google_exceptions.DeadlineExceeded, asyncio.TimeoutError))
+    caller_deadline = timed_out and timeout is not None and timeout < breaker.slow_call_seconds
+    if is_retryable(error) and not caller_deadline:
+        breaker.record(False)
+    else:
+        breaker.release()
+
+
+_image_rate_limiter = RateLimiter(
+    'gemini_image',
+    limit_per_minute=Config.GEMINI_IMAGE_RPM,
+    store=InMemoryBudgetStore() if Config.GEMINI_RATE_LIMIT_STORE == 'memory' else FirestoreBudgetStore(),
+    chunk_size=Config.GEMINI_RATE_LIMIT_CHUNK,
+    max_wait=Config.GEMINI_RATE_LIMIT_MAX_WAIT
+)
+
+_suggestions_cache = SuggestionsCache(
+    max_entries=Config.SUGGESTIONS_CACHE_MAX_ENTRIES,
+    ttl_seconds=Config.SUGGESTIONS_CACHE_TTL_SECONDS
+)
+
+# Changes whenever the prompt, schema, model or config would change the suggestions
+SUGGESTIONS_CACHE_VERSION = cache_version(
+    SuggestionPrompts.get_suggestions_prompt(),
+    SuggestionPrompts.get_response_schema(),
+    Config.GEMINI_VISION_MODEL,
+    Config.SUGGESTIONS_GENERATION_CONFIG
+)
+
+_client_lock = threading.Lock()
+_client: Optional['GeminiClient'] = None
+
+
+def get_gemini_client() -> 'GeminiClient':
+    """Return the client shared by warm invocations, rebuilding it when the API key changes."""
+    global _client
+    client = _client
+    if client is not None and client.api_key == Config.get_api_key():
+        return client
+    
+    with _client_lock:
+        if _client is None or _client.api_key != Config.get_api_key():
+            _client = GeminiClient()
+        return _client
+
+
+def reset_gemini_client() -> None:
+    """Drop the shared client so the next call builds a new one."""
+    global _client
+    with _client_lock:
+        _client = None
+
+
 class GeminiClient:
     """Client for making requests to Google Gemini API using the native SDK."""
     
     def __init__(self):
         """Initialize the Gemini client."""
         Config.validate()
+        self.api_key = Config.get_api_key()
         
         # Configure the SDK
-        genai.configure(api_key=Config.GOOGLE_AI_API_KEY)
+        genai.configure(api_key=self.api_key)
         
         # Initialize models
         self.image_model = genai.GenerativeModel(Config.GEMINI_IMAGE_MODEL)
@@ -64,88 +215,157 @@ class GeminiClient:
             HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
             HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
         }
+        
+        # Successful image generation latencies, used to decide when to hedge
+        self.image_latency = LatencyTracker()
+        self.image_rate_limiter = _image_rate_limiter
+        self.image_breaker = _circuit_breakers[Config.GEMINI_IMAGE_MODEL]
+        self.vision_breaker = _circuit_breakers[Config.GEMINI_VISION_MODEL]
     
-    def _base64_to_image_part(self, base64_data: str, mime_type: str = 'image/jpeg') -> Dict[str, Any]:
-        """Convert base64 data to image part for Gemini."""
-        return {
-            'mime_type': mime_type,
-            'data': base64.b64decode(base64_data)
-        }
+    def prepare_image_part(self, image: Union[str, bytes]) -> ImagePart:
+        """Decode and normalize a base64 string or raw image bytes once so it can be reused across requests."""
+        if isinstance(image, str):
+            image = base64.b64decode(image)
+        image_bytes, mime_type = normalize_image(
+            image,
+            max_edge=Config.INPUT_IMAGE_MAX_EDGE,
+            quality=Config.INPUT_IMAGE_QUALITY
+        )
+        return ImagePart(mime_type, image_bytes)
+    
+    def _to_content_part(self, image: Union[str, bytes, ImagePart]) -> Dict[str, Any]:
+        if isinstance(image, ImagePart):
+            return image.to_content_part()
+        return self.prepare_image_part(image).to_content_part()
+    
+    def _image_content_parts(
+        self,
+        original_image: Union[str, bytes, ImagePart],
+        prompt: str,
+        reference_image: Optional[Union[str, bytes, ImagePart]],
+        generation_prompt: Optional[str] = None
+    ) -> List[Any]:
+        content_parts = [
+            generation_prompt or ImagePrompts.get_image_generation_prompt(prompt),
+            self._to_content_part(original_image)
+        ]
+        
+        # Add reference image if provided
+        if reference_image:
+            content_parts.append(self._to_content_part(reference_image))
+        
+        return content_parts
+    
+    def _extract_image_data(self, response) -> bytes:
+        if response.candidates and len(response.candidates) > 0:
+            candidate = response.candidates[0]
+            if candidate.content and candidate.content.parts:
+                for part in candidate.content.parts:
+                    if hasattr(part, 'inline_data') and part.inline_data:
+                        return part.inline_data.data
+            
+            finish_reason = getattr(candidate.finish_reason, 'name', '')
+            if finish_reason in SAFETY_FINISH_REASONS:
+                raise https_fn.HttpsError('invalid-argument', f'Image generation was blocked ({finish_reason})')
+        
+        if getattr(getattr(response, 'prompt_feedback', None), 'block_reason', None):
+            raise https_fn.HttpsError('invalid-argument', 'Image generation was blocked by safety filters')
+        
+        # The model occasionally answers with text only; another attempt usually returns an image
+        raise TransientResponseError('No image data found in response')
     
     def generate_image(
         self, 
-        original_image_base64: str, 
+        original_image: Union[str, bytes, ImagePart], 
         prompt: str, 
-        reference_image_base64: Optional[str] = None
-    ) -> str:
-        """Generate an image using Gemini."""
-        try:
-            # Prepare content parts
-            content_parts = [
-                ImagePrompts.get_image_generation_prompt(prompt),
-                self._base64_to_image_part(original_image_base64)
-            ]
-            
-            # Add reference image if provided
-            if reference_image_base64:
-                content_parts.append(self._base64_to_image_part(reference_image_base64))
+        reference_image: Optional[Union[str, bytes, ImagePart]] = None,
+        deadline: Optional[Deadline] = None
+    ) -> bytes:
+        """
+        Generate an image using Gemini and return its raw bytes. Images are base64 strings or prepared ImageParts.
+        With a deadline, requests time out and retries stop when it runs out.
+        """
+        # Decode and resize here, in the caller's thread, so the shared loop only waits on I/O
+        if not isinstance(original_image, ImagePart):
+            original_image = self.prepare_image_part(original_image)
+        if reference_image and not isinstance(reference_image, ImagePart):
+            reference_image = self.prepare_image_part(reference_image)
+        return async_runtime.run(self.generate_image_async(original_image, prompt, reference_image, deadline))
+    
+    async def generate_image_async(
+        self, 
+        original_image: Union[str, bytes, ImagePart], 
+        prompt: str, 
+        reference_image: Optional[Union[str, bytes, ImagePart]] = None,
+        deadline: Optional[Deadline] = None,
+        generation_prompt: Optional[str] = None
+    ) -> bytes:
+        """
+        Async version of generate_image; run it on the shared async_runtime loop.
+        generation_prompt is the full prompt when the caller has already built it from prompt.
+        Images not yet prepared are decoded and resized on the blocking pool, off the loop thread.
+        """
+        if not isinstance(original_image, ImagePart):
+            original_image = await async_runtime.run_blocking(self.prepare_image_part, original_image)
+        if reference_image and not isinstance(reference_image, ImagePart):
+            reference_image = await async_runtime.run_blocking(self.prepare_image_part, reference_image)
+        content_parts = self._image_content_parts(original_image, prompt, reference_image, generation_prompt)
+        
+        async def attempt() -> bytes:
+            # Every attempt, including retries and hedges, spends from the shared budget
+            await self.image_rate_limiter.acquire()
+            if not self.image_breaker.allow():
+                raise CircuitOpenError(f'{Config.GEMINI_IMAGE_MODEL} is temporarily unavailable')
             
-            # Generate content
-            response = self.image_model.generate_content(
-                content_parts,
-                generation_config=genai.GenerationConfig(**Config.IMAGE_GENERATION_CONFIG),
-                safety_settings=self.safety_settings
+            timeout = max(deadline.remaining(), 1.0) if deadline else None
+            start = time.monotonic()
+            try:
+                response = await self.image_model.generate_content_async(
+                    content_parts,
+                    generation_config=genai.GenerationConfig(**Config.IMAGE_GENERATION_CONFIG),
+                    safety_settings=self.safety_settings,
+                    request_options={'timeout': timeout} if timeout else None
+                )
+            except Exception as e:
+                _record_error(self.image_breaker, e, timeout)
+                raise
+            self.image_breaker.record(True, time.monotonic() - start)
+            return self._extract_image_data(response)
+        
+        try:
+            return await with_retries(
+                attempt,
+                max_attempts=Config.GEMINI_MAX_ATTEMPTS,
+                base_delay=Config.GEMINI_RETRY_BASE_DELAY,
+                max_delay=Config.GEMINI_RETRY_MAX_DELAY,
+                latency=self.image_latency,
+                hedge=Config.GEMINI_HEDGE_ENABLED,
+                deadline=deadline
             )
-            
-            # Extract image data from response
-            if response.candidates and len(response.candidates) > 0:
-                candidate = response.candidates[0]
-                if candidate.content and candidate.content.parts:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            return base64.b64encode(part.inline_data.data).decode('utf-8')
-            
-            raise https_fn.HttpsError('internal', 'No image data found in response')
-            
+        except https_fn.HttpsError:
+            raise
+        except RateLimitTimeout as e:
+            raise https_fn.HttpsError('resource-exhausted', 'Image generation is busy, please try again shortly') from e
+        except CircuitOpenError as e:
+            raise https_fn.HttpsError('unavailable', str(e)) from e
         except Exception as e:
-            if isinstance(e, https_fn.HttpsError):
-                raise
-            raise https_fn.HttpsError('internal', f'Failed to generate image: {str(e)}')
+            code = 'unavailable' if is_retryable(e) else 'internal'
+            raise https_fn.HttpsError(code, f'Failed to generate image: {str(e)}') from e
+    
+    def expected_image_seconds(self) -> float:
+        """How long an image generation is likely to take: the observed p95, or the configured estimate."""
+        return self.image_latency.p95() or Config.IMAGE_GENERATION_ESTIMATE_SECONDS
     
-    def generate_suggestions(self, image_base64: str) -> List[Dict[str, str]]:
-        """Generate prompt suggestions using Gemini Vision."""
+    def generate_suggestions(self, image: Union[str, bytes]) -> List[Dict[str, str]]:
+        """Generate prompt suggestions using Gemini Vision, served from cache for images seen before."""
         try:
-            # Prepare content parts
-            content_parts = [
-                SuggestionPrompts.get_suggestions_prompt(),
-                self._base64_to_image_part(image_base64)
-            ]
-            
-            # Configure generation for JSON output
-            generation_config = genai.GenerationConfig(
-                **Config.SUGGESTIONS_GENERATION_CONFIG,
-                response_schema=SuggestionPrompts.get_response_schema()
-            )
-            
-            # Generate content
-            response = self.vision_model.generate_content(
-                content_parts,
-                generation_config=generation_config,
-                safety_settings=self.safety_settings
+            image_bytes = image if isinstance(image, bytes) else base64.b64decode(image)
+            suggestions = _suggestions_cache.get_or_compute(
+                cache_key(image_bytes, SUGGESTIONS_CACHE_VERSION),
+                lambda: self._request_suggestions(image_bytes)
             )
-            
-            # Extract and parse JSON response
-            if response.candidates and len(response.candidates) > 0:
-                candidate = response.candidates[0]
-                if candidate.content and candidate.content.parts:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            try:
-                                suggestions = json.loads(part.text)
-                                return suggestions
-                            except json.JSONDecodeError:
-                                # Continue to fallback
-                                pass
+            if suggestions is not None:
+                return suggestions
             
             # Return fallback suggestions if parsing fails or no valid response
             return FallbackSuggestions.get_fallback_suggestions()
@@ -153,3 +373,49 @@ class GeminiClient:
         except Exception as e:
             # Return fallback suggestions on any error
             return FallbackSuggestions.get_fallback_suggestions()
+    
+    def _request_suggestions(self, image_bytes: bytes) -> Optional[List[Dict[str, str]]]:
+        """Call Gemini Vision; returns None when the response has no valid suggestions."""
+        # Prepare content parts
+        content_parts = [
+            SuggestionPrompts.get_suggestions_prompt(),
+            self._to_content_part(image_bytes)
+        ]
+        
+        # Configure generation for JSON output
+        generation_config = genai.GenerationConfig(
+            **Config.SUGGESTIONS_GENERATION_CONFIG,
+            response_schema=SuggestionPrompts.get_response_schema()
+        )
+        
+        # Fail fast while the model is degraded; the caller serves cached or fallback suggestions
+        if not self.vision_breaker.allow():
+            raise CircuitOpenError(f'{Config.GEMINI_VISION_MODEL} is temporarily unavailable')
+        
+        # Generate content
+        start = time.monotonic()
+        try:
+            response = self.vision_model.generate_content(
+                content_parts,
+                generation_config=generation_config,
+                safety_settings=self.safety_settings,
+                request_options={'timeout': Config.GEMINI_VISION_TIMEOUT_SECONDS}
+            )
+        except Exception as e:
+            _record_error(self.vision_breaker, e)
+            raise
+        self.vision_breaker.record(True, time.monotonic() - start)
+        
+        # Extract and parse JSON response
+        if response.candidates and len(response.candidates) > 0:
+            candidate = response.candidates[0]
+            if candidate.content and candidate.content.parts:
+                for part in candidate.content.parts:
+                    if hasattr(part, 'text') and part.text:
+                        try:
+                            return json.loads(part.text)
+                        except json.JSONDecodeError:
+                            # Continue to fallback
+                            pass
+        
+        return None
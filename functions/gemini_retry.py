@@ -0,0 +1,118 @@
+"""Retries with jittered backoff and hedged requests for Gemini calls."""
+from typing import Any, Awaitable, Callable, Optional
+import asyncio
+import collections
+import logging
+import random
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+from deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+class TransientResponseError(Exception):
+    """The model answered without the expected output (e.g. text instead of an image); worth another try."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Quota, overload, timeout and server errors are retried; everything else is fatal."""
+    return isinstance(error, RETRYABLE_EXCEPTIONS + (TransientResponseError,))
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff for the given zero-based attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, used to pick the hedging delay."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def p95(self) -> Optional[float]:
+        """95th percentile latency in seconds, or None until enough calls have been seen."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+async def hedged(call: Callable[[], Awaitable[Any]], hedge_after: Optional[float]) -> Any:
+    """
+    Run call(); if it hasn't finished after hedge_after seconds, start a duplicate
+    and return whichever succeeds first, cancelling the other. A failure of one
+    copy only surfaces if the other copy fails too.
+    """
+    first = asyncio.ensure_future(call())
+    pending = {first}
+    try:
+        if hedge_after is None:
+            return await first
+
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return first.result()
+
+        logger.info(f"Gemini call exceeded p95 ({hedge_after:.1f}s), sending hedged request")
+        pending.add(asyncio.ensure_future(call()))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def with_retries(
+    call: Callable[[], Awaitable[Any]],
+    max_attempts: int,
+    base_delay: float,
+    max_delay: float,
+    latency: Optional[LatencyTracker] = None,
+    hedge: bool = False,
+    deadline: Optional[Deadline] = None
+) -> Any:
+    """
+    Retry call() on retryable errors with full-jitter backoff, re-raising the last
+    error once attempts run out or the next retry wouldn't start before the deadline.
+    With hedge, each attempt is hedged at the tracked p95.
+    """
+    for attempt in range(max_attempts):
+        start = time.monotonic()
+        try:
+            hedge_after = latency.p95() if hedge and latency is not None else None
+            result = await hedged(call, hedge_after)
+            if latency is not None:
+                latency.record(time.monotonic() - start)
+            return result
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_attempts - 1:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            if deadline is not None and delay >= deadline.remaining():
+                raise
+            logger.warning(f"Gemini call failed ({type(e).__name__}: {str(e)}), retry {attempt + 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
@@ -0,0 +1,162 @@
+"""Client-supplied idempotency keys for generation callables."""
+from firebase_functions import https_fn
+from firebase_admin import firestore
+from google.api_core import exceptions as google_exceptions
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional
+import base64
+import hashlib
+import json
+import logging
+import time
+
+from deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+# How often a duplicate re-reads the record while the original call is in flight
+POLL_SECONDS = 1.0
+RESULT_TTL = timedelta(hours=24)
+
+
+def request_hash(params: Dict[str, Any]) -> str:
+    """Fingerprint of a call's parameters, ignoring the idempotency key itself."""
+    params = {name: value for name, value in params.items() if name != 'idempotencyKey'}
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class IdempotentCall:
+    """
+    Ties retries of one callable invocation together through idempotency_keys/{hash}.
+    The first call with a key runs and stores its outcome; duplicates return the
+    stored result, or wait for the in-flight call to finish while their own deadline
+    allows. A pending record older than stale_after seconds (the callable's timeout
+    plus a margin) belongs to a call the platform killed, and is taken over. Reusing a
+    key with different parameters is rejected. Only the call that owns the key records
+    an outcome; without a key every method is a no-op. Generated image bytes are kept
+    in Storage, not in the document.
+    """
+
+    def __init__(
+        self,
+        firestore_service,
+        uid: str,
+        function_name: str,
+        params: Dict[str, Any],
+        deadline: Deadline,
+        stale_after: float
+    ):
+        self.firestore_service = firestore_service
+        self.uid = uid
+        self.key = params.get('idempotencyKey')
+        self.doc_id = hashlib.sha256(f"{uid}:{function_name}:{self.key}".encode('utf-8')).hexdigest()
+        self.doc_ref = firestore_service.db.collection('idempotency_keys').document(self.doc_id)
+        self.function_name = function_name
+        self.request_hash = request_hash(params) if self.key else None
+        self.deadline = deadline
+        self.stale_after = timedelta(seconds=stale_after)
+        self.owned = False
+
+    def begin(self) -> Optional[Dict[str, Any]]:
+        """Return the stored result of an earlier call with this key, or None if this call should run."""
+        if not self.key:
+            return None
+
+        if self._create():
+            self.owned = True
+            return None
+
+        # Only a read per poll while the original call is in flight; a transaction only to take over
+        while True:
+            doc = self.doc_ref.get()
+            record = doc.to_dict() if doc.exists else None
+            if record is not None:
+                self._check_params(record)
+                if record['status'] == 'completed':
+                    logger.info(f"Returning stored {self.function_name} result for idempotency key {self.key}")
+                    return self._load_result(record)
+
+            if self._claimable(record) and self._take_over():
+                self.owned = True
+                return None
+
+            if self.deadline.remaining() <= POLL_SECONDS:
+                raise https_fn.HttpsError('aborted', 'A request with this idempotency key is still in progress')
+            time.sleep(POLL_SECONDS)
+
+    def _new_record(self) -> Dict[str, Any]:
+        now = datetime.now(timezone.utc)
+        return {
+            'userId': self.uid,
+            'function': self.function_name,
+            'status': 'pending',
+            'requestHash': self.request_hash,
+            'createdAt': now,
+            'expiresAt': now + RESULT_TTL,
+        }
+
+    def _create(self) -> bool:
+        try:
+            self.doc_ref.create(self._new_record())
+            return True
+        except google_exceptions.AlreadyExists:
+            return False
+
+    def _check_params(self, record: Dict[str, Any]) -> None:
+        stored_hash = record.get('requestHash')
+        if stored_hash and stored_hash != self.request_hash:
+            logger.warning(f"Idempotency key {self.key} reused with different parameters for user {self.uid}")
+            raise https_fn.HttpsError('invalid-argument', 'Idempotency key was already used for a different request')
+
+    def _claimable(self, record: Optional[Dict[str, Any]]) -> bool:
+        """Missing, failed, or pending past stale_after (its owner was killed)."""
+        if record is None or record['status'] == 'failed':
+            return True
+        return record['status'] == 'pending' and record['createdAt'] <= datetime.now(timezone.utc) - self.stale_after
+
+    def _take_over(self) -> bool:
+        """Replace a claimable record, re-checked inside a transaction. True if this call now owns the key."""
+        @firestore.transactional
+        def take_over(transaction):
+            doc = self.doc_ref.get(transaction=transaction)
+            if not self._claimable(doc.to_dict() if doc.exists else None):
+                return False
+            transaction.set(self.doc_ref, self._new_record())
+            return True
+
+        return take_over(self.firestore_service.db.transaction())
+
+    def complete(self, result: Dict[str, Any], image_bytes: Optional[bytes] = None) -> None:
+        """Store the outcome. image_bytes replaces result['imageData'] with a Storage object."""
+        if not self.owned:
+            return
+
+        try:
+            stored = dict(result)
+            if image_bytes is not None:
+                image_path = f"idempotency/{self.uid}/{self.doc_id}"
+                self.firestore_service.bucket.blob(image_path).upload_from_string(image_bytes)
+                stored.pop('imageData', None)
+                stored['imagePath'] = image_path
+
+            self.doc_ref.update({'status': 'completed', 'result': stored})
+        except Exception as e:
+            logger.error(f"Failed to store result for idempotency key {self.key}: {str(e)}")
+
+    def abandon(self) -> None:
+        """Mark the call failed so a retry with the same key runs again."""
+        if not self.owned:
+            return
+
+        try:
+            self.doc_ref.update({'status': 'failed'})
+        except Exception as e:
+            logger.error(f"Failed to release idempotency key {self.key}: {str(e)}")
+
+    def _load_result(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        result = dict(record.get('result') or {})
+        image_path = result.pop('imagePath', None)
+        if image_path:
+            image_bytes = self.firestore_service.bucket.blob(image_path).download_as_bytes()
+            result['imageData'] = base64.b64encode(image_bytes).decode('utf-8')
+        return result
@@ -0,0 +1,213 @@
+"""Image preprocessing with Pillow."""
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+from typing import Any, Dict, Iterable, Optional, Tuple
+import io
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+# ISO-BMFF brands found at bytes 8-12 of HEIC/AVIF files
+_FTYP_BRANDS = {
+    b'heic': 'image/heic',
+    b'heix': 'image/heic',
+    b'mif1': 'image/heif',
+    b'avif': 'image/avif',
+}
+
+
+def sniff_mime_type(image_bytes: bytes, default: str = 'image/jpeg') -> str:
+    """Detect the image mime type from its magic bytes."""
+    header = bytes(image_bytes[:16])
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header[:4] == b'GIF8':
+        return 'image/gif'
+    if header[4:8] == b'ftyp':
+        return _FTYP_BRANDS.get(header[8:12], default)
+    return default
+
+
+def normalize_image(image_bytes: bytes, max_edge: int, quality: int) -> Tuple[bytes, str]:
+    """
+    Apply EXIF orientation, downscale to max_edge, strip metadata and re-encode.
+    Images with transparency are kept as PNG, everything else becomes JPEG.
+    Returns (image_bytes, mime_type); bytes Pillow can't read are passed through.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image = ImageOps.exif_transpose(image)
+            if max(image.size) > max_edge:
+                image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+            output = io.BytesIO()
+            if _has_alpha(image):
+                image.save(output, format='PNG', optimize=True)
+                return output.getvalue(), 'image/png'
+
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+            return output.getvalue(), 'image/jpeg'
+
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Could not normalize image, sending original bytes: {str(e)}")
+        return image_bytes, sniff_mime_type(image_bytes)
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+# Output formats: Pillow format name, mime type, file extension
+OUTPUT_FORMATS = {
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'avif': ('AVIF', 'image/avif', 'avif'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'png': ('PNG', 'image/png', 'png'),
+}
+
+_EXTENSIONS = {mime_type: extension for _, mime_type, extension in OUTPUT_FORMATS.values()}
+
+
+def extension_for(mime_type: str) -> str:
+    return _EXTENSIONS.get(mime_type, 'bin')
+
+
+def _encode(image: Image.Image, target_format: str, quality: int) -> Tuple[bytes, str]:
+    """Encode in target_format; JPEG falls back to PNG for images with transparency."""
+    if target_format == 'avif' and not features.check('avif'):
+        target_format = 'webp'
+    if target_format == 'jpeg' and _has_alpha(image):
+        target_format = 'png'
+
+    pil_format, mime_type, _ = OUTPUT_FORMATS[target_format]
+    if not _has_alpha(image) and image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    output = io.BytesIO()
+    if pil_format == 'PNG':
+        image.save(output, format='PNG', optimize=True)
+    elif pil_format == 'JPEG':
+        image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+    elif pil_format == 'WEBP':
+        image.save(output, format='WEBP', quality=quality, method=4)
+    else:
+        image.save(output, format=pil_format, quality=quality)
+    return output.getvalue(), mime_type
+
+
+def transcode_image(image_bytes: bytes, target_format: str, quality: int) -> Tuple[bytes, str]:
+    """
+    Re-encode a generated image as target_format ('webp', 'avif', 'jpeg' or 'original').
+    Returns (image_bytes, mime_type). Images already in the target format, 'original',
+    and bytes Pillow can't read are returned as they are, with their sniffed mime type.
+    """
+    source_mime_type = sniff_mime_type(image_bytes, default='application/octet-stream')
+    if target_format == 'original' or OUTPUT_FORMATS.get(target_format, (None, None))[1] == source_mime_type:
+        return image_bytes, source_mime_type
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            return _encode(ImageOps.exif_transpose(image), target_format, quality)
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Could not transcode image to {target_format}, storing original bytes: {str(e)}")
+        return image_bytes, source_mime_type
+
+
+def create_previews(
+    image_bytes: bytes,
+    sizes: Iterable[int],
+    quality: int,
+    target_format: str = 'jpeg'
+) -> Optional[Dict[str, Any]]:
+    """
+    Build grid thumbnails (longest edge = size) in target_format and a blurhash placeholder.
+    Returns {'width', 'height', 'thumbnails': {size: (bytes, mime_type)}, 'blurhash'},
+    or None if the image can't be read.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+            previews = {'width': image.width, 'height': image.height, 'thumbnails': {}}
+
+            for size in sorted(sizes, reverse=True):
+                # Each size is scaled from the next larger one, which is cheaper and looks the same
+                if max(image.size) > size:
+                    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+                previews['thumbnails'][size] = _encode(image, target_format, quality)
+
+            previews['blurhash'] = blurhash_encode(image)
+            return previews
+
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Could not create image previews: {str(e)}")
+        return None
+
+
+_BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def _base83(value: int, length: int) -> str:
+    return ''.join(_BASE83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def _srgb_to_linear(value: int) -> float:
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value: float) -> int:
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash_encode(image: Image.Image, x_components: int = 4, y_components: int = 3) -> str:
+    """Encode a blurhash (https://blurha.sh) from a 32px copy of the image."""
+    small = image.convert('RGB').resize((32, 32), Image.Resampling.BILINEAR)
+    width, height = small.size
+    pixels = [tuple(_srgb_to_linear(c) for c in pixel) for pixel in small.getdata()]
+
+    factors = []
+    for j in range(y_components):
+        cos_y = [math.cos(math.pi * j * y / height) for y in range(height)]
+        for i in range(x_components):
+            cos_x = [math.cos(math.pi * i * x / width) for x in range(width)]
+            r = g = b = 0.0
+            for y in range(height):
+                for x in range(width):
+                    basis = cos_x[x] * cos_y[y]
+                    pr, pg, pb = pixels[y * width + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = (1 if i == 0 and j == 0 else 2) / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+
+    max_value = 1.0
+    if ac:
+        quantised_max = max(0, min(82, int(math.floor(max(abs(c) for f in ac for c in f) * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        result += _base83(0, 1)
+
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+
+    def quantise(value: float) -> int:
+        scaled = value / max_value
+        return max(0, min(18, int(math.floor(math.copysign(abs(scaled) ** 0.5, scaled) * 9 + 9.5))))
+
+    for r, g, b in ac:
+        result += _base83(quantise(r) * 19 * 19 + quantise(g) * 19 + quantise(b), 2)
+    return result
@@ -0,0 +1,233 @@
+"""Transaction history paging, monthly rollups and balance reconciliation."""
+from firebase_admin import firestore
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional
+import logging
+
+from deadline import Deadline
+from firestore_service import FirestoreService
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FIELDS = ['event', 'amount', 'description', 'timestamp']
+
+# Transactions from months this far back are folded into their monthly rollup
+ROLLUP_AFTER_MONTHS = 3
+
+# Deletes plus the rollup update per batch, under Firestore's 500 writes
+ROLLUP_CHUNK_SIZE = 400
+
+USERS_PAGE_SIZE = 300
+
+# Each pass also covers users changed this long before the previous one started, so a token
+# hold still live then (pack jobs hold for 6 hours) is seen again once it has expired
+ACTIVITY_OVERLAP = timedelta(hours=12)
+
+# Lower bound for the first pass, before any checkpoint: every user
+ACTIVITY_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def month_key(moment: datetime) -> str:
+    return f"{moment.year}-{moment.month:02d}"
+
+
+def rollup_cutoff(now: Optional[datetime] = None) -> datetime:
+    """Start of the oldest month that is kept as individual transactions."""
+    now = now or datetime.now(timezone.utc)
+    months = now.year * 12 + now.month - 1 - ROLLUP_AFTER_MONTHS
+    return datetime(months // 12, months % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _sum(collection, field: str) -> int:
+    """Server-side sum of field across collection, without reading the documents."""
+    return collection.sum(field, alias='total').get()[0][0].value or 0
+
+
+class Ledger:
+    """
+    Per-user layout:
+      users/{uid}/transactions/{id}              individual entries, newest months only
+      users/{uid}/transaction_rollups/{YYYY-MM}  count, total and per-event sums of compacted months
+    """
+
+    def __init__(self, firestore_service: FirestoreService):
+        self.firestore_service = firestore_service
+        self.db = firestore_service.db
+
+    def _user_ref(self, uid: str):
+        return self.db.collection('users').document(uid)
+
+    def history(self, uid: str, page_size: int, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """
+        One page of transactions, newest first. nextCursor is the id to pass back for the
+        following page; on the last page it is None and the monthly rollups are included.
+        """
+        transactions = self._user_ref(uid).collection('transactions')
+        query = (
+            transactions
+            .order_by('timestamp', direction=firestore.Query.DESCENDING)
+            .select(HISTORY_FIELDS)
+            .limit(page_size)
+        )
+        if cursor:
+            cursor_doc = transactions.document(cursor).get()
+            if not cursor_doc.exists:
+                raise ValueError('Unknown cursor')
+            query = query.start_after(cursor_doc)
+
+        docs = list(query.stream())
+        page = []
+        for doc in docs:
+            data = doc.to_dict()
+            page.append({
+                'id': doc.id,
+                'event': data.get('event'),
+                'amount': data.get('amount', 0),
+                'description': data.get('description'),
+                'timestamp': data['timestamp'].isoformat() if data.get('timestamp') else None,
+            })
+
+        result = {'transactions': page, 'nextCursor': docs[-1].id if len(docs) == page_size else None}
+        if result['nextCursor'] is None:
+            result['rollups'] = [
+                {'month': doc.id, 'count': doc.get('count'), 'total': doc.get('total'), 'byEvent': doc.get('byEvent')}
+                for doc in self._user_ref(uid).collection('transaction_rollups')
+                .order_by('__name__', direction=firestore.Query.DESCENDING)
+                .select(['count', 'total', 'byEvent'])
+                .stream()
+            ]
+        return result
+
+    def rollup(self, uid: str, cutoff: datetime) -> int:
+        """Fold transactions older than cutoff into monthly rollups. Returns how many were compacted."""
+        transactions = self._user_ref(uid).collection('transactions')
+        rollups = self._user_ref(uid).collection('transaction_rollups')
+        compacted = 0
+
+        while True:
+            docs = list(
+                transactions
+                .where('timestamp', '<', cutoff)
+                .order_by('timestamp')
+                .select(['event', 'amount', 'timestamp'])
+                .limit(ROLLUP_CHUNK_SIZE)
+                .stream()
+            )
+            if not docs:
+                return compacted
+
+            # Sums and deletes commit together, so every entry is counted exactly once
+            months: Dict[str, Dict[str, Any]] = {}
+            for doc in docs:
+                data = doc.to_dict()
+                amount = data.get('amount', 0)
+                event = data.get('event', 'unknown')
+                month = months.setdefault(month_key(data['timestamp']), {'count': 0, 'total': 0, 'byEvent': {}})
+                month['count'] += 1
+                month['total'] += amount
+                by_event = month['byEvent'].setdefault(event, {'count': 0, 'amount': 0})
+                by_event['count'] += 1
+                by_event['amount'] += amount
+
+            batch = self.db.batch()
+            for key, month in months.items():
+                batch.set(rollups.document(key), {
+                    'count': firestore.Increment(month['count']),
+                    'total': firestore.Increment(month['total']),
+                    'byEvent': {
+                        event: {'count': firestore.Increment(sums['count']), 'amount': firestore.Increment(sums['amount'])}
+                        for event, sums in month['byEvent'].items()
+                    },
+                    'updatedAt': firestore.SERVER_TIMESTAMP,
+                }, merge=True)
+            for doc in docs:
+                batch.delete(doc.reference)
+            batch.commit()
+            compacted += len(docs)
+
+    def reconcile(self, uid: str, balance: int) -> int:
+        """
+        Compare balance with rollup totals plus remaining transactions, minus tokens held by
+        in-flight generations. Returns the difference (0 when the ledger agrees) and logs mismatches.
+        """
+        user_ref = self._user_ref(uid)
+        ledger_total = _sum(user_ref.collection('transaction_rollups'), 'total')
+        ledger_total += _sum(user_ref.collection('transactions'), 'amount')
+        held = _sum(user_ref.collection('token_holds'), 'tokens')
+
+        difference = balance - (ledger_total - held)
+        if difference:
+            logger.warning(f"Ledger mismatch for user {uid}: balance {balance}, ledger {ledger_total}, held {held}")
+        return difference
+
+    def rollup_all(self, deadline: Deadline) -> int:
+        """
+        Roll up, release expired token holds and reconcile the users whose document changed
+        since the last pass (every balance change writes lastUpdated), in lastUpdated order.
+        job_checkpoints/transaction_rollup keeps the pass's lower bound, its start and a cursor,
+        so a run cut short by the deadline resumes there. When the rollup cutoff moves on a
+        month, the pass restarts from the old cutoff: only users active since then can have
+        transactions in the month that just aged out.
+        Returns the number of users processed.
+        """
+        checkpoint_ref = self.db.collection('job_checkpoints').document('transaction_rollup')
+        checkpoint = checkpoint_ref.get()
+        checkpoint = checkpoint.to_dict() if checkpoint.exists else {}
+        cutoff = rollup_cutoff()
+        since = checkpoint.get('since') or ACTIVITY_EPOCH
+        started_at = checkpoint.get('startedAt') or datetime.now(timezone.utc)
+        cursor = None
+        if checkpoint.get('cursorId'):
+            cursor = {'lastUpdated': checkpoint['cursorLastUpdated'], '__name__': checkpoint['cursorId']}
+        last_cutoff = checkpoint.get('cutoff')
+        if last_cutoff and last_cutoff < cutoff:
+            since, cursor = min(since, last_cutoff), None
+        processed = 0
+        finished = False
+
+        while not deadline.expired:
+            query = (
+                self.db.collection('users')
+                .where('lastUpdated', '>=', since)
+                .order_by('lastUpdated')
+                .order_by('__name__')
+                .select(['lastUpdated'])
+                .limit(USERS_PAGE_SIZE)
+            )
+            if cursor:
+                query = query.start_after(cursor)
+            page = list(query.stream())
+
+            for doc in page:
+                if deadline.expired:
+                    break
+                self.rollup(doc.id, cutoff)
+                # Holds left by requests that died are refunded before the balance is checked
+                user = self.firestore_service.get_user_context(doc.id)
+                self.firestore_service.release_expired_holds(user)
+                self.reconcile(doc.id, user.balance)
+                # Processing can move the user later in the order (a refund writes lastUpdated); it is just seen again
+                cursor = {'lastUpdated': doc.get('lastUpdated'), '__name__': doc.id}
+                processed += 1
+            else:
+                # End of the active users: the next pass starts from this one's start
+                finished = len(page) < USERS_PAGE_SIZE
+
+            if finished:
+                checkpoint_ref.set({
+                    'since': started_at - ACTIVITY_OVERLAP,
+                    'cutoff': cutoff,
+                    'updatedAt': firestore.SERVER_TIMESTAMP
+                })
+                break
+            checkpoint_ref.set({
+                'since': since,
+                'cutoff': cutoff,
+                'startedAt': started_at,
+                'cursorId': cursor['__name__'] if cursor else None,
+                'cursorLastUpdated': cursor['lastUpdated'] if cursor else None,
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            })
+
+        logger.info(f"Rolled up transactions for {processed} users changed since {since}, resume cursor: {cursor}")
+        return processed
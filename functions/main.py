@@ -1,16 +1,15 @@
 """Firebase Functions for AI image generation and prompt suggestions."""
-from firebase_functions import https_fn
-from firebase_admin import initialize_app, firestore
+from firebase_functions import https_fn, scheduler_fn, tasks_fn, options
+from firebase_admin import initialize_app
 from typing import Dict, Any, List
+import base64
 import logging
-import json
 import os
 import re
 
-from gemini_client import GeminiClient
 from auth_guards import require_auth, AuthContext
+from deadline import Deadline
 from prompts import FallbackSuggestions
-from firestore_service import FirestoreService
 
 # Configure logging to see errors in the console
 logging.basicConfig(level=logging.INFO)
@@ -19,75 +18,74 @@ logger = logging.getLogger(__name__)
 # Initialize Firebase Admin
 initialize_app()
 
-def _get_user_role(uid: str) -> str:
-    """Get user role from Firestore."""
-    try:
-        db = firestore.client()
-        user_doc = db.collection('users').document(uid).get()
-        if user_doc.exists:
-            return user_doc.to_dict().get('role', 'normal')
-        return 'normal'
-    except Exception as e:
-        logger.warning(f"Failed to get user role for {uid}: {e}")
-        return 'normal'
+# Heavy SDKs (google.generativeai, google.cloud.firestore/storage) are imported
+# on first use so entry points that don't need them don't pay for them on cold start.
+def _gemini_client():
+    """Import the Gemini SDK and return the shared client."""
+    from gemini_client import get_gemini_client
+    return get_gemini_client()
 
-def _check_and_deduct_tokens(auth: AuthContext, firestore_service: FirestoreService, tokens_needed: int) -> bool:
-    """Check token balance and deduct if user is not admin/VIP. Returns True if operation should proceed."""
-    user_role = _get_user_role(auth.uid)
-    
-    # Admin and VIP users bypass token requirements
-    if user_role in ['admin', 'premium']:
-        logger.info(f"User {auth.uid} has {user_role} role - bypassing token requirement")
-        return True
-    
-    # Check token balance for normal users
-    current_balance = firestore_service.get_user_balance(auth.uid)
-    logger.info(f"User {auth.uid} current balance: {current_balance}, needs: {tokens_needed}")
-    
-    if current_balance < tokens_needed:
-        logger.warning(f"Insufficient tokens for user {auth.uid}: {current_balance} < {tokens_needed}")
-        raise https_fn.HttpsError('failed-precondition', 'Insufficient tokens', {
-            'needsTokens': True, 
-            'balance': current_balance,
-            'required': tokens_needed
-        })
-    
-    return True
+def _firestore_service():
+    """Import the Firestore SDK and return the shared service."""
+    from firestore_service import get_firestore_service
+    return get_firestore_service()
 
-def _check_generation_limits(auth: AuthContext, firestore_service: FirestoreService, images_to_generate: int) -> bool:
-    """Check weekly generation limits for non-admin users. Returns True if operation should proceed."""
-    user_role = _get_user_role(auth.uid)
-    
-    # Admin users bypass generation limits
-    if user_role == 'admin':
-        logger.info(f"User {auth.uid} has admin role - bypassing generation limit")
-        return True
-    
-    # Check weekly generation limit for non-admin users
-    if not firestore_service.check_weekly_generation_limit(auth.uid, images_to_generate):
-        logger.warning(f"Weekly generation limit exceeded for user {auth.uid}")
-        raise https_fn.HttpsError('failed-precondition', 'Weekly generation limit exceeded', {
-            'weeklyLimitExceeded': True,
-            'weeklyLimit': 300,
-            'imagesRequested': images_to_generate
-        })
-    
-    return True
+# Callable timeout (the platform default, made explicit) and the part of it kept
+# back from generation for saving, settling tokens and returning the response
+CALLABLE_TIMEOUT_SEC = 60
+DEADLINE_MARGIN_SEC = 10
+
+# A callable is certainly gone after this; its idempotency record and token hold can be reclaimed
+CALLABLE_ABANDONED_AFTER_SEC = CALLABLE_TIMEOUT_SEC + DEADLINE_MARGIN_SEC
 
-def _deduct_tokens_after_success(auth: AuthContext, firestore_service: FirestoreService, tokens_to_deduct: int):
-    """Deduct tokens after successful generation (only for normal users)."""
-    user_role = _get_user_role(auth.uid)
+def _run_pack(
+    client, firestore_service, uid: str, prompts: List[str], source_image,
+    on_image=None, skip=(), user=None, deadline=None, generation_prompts=None
+) -> list:
+    """
+    Generate and save pack images concurrently on the shared event loop. Returns PromptResults.
+    Image metadata is staged on user for the ledger commit when given; otherwise it is
+    handed to on_image(image, pending_writes) to write. Prompts that can't finish
+    before deadline are skipped or cancelled. generation_prompts are the prebuilt full
+    prompts from the pack catalog, when available.
+    """
+    import async_runtime
+    from pack_engine import PackGeneration
     
-    # Admin and VIP users don't get tokens deducted
-    if user_role in ['admin', 'premium']:
-        logger.info(f"User {auth.uid} has {user_role} role - skipping token deduction")
-        return
+    async def generate_single_image(i: int, prompt: str) -> bytes:
+        logger.info(f"Generating image {i+1}/{len(prompts)}: {prompt[:100]}...")
+        return await client.generate_image_async(
+            original_image=source_image,
+            prompt=prompt,
+            deadline=deadline,
+            generation_prompt=generation_prompts[i] if generation_prompts else None
+        )
     
-    # Deduct tokens for normal users
-    if not firestore_service.deduct_tokens(auth.uid, tokens_to_deduct):
-        logger.warning(f"Failed to deduct {tokens_to_deduct} tokens for user {auth.uid} after successful generation")
-    else:
-        logger.info(f"Successfully deducted {tokens_to_deduct} tokens for user {auth.uid}")
+    async def save_single_image(i: int, prompt: str, image_data: bytes) -> Dict[str, Any]:
+        # Upload to Firebase Storage; the Firestore metadata write is deferred
+        pending_writes = user.pending_writes if user is not None else []
+        image_url, doc_id = await async_runtime.run_blocking(
+            firestore_service.save_image_to_firebase, image_data, uid, prompt, pending_writes
+        )
+        image = {
+            'imageUrl': image_url,
+            'prompt': prompt,
+            'index': i,
+            'documentId': doc_id
+        }
+        if on_image is not None:
+            await async_runtime.run_blocking(on_image, image, pending_writes)
+        return image
+    
+    generation = PackGeneration(
+        prompts,
+        generate_single_image,
+        save_single_image,
+        skip=skip,
+        deadline=deadline,
+        estimated_seconds=client.expected_image_seconds()
+    )
+    return async_runtime.run(generation.run())
 
 def _validate_request_data(request_data: Dict[str, Any], required_fields: List[str]) -> None:
     """Validate request data has required fields."""
@@ -104,61 +102,79 @@ def _validate_request_data(request_data: Dict[str, Any], required_fields: List[s
         logger.error(f"Missing required parameters: {missing_fields}")
         raise https_fn.HttpsError('invalid-argument', f'Missing required parameters: {", ".join(missing_fields)}')
 
-@https_fn.on_call(secrets=["GOOGLE_AI_API_KEY"])
+@https_fn.on_call(secrets=["GOOGLE_AI_API_KEY"], timeout_sec=CALLABLE_TIMEOUT_SEC)
 @require_auth
 def generate_image(req: https_fn.CallableRequest) -> Dict[str, Any]:
     """Generate image using Google Gemini API with role-based token validation."""
+    call = None
+    deadline = Deadline(CALLABLE_TIMEOUT_SEC - DEADLINE_MARGIN_SEC)
     try:
         logger.info(f"Image generation request received for user: {req.auth.uid}")
         
         # Get user context
         auth = AuthContext(req)
-        firestore_service = FirestoreService()
+        firestore_service = _firestore_service()
         
         # Validate request data
         _validate_request_data(req.data, ['originalImage', 'prompt'])
         
-        # Check token balance (bypassed for admin/VIP)
-        _check_and_deduct_tokens(auth, firestore_service, 1)
-        
-        # Check weekly generation limits (bypassed for admin)
-        _check_generation_limits(auth, firestore_service, 1)
+        # A retry with the same idempotency key gets the original result instead of a new generation
+        from idempotency import IdempotentCall
+        call = IdempotentCall(
+            firestore_service, auth.uid, 'generate_image', req.data,
+            deadline=deadline, stale_after=CALLABLE_ABANDONED_AFTER_SEC
+        )
+        previous_result = call.begin()
+        if previous_result is not None:
+            return previous_result
         
-        # Extract parameters
-        original_image_base64 = req.data.get('originalImage')
+        # Extract parameters; images are base64 strings or Storage references fetched here as bytes
+        from storage_inputs import resolve_image_input
+        original_image = resolve_image_input(firestore_service, auth.uid, req.data.get('originalImage'))
         prompt = req.data.get('prompt')
-        reference_image_base64 = req.data.get('referenceImage')
+        reference_image = resolve_image_input(firestore_service, auth.uid, req.data.get('referenceImage'))
         
-        logger.info(f"Processing image generation with prompt: {prompt[:100]}...")
+        # Hold tokens and weekly allowance (bypassed for admin/VIP)
+        user = firestore_service.get_user_context(auth.uid)
+        reservation = firestore_service.reserve_tokens(user, 1, CALLABLE_ABANDONED_AFTER_SEC)
         
-        # Generate image
-        client = GeminiClient()
-        image_data = client.generate_image(
-            original_image_base64=original_image_base64,
-            prompt=prompt,
-            reference_image_base64=reference_image_base64
-        )
-        
-        # Deduct token after successful generation (bypassed for admin/VIP)
-        _deduct_tokens_after_success(auth, firestore_service, 1)
-        
-        # Increment generation counts
-        firestore_service.increment_generation_counts(auth.uid, 1)
+        logger.info(f"Processing image generation with prompt: {prompt[:100]}...")
         
-        # Get updated balance
-        new_balance = firestore_service.get_user_balance(auth.uid)
+        # Anything that fails before the hold is settled gives it back
+        try:
+            client = _gemini_client()
+            image_data = client.generate_image(
+                original_image=original_image,
+                prompt=prompt,
+                reference_image=reference_image,
+                deadline=deadline
+            )
+            
+            # Settle the hold for the generated image
+            new_balance = firestore_service.commit_reservation(reservation, 1)
+        except Exception:
+            firestore_service.release_reservation(reservation)
+            raise
+        user.log_io('generate_image')
         logger.info(f"Image generation successful for user {auth.uid}, new balance: {new_balance}")
         
-        return {
-            'imageData': image_data,
+        result = {
+            # Base64 only at the API boundary, for the app
+            'imageData': base64.b64encode(image_data).decode('utf-8'),
             'tokensRemaining': new_balance
         }
+        call.complete(result, image_bytes=image_data)
+        return result
     
     except https_fn.HttpsError as e:
         logger.error(f"HttpsError in generate_image: {e.code} - {e.message}")
+        if call is not None:
+            call.abandon()
         raise
     except Exception as e:
         logger.error(f"Unexpected error in generate_image: {str(e)}", exc_info=True)
+        if call is not None:
+            call.abandon()
         raise https_fn.HttpsError('internal', f'Failed to generate image: {str(e)}')
 
 @https_fn.on_call(secrets=["GOOGLE_AI_API_KEY"])
@@ -177,15 +193,19 @@ def generate_prompt_suggestions(req: https_fn.CallableRequest) -> Dict[str, Any]
             logger.error("Invalid request data for prompt suggestions")
             raise https_fn.HttpsError('invalid-argument', 'Invalid request data')
         
-        # Extract image data
-        image_base64 = request_data.get('imageData')
-        if not image_base64:
+        # Extract image data: a base64 string or a Storage reference
+        image_data = request_data.get('imageData')
+        if not image_data:
             logger.error("Missing image data for prompt suggestions")
             raise https_fn.HttpsError('invalid-argument', 'Missing image data')
         
+        from storage_inputs import is_storage_reference, resolve_image_input
+        if is_storage_reference(image_data):
+            image_data = resolve_image_input(_firestore_service(), auth.uid, image_data)
+        
         # Use Gemini client to generate suggestions
-        client = GeminiClient()
-        suggestions = client.generate_suggestions(image_base64)
+        client = _gemini_client()
+        suggestions = client.generate_suggestions(image_data)
         
         logger.info(f"Generated {len(suggestions)} suggestions for user {auth.uid}")
         return {'suggestions': suggestions}
@@ -200,9 +220,89 @@ def generate_prompt_suggestions(req: https_fn.CallableRequest) -> Dict[str, Any]
         logger.info(f"Returning fallback suggestions for user {req.auth.uid}")
         return {'suggestions': fallback_suggestions}
 
+GALLERY_DEFAULT_PAGE_SIZE = 30
+GALLERY_MAX_PAGE_SIZE = 100
+
+@https_fn.on_call()
+@require_auth
+def get_gallery(req: https_fn.CallableRequest) -> Dict[str, Any]:
+    """Return one page of the caller's generated images, newest first, with thumbnail URLs and blurhashes."""
+    try:
+        auth = AuthContext(req)
+        request_data = req.data or {}
+        
+        try:
+            page_size = min(max(int(request_data.get('pageSize', GALLERY_DEFAULT_PAGE_SIZE)), 1), GALLERY_MAX_PAGE_SIZE)
+            return _firestore_service().list_user_images(auth.uid, page_size, request_data.get('cursor'))
+        except (TypeError, ValueError) as e:
+            raise https_fn.HttpsError('invalid-argument', str(e))
+    
+    except https_fn.HttpsError as e:
+        logger.error(f"HttpsError in get_gallery: {e.code} - {e.message}")
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in get_gallery: {str(e)}", exc_info=True)
+        raise https_fn.HttpsError('internal', f'Failed to load gallery: {str(e)}')
+
+@https_fn.on_call()
+@require_auth
+def set_premium_listing(req: https_fn.CallableRequest) -> Dict[str, Any]:
+    """Admin only: add an email to or remove it from premium_list, updating an existing user's role and claim."""
+    try:
+        auth = AuthContext(req)
+        firestore_service = _firestore_service()
+        if not auth.is_admin(firestore_service):
+            raise https_fn.HttpsError('permission-denied', 'Only admins can change the premium list')
+        
+        request_data = req.data or {}
+        email = request_data.get('email')
+        if not email or not isinstance(request_data.get('listed'), bool):
+            raise https_fn.HttpsError('invalid-argument', 'email and listed are required')
+        
+        from role_claims import update_premium_listing
+        update_premium_listing(firestore_service.db, email, request_data['listed'])
+        return {'success': True}
+    
+    except https_fn.HttpsError as e:
+        logger.error(f"HttpsError in set_premium_listing: {e.code} - {e.message}")
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in set_premium_listing: {str(e)}", exc_info=True)
+        raise https_fn.HttpsError('internal', f'Failed to update premium list: {str(e)}')
+
+HISTORY_DEFAULT_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 100
+
+@https_fn.on_call()
+@require_auth
+def get_transaction_history(req: https_fn.CallableRequest) -> Dict[str, Any]:
+    """Return one page of the caller's token transactions, newest first. Admins may pass userId to view another user."""
+    from ledger import Ledger
+    try:
+        auth = AuthContext(req)
+        firestore_service = _firestore_service()
+        request_data = req.data or {}
+        
+        uid = request_data.get('userId') or auth.uid
+        if uid != auth.uid and not auth.is_admin(firestore_service):
+            raise https_fn.HttpsError('permission-denied', 'Only admins can view other users\' transactions')
+        
+        try:
+            page_size = min(max(int(request_data.get('pageSize', HISTORY_DEFAULT_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+            return Ledger(firestore_service).history(uid, page_size, request_data.get('cursor'))
+        except (TypeError, ValueError) as e:
+            raise https_fn.HttpsError('invalid-argument', str(e))
+    
+    except https_fn.HttpsError as e:
+        logger.error(f"HttpsError in get_transaction_history: {e.code} - {e.message}")
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in get_transaction_history: {str(e)}", exc_info=True)
+        raise https_fn.HttpsError('internal', f'Failed to load transaction history: {str(e)}')
+
 @https_fn.on_request()
 def superwall_webhook(req: https_fn.Request) -> https_fn.Response:
-    """Handle Superwall webhook events for purchases and subscriptions."""
+    """Validate and store Superwall webhook events, then acknowledge; process_superwall_events applies them."""
     try:
         logger.info("Superwall webhook received")
         
@@ -215,121 +315,24 @@ def superwall_webhook(req: https_fn.Request) -> https_fn.Response:
             return https_fn.Response("Unauthorized", status=401)
         
         # Parse webhook payload
-        webhook_data = req.get_json()
+        webhook_data = req.get_json(silent=True)
         if not webhook_data:
             logger.error("Invalid webhook payload - no JSON data")
             return https_fn.Response("Invalid payload", status=400)
         
-        logger.info(f"Webhook data: {json.dumps(webhook_data, indent=2)}")
+        from superwall_events import SuperwallEvents
+        try:
+            event, pending = SuperwallEvents(_firestore_service()).record(webhook_data)
+        except ValueError as e:
+            logger.error(f"Invalid webhook event {webhook_data.get('type')}: {str(e)}")
+            return https_fn.Response(str(e), status=400)
         
-        # Extract event information from the actual Superwall payload structure
-        event_type = webhook_data.get('type')
-        event_data = webhook_data.get('data', {})
+        logger.info(f"Stored Superwall event {event['eventId']} ({event['type']}) for user {event['userId']}")
         
-        # Extract user ID from originalAppUserId and remove Superwall alias prefix
-        original_app_user_id = event_data.get('originalAppUserId', '')
-        if original_app_user_id.startswith('$SuperwallAlias:'):
-            user_id = original_app_user_id.replace('$SuperwallAlias:', '')
-        else:
-            user_id = original_app_user_id
-            
-        if not user_id:
-            logger.error(f"No user ID found in webhook: {webhook_data}")
-            return https_fn.Response("No user ID", status=400)
-        
-        # Get product ID
-        product_id = event_data.get('productId', '')
-        
-        logger.info(f"Processing event {event_type} for user {user_id}, product: {product_id}")
-        
-        firestore_service = FirestoreService()
-        
-        # Handle different event types based on actual Superwall event types
-        if event_type in ['subscription_start', 'initial_purchase', 'trial_start']:
-            # New subscription or trial
-            firestore_service.update_subscription_status(
-                uid=user_id,
-                status='active',
-                product_id=product_id,
-                grant_tokens=True
-            )
-            logger.info(f"Subscription started for user {user_id}: {product_id}")
-            
-        elif event_type == 'renewal':
-            # Subscription renewal - grant tokens
-            firestore_service.update_subscription_status(
-                uid=user_id,
-                status='active',
-                product_id=product_id,
-                grant_tokens=True
-            )
-            logger.info(f"Subscription renewed for user {user_id}: {product_id}")
-            
-        elif event_type in ['cancellation', 'subscription_cancel']:
-            # Subscription canceled
-            firestore_service.update_subscription_status(
-                uid=user_id,
-                status='canceled',
-                grant_tokens=False
-            )
-            logger.info(f"Subscription canceled for user {user_id}")
-            
-        elif event_type in ['expiration', 'subscription_expire']:
-            # Subscription expired
-            firestore_service.update_subscription_status(
-                uid=user_id,
-                status='expired',
-                grant_tokens=False
-            )
-            logger.info(f"Subscription expired for user {user_id}")
-            
-        elif event_type in ['non_consumable_purchase', 'consumable_purchase']:
-            # Token pack purchase
-            # Map product IDs to token amounts (update these with your actual product IDs)
-            token_amounts = {
-                'reeys.tokens.200': 200,
-                'reeys.tokens.500': 500,
-                'reeys.tokens.2000': 2000,
-                # Add your actual token pack product IDs here
-            }
-            
-            token_amount = token_amounts.get(product_id, 0)
-            if token_amount > 0:
-                firestore_service.add_tokens(
-                    uid=user_id,
-                    amount=token_amount,
-                    source='token_pack'
-                )
-                logger.info(f"Token pack purchased for user {user_id}: {product_id} = {token_amount} tokens")
-            else:
-                logger.warning(f"Unknown product ID for token pack: {product_id}")
-        
-        elif event_type == 'refund':
-            # Handle refund - you might want to deduct tokens or mark subscription as refunded
-            logger.info(f"Refund event for user {user_id}, product: {product_id}")
-            
-            # Optional: Deduct tokens for refunded token packs
-            token_amounts = {
-                'reeys.tokens.200': 200,
-                'reeys.tokens.500': 500,
-                'reeys.tokens.2000': 2000,
-            }
-            
-            if product_id in token_amounts:
-                # This was a token pack refund - you might want to deduct tokens
-                # firestore_service.deduct_tokens(user_id, token_amounts[product_id])
-                logger.info(f"Token pack refunded: {product_id}")
-            else:
-                # This was a subscription refund
-                firestore_service.update_subscription_status(
-                    uid=user_id,
-                    status='refunded',
-                    grant_tokens=False
-                )
-                logger.info(f"Subscription refunded for user {user_id}")
-            
-        else:
-            logger.warning(f"Unknown event type: {event_type}")
+        # Apply it out of band; if queueing fails Superwall redelivers and the stored event is queued again
+        if pending:
+            from firebase_admin import functions
+            functions.task_queue('process_superwall_events').enqueue({'userId': event['userId']})
         
         return https_fn.Response("OK", status=200)
         
@@ -337,6 +340,23 @@ def superwall_webhook(req: https_fn.Request) -> https_fn.Response:
         logger.error(f"Webhook error: {str(e)}", exc_info=True)
         return https_fn.Response(f"Error: {str(e)}", status=500)
 
+@tasks_fn.on_task_dispatched(
+    retry_config=options.RetryConfig(max_attempts=10, min_backoff_seconds=10),
+    rate_limits=options.RateLimits(max_concurrent_dispatches=20),
+)
+def process_superwall_events(req: tasks_fn.CallableRequest) -> None:
+    """Apply a user's stored Superwall events in order, each exactly once."""
+    from superwall_events import SuperwallEvents
+    
+    user_id = (req.data or {}).get('userId')
+    if not user_id:
+        logger.error("Superwall event task without userId")
+        return
+    
+    # Raises on failure so Cloud Tasks retries; events already applied are skipped next time
+    applied = SuperwallEvents(_firestore_service()).process_user(user_id)
+    logger.info(f"Applied {applied} Superwall events for user {user_id}")
+
 @https_fn.on_call()
 @require_auth
 def handle_first_time_user(req: https_fn.CallableRequest) -> Dict[str, Any]:
@@ -346,7 +366,7 @@ def handle_first_time_user(req: https_fn.CallableRequest) -> Dict[str, Any]:
         
         # Get user context
         auth = AuthContext(req)
-        firestore_service = FirestoreService()
+        firestore_service = _firestore_service()
         
         # Get request data
         request_data = req.data or {}
@@ -354,11 +374,9 @@ def handle_first_time_user(req: https_fn.CallableRequest) -> Dict[str, Any]:
         user_name = request_data.get('name') or auth.token.get('name')
         
         # Check if user already exists
-        db = firestore.client()
-        user_doc_ref = db.collection('users').document(auth.uid)
-        user_doc = user_doc_ref.get()
+        user = firestore_service.get_user_context(auth.uid)
         
-        if user_doc.exists:
+        if user.exists:
             logger.info(f"User {auth.uid} already initialized")
             return {
                 'success': True,
@@ -366,20 +384,22 @@ def handle_first_time_user(req: https_fn.CallableRequest) -> Dict[str, Any]:
                 'isNewUser': False
             }
         
-        # Determine role: check if email is in premium_list
-        role = 'normal'  # default
-        if user_email:
-            premium_query = db.collection('premium_list').where('email', '==', user_email).limit(1).get()
-            if premium_query:
-                role = 'premium'
-                logger.info(f"User {auth.uid} ({user_email}) granted premium role")
+        # Determine role: check if email is in premium_list (a leftover claim may be stale, so it isn't trusted)
+        role = 'normal'
+        if user_email and user.is_premium_listed(user_email):
+            role = 'premium'
+            logger.info(f"User {auth.uid} ({user_email}) granted premium role")
         
         # Initialize user with secure token allocation
+        from firebase_admin import firestore
+        from user_context import iso_week
         welcome_tokens = 5  # Secure default amount
-        user_data = {
+        user.create({
             'balance': welcome_tokens,
             'subscriptionStatus': 'none',
             'subscriptionProductId': None,
+            # Present (if null) so the refill's lastTokenAdd == null query finds the user once subscribed
+            'lastTokenAdd': None,
             'lastUpdated': firestore.SERVER_TIMESTAMP,
             'createdAt': firestore.SERVER_TIMESTAMP,
             'role': role,
@@ -387,20 +407,28 @@ def handle_first_time_user(req: https_fn.CallableRequest) -> Dict[str, Any]:
             'name': user_name,
             'totalGenerated': 0,
             'weeklyGenerated': 0,
-            'weekStartDate': firestore.SERVER_TIMESTAMP,
-        }
-        
-        # Create user document
-        user_doc_ref.set(user_data)
+            'generationWeek': iso_week(),
+        })
         
         # Record welcome token transaction
-        firestore_service._record_transaction(
-            uid=auth.uid,
+        user.record_transaction(
             event='welcome_bonus', 
             amount=welcome_tokens,
             description=f'Welcome bonus for new user: {role} role'
         )
         
+        # Create user document and transaction together
+        user.commit()
+        user.log_io('handle_first_time_user')
+        
+        # Keep the client-visible claim in step with the role just written
+        if role != auth.role_claim:
+            try:
+                from role_claims import sync_role_claim
+                sync_role_claim(auth.uid, role)
+            except Exception as e:
+                logger.error(f"Failed to set role claim for user {auth.uid}: {str(e)}")
+        
         logger.info(f"Successfully initialized user {auth.uid} with role {role} and {welcome_tokens} tokens")
         
         return {
@@ -416,120 +444,237 @@ def handle_first_time_user(req: https_fn.CallableRequest) -> Dict[str, Any]:
         logger.error(f"Error initializing first-time user {req.auth.uid}: {str(e)}", exc_info=True)
         raise https_fn.HttpsError('internal', f'Failed to initialize user: {str(e)}')
 
-@https_fn.on_call(secrets=["GOOGLE_AI_API_KEY"])
+@https_fn.on_call(secrets=["GOOGLE_AI_API_KEY"], timeout_sec=CALLABLE_TIMEOUT_SEC)
 @require_auth
 def generate_pack_images(req: https_fn.CallableRequest) -> Dict[str, Any]:
-    """Generate multiple images from a pack using Google Gemini API with role-based token validation."""
+    """
+    Generate multiple images from a pack using Google Gemini API with role-based token validation.
+    Prompts that can't finish within the call's time budget are dropped; the images
+    that did finish are returned and only those are billed.
+    """
+    call = None
+    deadline = Deadline(CALLABLE_TIMEOUT_SEC - DEADLINE_MARGIN_SEC)
     try:
         logger.info(f"Pack generation request received for user: {req.auth.uid}")
         
         # Get user context
         auth = AuthContext(req)
-        firestore_service = FirestoreService()
+        firestore_service = _firestore_service()
         
         # Validate request data
         _validate_request_data(req.data, ['originalImage', 'packId'])
         
-        # Extract parameters
-        original_image_base64 = req.data.get('originalImage')
+        # A retry with the same idempotency key gets the original result instead of a new generation
+        from idempotency import IdempotentCall
+        call = IdempotentCall(
+            firestore_service, auth.uid, 'generate_pack_images', req.data,
+            deadline=deadline, stale_after=CALLABLE_ABANDONED_AFTER_SEC
+        )
+        previous_result = call.begin()
+        if previous_result is not None:
+            return previous_result
+        
+        # Extract parameters; the image is a base64 string or a Storage reference
+        original_image = req.data.get('originalImage')
         pack_id = req.data.get('packId')
         
-        # Get pack data from Firestore
-        db = firestore.client()
-        pack_doc = db.collection('packs').document(pack_id).get()
+        # Get pack data from the instance's catalog, kept in sync with Firestore by a listener
+        from pack_catalog import get_pack_catalog
+        pack = get_pack_catalog(firestore_service.db).get(pack_id)
         
-        if not pack_doc.exists:
+        if pack is None:
             logger.error(f"Pack not found: {pack_id}")
             raise https_fn.HttpsError('not-found', 'Pack not found')
         
-        pack_data = pack_doc.to_dict()
-        prompts = pack_data.get('prompt', [])
+        prompts = pack.prompts
         
         if not prompts:
             logger.error(f"No prompts found in pack: {pack_id}")
             raise https_fn.HttpsError('invalid-argument', 'Pack has no prompts')
         
-        # Check token balance (bypassed for admin/VIP)
-        tokens_needed = len(prompts)
-        _check_and_deduct_tokens(auth, firestore_service, tokens_needed)
-        
-        # Check weekly generation limits (bypassed for admin)
-        _check_generation_limits(auth, firestore_service, len(prompts))
+        client = _gemini_client()
         
-        logger.info(f"Generating {len(prompts)} images for pack: {pack_data.get('name')}")
+        # Decode and normalize the source image once for every prompt in the pack
+        from storage_inputs import resolve_image_input
+        source_image = client.prepare_image_part(resolve_image_input(firestore_service, auth.uid, original_image))
         
-        # Use Gemini client to generate all images in parallel
-        import concurrent.futures
-        import functools
+        # Hold tokens and weekly allowance (bypassed for admin/VIP); a job's hold lasts until the job settles it
+        job_mode = req.data.get('mode') == 'job'
+        user = firestore_service.get_user_context(auth.uid)
+        reservation = firestore_service.reserve_tokens(
+            user, len(prompts), PACK_JOB_HOLD_SEC if job_mode else CALLABLE_ABANDONED_AFTER_SEC
+        )
         
-        client = GeminiClient()
-        generated_images = []
+        logger.info(f"Generating {len(prompts)} images for pack: {pack.name}")
         
-        def generate_single_image(index_prompt_tuple):
-            i, prompt = index_prompt_tuple
-            try:
-                logger.info(f"Generating image {i+1}/{len(prompts)}: {prompt[:100]}...")
-                image_data = client.generate_image(
-                    original_image_base64=original_image_base64,
-                    prompt=prompt,
-                    reference_image_base64=None
+        # Anything that fails before the hold is settled or handed to a job gives it back
+        try:
+            # Job mode: return right away and let process_pack_job publish images as they finish
+            if job_mode:
+                from firebase_admin import functions
+                from pack_jobs import PackJobs
+                job_id = PackJobs(firestore_service).create(
+                    auth.uid, pack_id, pack.name, prompts, source_image, reservation
                 )
+                functions.task_queue('process_pack_job').enqueue({'jobId': job_id})
+            else:
+                results = _run_pack(
+                    client, firestore_service, auth.uid, prompts, source_image,
+                    user=user, deadline=deadline, generation_prompts=pack.generation_prompts
+                )
+                generated_images = [result.value for result in results if result.ok]
+                timed_out_count = sum(1 for result in results if result.timed_out)
+                timings = [result.timing() for result in results]
+                logger.info(f"Pack {pack_id} prompt timings: {timings}, rate limiter: {client.image_rate_limiter.metrics()}")
                 
-                # Save image to Firebase Storage and Firestore
-                image_url, doc_id = firestore_service.save_image_to_firebase(image_data, auth.uid, prompt)
+                if not generated_images:
+                    raise https_fn.HttpsError('internal', 'Failed to generate any images')
                 
-                return {
-                    'imageUrl': image_url,
-                    'prompt': prompt,
-                    'index': i,
-                    'documentId': doc_id
-                }
-            except Exception as e:
-                logger.error(f"Failed to generate image {i+1}: {str(e)}")
-                return None
-        
-        # Generate images in parallel using ThreadPoolExecutor
-        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-            # Submit all tasks
-            future_to_index = {
-                executor.submit(generate_single_image, (i, prompt)): i 
-                for i, prompt in enumerate(prompts)
+                # Settle the hold and write all image metadata in one transaction
+                new_balance = firestore_service.commit_reservation(reservation, len(generated_images))
+        except Exception:
+            firestore_service.release_reservation(reservation)
+            raise
+        
+        if job_mode:
+            logger.info(f"Queued pack job {job_id} for user {auth.uid}")
+            result = {
+                'jobId': job_id,
+                'packName': pack.name,
+                'totalPrompts': len(prompts)
             }
-            
-            # Collect results
-            for future in concurrent.futures.as_completed(future_to_index):
-                result = future.result()
-                if result is not None:
-                    generated_images.append(result)
-        
-        # Sort results by index to maintain order
-        generated_images.sort(key=lambda x: x['index'])
+            call.complete(result)
+            return result
         
-        if not generated_images:
-            raise https_fn.HttpsError('internal', 'Failed to generate any images')
-        
-        # Deduct tokens after successful generation (bypassed for admin/VIP)
-        tokens_to_deduct = len(generated_images)
-        _deduct_tokens_after_success(auth, firestore_service, tokens_to_deduct)
-        
-        # Increment generation counts
-        firestore_service.increment_generation_counts(auth.uid, len(generated_images))
-        
-        # Get updated balance
-        new_balance = firestore_service.get_user_balance(auth.uid)
+        user.log_io('generate_pack_images')
         logger.info(f"Pack generation successful for user {auth.uid}, {len(generated_images)} images generated, new balance: {new_balance}")
         
-        return {
+        result = {
             'images': generated_images,
-            'packName': pack_data.get('name'),
+            'packName': pack.name,
             'tokensRemaining': new_balance,
             'generatedCount': len(generated_images),
-            'totalPrompts': len(prompts)
+            'totalPrompts': len(prompts),
+            'timedOutCount': timed_out_count,
+            'timings': timings
         }
+        call.complete(result)
+        return result
     
     except https_fn.HttpsError as e:
         logger.error(f"HttpsError in generate_pack_images: {e.code} - {e.message}")
+        if call is not None:
+            call.abandon()
         raise
     except Exception as e:
         logger.error(f"Unexpected error in generate_pack_images: {str(e)}", exc_info=True)
+        if call is not None:
+            call.abandon()
         raise https_fn.HttpsError('internal', f'Failed to generate pack images: {str(e)}')
+
+PACK_JOB_TIMEOUT_SEC = 540
+PACK_JOB_MAX_ATTEMPTS = 5
+
+# Covers every attempt and Cloud Tasks' backoff between them; finish() or cleanup settles the hold sooner
+PACK_JOB_HOLD_SEC = 6 * 3600
+
+@tasks_fn.on_task_dispatched(
+    secrets=["GOOGLE_AI_API_KEY"],
+    timeout_sec=PACK_JOB_TIMEOUT_SEC,
+    memory=options.MemoryOption.GB_1,
+    retry_config=options.RetryConfig(max_attempts=PACK_JOB_MAX_ATTEMPTS, min_backoff_seconds=60),
+)
+def process_pack_job(req: tasks_fn.CallableRequest) -> None:
+    """Generate a queued pack job, publishing each image as it finishes and resuming after restarts."""
+    from pack_jobs import PackJobs
+    
+    job_id = (req.data or {}).get('jobId')
+    if not job_id:
+        logger.error("Pack job task without jobId")
+        return
+    
+    firestore_service = _firestore_service()
+    jobs = PackJobs(firestore_service)
+    
+    # Raises while another attempt holds the lease, so Cloud Tasks retries later;
+    # a job left unfinished after the last attempt is settled by settle_stale_pack_jobs
+    job = jobs.claim(job_id, PACK_JOB_TIMEOUT_SEC)
+    if job is None:
+        return
+    
+    retry_count = int(req.raw_request.headers.get('X-CloudTasks-TaskRetryCount', 0))
+    final_attempt = retry_count + 1 >= PACK_JOB_MAX_ATTEMPTS
+    
+    # Prompts finished by earlier attempts are neither regenerated nor billed again
+    done = jobs.completed_images(job_id)
+    
+    try:
+        results = _run_pack(
+            _gemini_client(),
+            firestore_service,
+            job['userId'],
+            job['prompts'],
+            jobs.load_source(job),
+            on_image=lambda image, pending_writes: jobs.record_image(job_id, image, pending_writes),
+            skip=done.keys(),
+            deadline=Deadline(PACK_JOB_TIMEOUT_SEC - DEADLINE_MARGIN_SEC)
+        )
+        if not done and not any(result.ok for result in results) and not final_attempt:
+            raise RuntimeError('Failed to generate any images')
+        # Prompts that ran out of time are picked up by the next attempt
+        if any(result.timed_out for result in results) and not final_attempt:
+            raise RuntimeError('Ran out of time before every prompt finished')
+    except Exception as e:
+        logger.error(f"Pack job {job_id} attempt {retry_count + 1} failed: {str(e)}", exc_info=True)
+        if not final_attempt:
+            jobs.release(job_id)
+            raise
+    
+    # Bill exactly the images published to the job, including ones from earlier attempts
+    try:
+        jobs.finish(job, job_id, len(jobs.completed_images(job_id)))
+    except Exception as e:
+        # Settling a hold twice is a no-op, so a retry can safely finish the job again
+        logger.error(f"Failed to finish pack job {job_id}: {str(e)}", exc_info=True)
+        jobs.release(job_id)
+        raise
+
+# Unfinished jobs older than every attempt plus backoff have been given up by Cloud Tasks
+PACK_JOB_STALE_SEC = 3 * 3600
+
+@scheduler_fn.on_schedule(schedule='every 1 hours')
+def settle_stale_pack_jobs(event: scheduler_fn.ScheduledEvent) -> None:
+    """Finish pack jobs whose tasks gave up, billing only the images they published and returning the rest of the hold."""
+    from pack_jobs import JobLeasedError, PackJobs
+    
+    jobs = PackJobs(_firestore_service())
+    for job_id in jobs.stale_job_ids(PACK_JOB_STALE_SEC):
+        try:
+            job = jobs.claim(job_id, PACK_JOB_TIMEOUT_SEC)
+            if job is None:
+                continue
+            new_balance = jobs.finish(job, job_id, len(jobs.completed_images(job_id)))
+            logger.warning(f"Settled stale pack job {job_id} for user {job['userId']}, new balance: {new_balance}")
+        except JobLeasedError:
+            # Still being worked on; a later run settles it if that attempt dies too
+            continue
+        except Exception as e:
+            logger.error(f"Failed to settle stale pack job {job_id}: {str(e)}", exc_info=True)
+
+SUBSCRIPTION_REFILL_TIMEOUT_SEC = 540
+
+@scheduler_fn.on_schedule(schedule='every 1 hours', timeout_sec=SUBSCRIPTION_REFILL_TIMEOUT_SEC, memory=options.MemoryOption.GB_1)
+def refill_subscriptions(event: scheduler_fn.ScheduledEvent) -> None:
+    """Grant the weekly subscription tokens to every active subscriber that is due, resuming where the last run stopped."""
+    from subscription_refill import SubscriptionRefill
+    
+    SubscriptionRefill(_firestore_service()).run(Deadline(SUBSCRIPTION_REFILL_TIMEOUT_SEC - 60))
+
+TRANSACTION_ROLLUP_TIMEOUT_SEC = 540
+
+@scheduler_fn.on_schedule(schedule='every day 03:00', timeout_sec=TRANSACTION_ROLLUP_TIMEOUT_SEC)
+def rollup_transactions(event: scheduler_fn.ScheduledEvent) -> None:
+    """Compact old transactions into monthly rollups and reconcile balances against the ledger."""
+    from ledger import Ledger
+    
+    Ledger(_firestore_service()).rollup_all(Deadline(TRANSACTION_ROLLUP_TIMEOUT_SEC - 60))
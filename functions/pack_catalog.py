@@ -0,0 +1,102 @@
+"""Per-instance cache of pack definitions, kept fresh by a Firestore listener."""
+from typing import Dict, List, Optional
+import logging
+import threading
+import time
+
+from prompts import ImagePrompts
+
+logger = logging.getLogger(__name__)
+
+# How long the first call waits for the listener's initial snapshot before reading directly
+INITIAL_SNAPSHOT_WAIT_SECONDS = 2.0
+
+# Packs read directly (listener not running) are reused for this long
+FALLBACK_TTL_SECONDS = 60
+
+
+class Pack:
+    """A pack's prompts plus the full generation prompt built from each, computed once."""
+
+    def __init__(self, pack_id: str, data: Dict):
+        self.id = pack_id
+        self.name = data.get('name')
+        self.prompts: List[str] = data.get('prompt', [])
+        self.generation_prompts = [ImagePrompts.get_image_generation_prompt(prompt) for prompt in self.prompts]
+
+
+class PackCatalog:
+    """
+    Mirrors the packs collection in memory. A snapshot listener started on first use
+    applies every change, so lookups don't touch Firestore. If the listener isn't
+    running (not yet synced, or stopped after an error), packs are read directly and
+    cached for FALLBACK_TTL_SECONDS, and the listener is restarted.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._packs: Dict[str, Pack] = {}
+        self._fallback: Dict[str, tuple] = {}
+        self._watch = None
+        self._synced = threading.Event()
+        self._lock = threading.Lock()
+
+    def get(self, pack_id: str) -> Optional[Pack]:
+        """Return the pack, or None if it doesn't exist."""
+        # Only the call that starts the listener waits for its first snapshot
+        started = self._ensure_listener()
+        synced = self._synced.wait(INITIAL_SNAPSHOT_WAIT_SECONDS) if started else self._synced.is_set()
+        if synced:
+            return self._packs.get(pack_id)
+        return self._get_direct(pack_id)
+
+    def _ensure_listener(self) -> bool:
+        """Start the listener if it isn't running. True if this call started it."""
+        if self._watch is not None and self._watch.is_active:
+            return False
+        with self._lock:
+            if self._watch is not None and self._watch.is_active:
+                return False
+            if self._watch is not None:
+                logger.warning("Pack catalog listener stopped, restarting")
+            self._synced.clear()
+            self._watch = self.db.collection('packs').on_snapshot(self._on_snapshot)
+            return True
+
+    def _on_snapshot(self, docs, changes, read_time) -> None:
+        if not self._synced.is_set():
+            # First snapshot after (re)starting is the whole collection
+            self._packs = {doc.id: Pack(doc.id, doc.to_dict()) for doc in docs}
+            logger.info(f"Pack catalog loaded {len(self._packs)} packs")
+            self._synced.set()
+            return
+
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                self._packs.pop(change.document.id, None)
+            else:
+                self._packs[change.document.id] = Pack(change.document.id, change.document.to_dict())
+
+    def _get_direct(self, pack_id: str) -> Optional[Pack]:
+        cached = self._fallback.get(pack_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        doc = self.db.collection('packs').document(pack_id).get()
+        pack = Pack(doc.id, doc.to_dict()) if doc.exists else None
+        self._fallback[pack_id] = (time.monotonic() + FALLBACK_TTL_SECONDS, pack)
+        return pack
+
+
+_catalog_lock = threading.Lock()
+_catalog: Optional[PackCatalog] = None
+
+
+def get_pack_catalog(db) -> PackCatalog:
+    """Return the catalog shared by warm invocations."""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = PackCatalog(db)
+    return _catalog
@@ -0,0 +1,217 @@
+"""Async pack generation engine with adaptive concurrency."""
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+import asyncio
+import collections
+import logging
+import time
+
+from deadline import Deadline
+from gemini_client import Config, is_overload_error
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Concurrency limit for Gemini calls that adapts to how the API is responding.
+    Starts in slow start (one extra slot per success) until the first sign of
+    overload, then grows by about one slot per round of healthy calls, shrinks
+    by one when latency climbs well above the best observed, and halves on 429/503.
+    Not thread-safe: use it from a single event loop.
+    """
+
+    LATENCY_TOLERANCE = 2.0
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 32):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._slow_start = True
+        self._best_latency: Optional[float] = None
+        self._waiters = collections.deque()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def acquire(self) -> None:
+        """Wait for a free slot."""
+        while self._in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass a wake-up we may have received on to the next waiter
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                self._wake()
+                raise
+        self._in_flight += 1
+
+    def release(self, latency: Optional[float], overloaded: bool = False) -> None:
+        """Free a slot and adjust the limit. latency is None for failed calls."""
+        self._in_flight -= 1
+        self._adjust(latency, overloaded)
+        self._wake()
+
+    def _wake(self) -> None:
+        for _ in range(max(self.limit - self._in_flight, 0)):
+            if not self._waiters:
+                return
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _adjust(self, latency: Optional[float], overloaded: bool) -> None:
+        if overloaded:
+            self._slow_start = False
+            self._limit = max(self.minimum, self._limit / 2)
+            logger.warning(f"Gemini overloaded, concurrency limit reduced to {self.limit}")
+            return
+
+        if latency is None:
+            return
+
+        # Track the best latency, letting it drift up slowly so one fast outlier doesn't pin it
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+        else:
+            self._best_latency += (latency - self._best_latency) * 0.05
+
+        if latency > self._best_latency * self.LATENCY_TOLERANCE:
+            self._slow_start = False
+            self._limit = max(self.minimum, self._limit - 1)
+        elif self._slow_start:
+            self._limit = min(self.maximum, self._limit + 1)
+        else:
+            self._limit = min(self.maximum, self._limit + 1 / self._limit)
+
+
+# Shared by every pack on this instance so the learned limit survives between requests
+_limiter = AdaptiveConcurrencyLimiter(
+    initial=Config.PACK_INITIAL_CONCURRENCY,
+    maximum=Config.PACK_MAX_CONCURRENCY
+)
+
+
+class PromptResult:
+    """Outcome and timing of one prompt in a pack."""
+
+    def __init__(self, index: int, prompt: str):
+        self.index = index
+        self.prompt = prompt
+        self.value: Any = None
+        self.error: Optional[Exception] = None
+        self.cancelled = False
+        self.timed_out = False
+        self.generated = False
+        self.queued_ms = 0.0
+        self.generation_ms = 0.0
+        self.total_ms = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.cancelled
+
+    def timing(self) -> Dict[str, Any]:
+        return {
+            'index': self.index,
+            'queuedMs': round(self.queued_ms),
+            'generationMs': round(self.generation_ms),
+            'totalMs': round(self.total_ms),
+            'timedOut': self.timed_out,
+        }
+
+
+class PackGeneration:
+    """
+    Runs every prompt of a pack concurrently under the adaptive limiter.
+    generate(index, prompt) runs inside a concurrency slot; save(index, prompt, value)
+    runs after the slot is released. Prompts whose index is in skip are not run.
+    With a deadline, prompts that get a slot with less than estimated_seconds left
+    are not started, and prompts still generating when it passes are cancelled;
+    images already being saved are allowed to finish. Results are returned in prompt order.
+    """
+
+    def __init__(
+        self,
+        prompts: List[str],
+        generate: Callable[[int, str], Awaitable[Any]],
+        save: Optional[Callable[[int, str, Any], Awaitable[Any]]] = None,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        skip: Iterable[int] = (),
+        deadline: Optional[Deadline] = None,
+        estimated_seconds: float = 0.0
+    ):
+        skip = set(skip)
+        self.results = [PromptResult(i, prompt) for i, prompt in enumerate(prompts) if i not in skip]
+        self._generate = generate
+        self._save = save
+        self._limiter = limiter or _limiter
+        self._deadline = deadline
+        self._estimated_seconds = estimated_seconds
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def cancel(self, index: int) -> None:
+        """Cancel one prompt. Safe to call from any thread."""
+        task = self._tasks.get(index)
+        if task is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(task.cancel)
+
+    async def run(self) -> List[PromptResult]:
+        self._loop = asyncio.get_running_loop()
+        self._tasks = {
+            result.index: asyncio.create_task(self._run_prompt(result))
+            for result in self.results
+        }
+        if self._deadline is not None:
+            _, pending = await asyncio.wait(self._tasks.values(), timeout=self._deadline.remaining())
+            if pending:
+                stragglers = [r for r in self.results if not r.generated and self._tasks[r.index] in pending]
+                logger.warning(f"Deadline reached, cancelling {len(stragglers)} unfinished prompts")
+                for result in stragglers:
+                    result.timed_out = True
+                    self._tasks[result.index].cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        return self.results
+
+    async def _run_prompt(self, result: PromptResult) -> None:
+        start = time.monotonic()
+        try:
+            await self._limiter.acquire()
+            acquired = time.monotonic()
+            result.queued_ms = (acquired - start) * 1000
+
+            if self._deadline is not None and self._deadline.remaining() < self._estimated_seconds:
+                self._limiter.release(None)
+                result.timed_out = True
+                result.cancelled = True
+                return
+
+            latency = None
+            overloaded = False
+            try:
+                value = await self._generate(result.index, result.prompt)
+                latency = time.monotonic() - acquired
+            except Exception as e:
+                overloaded = is_overload_error(e)
+                raise
+            finally:
+                result.generation_ms = (time.monotonic() - acquired) * 1000
+                self._limiter.release(latency, overloaded)
+            result.generated = True
+
+            if self._save is not None:
+                value = await self._save(result.index, result.prompt, value)
+            result.value = value
+
+        except asyncio.CancelledError:
+            result.cancelled = True
+        except Exception as e:
+            result.error = e
+            logger.error(f"Failed to generate image {result.index + 1}: {str(e)}")
+        finally:
+            result.total_ms = (time.monotonic() - start) * 1000
@@ -0,0 +1,159 @@
+"""Durable pack generation jobs stored in pack_jobs/{jobId}."""
+from firebase_admin import firestore
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
+import logging
+import uuid
+
+from firestore_service import FirestoreService, TokenReservation
+from gemini_client import ImagePart
+
+logger = logging.getLogger(__name__)
+
+
+class JobLeasedError(Exception):
+    """Another worker currently holds the job's lease."""
+
+
+class PackJobs:
+    """
+    Job document layout:
+      pack_jobs/{jobId}               status, prompts, hold and progress counters
+      pack_jobs/{jobId}/images/{idx}  one document per finished prompt, written as it completes
+    The source image is kept privately in Storage under pack_jobs/{uid}/{jobId}/source.
+    """
+
+    def __init__(self, firestore_service: FirestoreService):
+        self.firestore_service = firestore_service
+        self.db = firestore_service.db
+
+    def _job_ref(self, job_id: str):
+        return self.db.collection('pack_jobs').document(job_id)
+
+    def create(
+        self,
+        uid: str,
+        pack_id: str,
+        pack_name: str,
+        prompts: List[str],
+        source_image: ImagePart,
+        reservation: TokenReservation
+    ) -> str:
+        """Store the source image and job document. Returns the job id."""
+        job_id = str(uuid.uuid4())
+        source_path = f"pack_jobs/{uid}/{job_id}/source"
+        self.firestore_service.bucket.blob(source_path).upload_from_string(
+            source_image.data, content_type=source_image.mime_type
+        )
+
+        self._job_ref(job_id).set({
+            'userId': uid,
+            'packId': pack_id,
+            'packName': pack_name,
+            'prompts': prompts,
+            'sourcePath': source_path,
+            'sourceMimeType': source_image.mime_type,
+            'holdId': reservation.hold_id,
+            'holdImages': reservation.images,
+            'holdTokens': reservation.tokens,
+            'status': 'queued',
+            'completedCount': 0,
+            'totalPrompts': len(prompts),
+            'createdAt': firestore.SERVER_TIMESTAMP,
+        })
+        return job_id
+
+    def claim(self, job_id: str, lease_seconds: int) -> Optional[Dict[str, Any]]:
+        """
+        Take a lease on an unfinished job so duplicate task deliveries don't run it twice.
+        Returns the job data, or None if it is missing or finished.
+        Raises JobLeasedError while another worker's lease is active.
+        """
+        job_ref = self._job_ref(job_id)
+
+        @firestore.transactional
+        def claim_job(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                logger.error(f"Pack job not found: {job_id}")
+                return None
+
+            job = snapshot.to_dict()
+            if job.get('status') in ['completed', 'failed']:
+                return None
+
+            now = datetime.utcnow()
+            lease_expires_at = job.get('leaseExpiresAt')
+            if lease_expires_at and lease_expires_at.replace(tzinfo=None) > now:
+                raise JobLeasedError(f"Pack job {job_id} is leased until {lease_expires_at}")
+
+            transaction.update(job_ref, {
+                'status': 'running',
+                'leaseExpiresAt': now + timedelta(seconds=lease_seconds),
+                'attempts': firestore.Increment(1),
+            })
+            return job
+
+        return claim_job(self.db.transaction())
+
+    def release(self, job_id: str) -> None:
+        """Drop the lease so a retry can pick the job up immediately."""
+        self._job_ref(job_id).update({'status': 'queued', 'leaseExpiresAt': None})
+
+    def stale_job_ids(self, older_than_seconds: int) -> List[str]:
+        """Unfinished jobs created more than older_than_seconds ago, by when their tasks have given up."""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than_seconds)
+        docs = (
+            self.db.collection('pack_jobs')
+            .where('status', 'in', ['queued', 'running'])
+            .select(['createdAt'])
+            .stream()
+        )
+        return [doc.id for doc in docs if (doc.to_dict().get('createdAt') or cutoff) < cutoff]
+
+    def load_source(self, job: Dict[str, Any]) -> ImagePart:
+        data = self.firestore_service.bucket.blob(job['sourcePath']).download_as_bytes()
+        return ImagePart(job['sourceMimeType'], data)
+
+    def completed_images(self, job_id: str) -> Dict[int, Dict[str, Any]]:
+        """Images already generated by earlier attempts, keyed by prompt index."""
+        docs = self._job_ref(job_id).collection('images').stream()
+        return {int(doc.id): doc.to_dict() for doc in docs}
+
+    def record_image(
+        self,
+        job_id: str,
+        image: Dict[str, Any],
+        pending_writes: List[Tuple[Any, Dict[str, Any]]] = ()
+    ) -> None:
+        """Publish one finished image, together with its pending metadata writes, so clients can render it right away."""
+        job_ref = self._job_ref(job_id)
+        batch = self.db.batch()
+        for doc_ref, data in pending_writes:
+            batch.set(doc_ref, data)
+        batch.set(job_ref.collection('images').document(str(image['index'])), {
+            **image,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+        })
+        batch.update(job_ref, {'completedCount': firestore.Increment(1)})
+        batch.commit()
+
+    def finish(self, job: Dict[str, Any], job_id: str, images_generated: int) -> int:
+        """Settle the job's token hold for the images generated and close the job. Returns the new balance."""
+        user = self.firestore_service.get_user_context(job['userId'])
+        reservation = TokenReservation(user, job['holdId'], job['holdImages'], job['holdTokens'])
+        new_balance = self.firestore_service.commit_reservation(reservation, images_generated)
+
+        self._job_ref(job_id).update({
+            'status': 'completed' if images_generated else 'failed',
+            'generatedCount': images_generated,
+            'tokensRemaining': new_balance,
+            'leaseExpiresAt': None,
+            'completedAt': firestore.SERVER_TIMESTAMP,
+        })
+        try:
+            self.firestore_service.bucket.blob(job['sourcePath']).delete()
+        except Exception as e:
+            logger.warning(f"Failed to delete source image for pack job {job_id}: {str(e)}")
+        user.log_io(f'pack job {job_id}')
+        return new_balance
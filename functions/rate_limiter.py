@@ -0,0 +1,157 @@
+"""Project-wide request budget for Gemini, shared across function instances."""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+import async_runtime
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitTimeout(Exception):
+    """The shared budget stayed exhausted for longer than the caller was willing to wait."""
+
+
+class InMemoryBudgetStore:
+    """Budget store for a single process; stands in for FirestoreBudgetStore in tests and local runs."""
+
+    def __init__(self):
+        self._used: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def lease(self, bucket: str, window: int, requested: int, limit: int) -> int:
+        """Take up to requested units from the window's budget. Returns how many were granted."""
+        key = f"{bucket}_{window}"
+        with self._lock:
+            used = self._used.get(key, 0)
+            granted = max(0, min(requested, limit - used))
+            self._used[key] = used + granted
+            return granted
+
+
+class FirestoreBudgetStore:
+    """Budget kept in rate_limits/{bucket}_{window}, one document per window, claimed transactionally."""
+
+    COLLECTION = 'rate_limits'
+
+    def lease(self, bucket: str, window: int, requested: int, limit: int) -> int:
+        """Take up to requested units from the window's budget. Returns how many were granted."""
+        # Imported here so the limiter module stays cheap to load
+        from firebase_admin import firestore
+        from firestore_service import get_firestore_service
+
+        db = get_firestore_service().db
+        doc_ref = db.collection(self.COLLECTION).document(f"{bucket}_{window}")
+
+        @firestore.transactional
+        def take(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            used = snapshot.get('used') if snapshot.exists else 0
+            granted = max(0, min(requested, limit - used))
+            if granted:
+                transaction.set(doc_ref, {
+                    'used': used + granted,
+                    'limit': limit,
+                    'expiresAt': datetime.now(timezone.utc) + timedelta(hours=1),
+                })
+            return granted
+
+        return take(db.transaction())
+
+
+class RateLimiter:
+    """
+    Token bucket refilled from a shared per-minute budget. Each instance leases
+    tokens from the store in chunks and hands them out locally, so most calls
+    never touch the store. When the budget for the current minute is used up,
+    callers queue until the next minute instead of failing, up to max_wait seconds.
+    Use it from a single event loop.
+    """
+
+    WINDOW_SECONDS = 60
+
+    def __init__(self, bucket: str, limit_per_minute: int, store, chunk_size: int = 10, max_wait: float = 10.0):
+        self.bucket = bucket
+        self.limit_per_minute = limit_per_minute
+        self.store = store
+        self.chunk_size = chunk_size
+        self.max_wait = max_wait
+        self._tokens = 0
+        self._window = None
+        self._refill_lock: Optional[asyncio.Lock] = None
+        self._waits = collections.deque(maxlen=500)
+        self._acquired = 0
+        self._timeouts = 0
+
+    def _current_window(self) -> int:
+        return int(time.time() // self.WINDOW_SECONDS)
+
+    async def acquire(self) -> float:
+        """Wait for one request's worth of budget. Returns the time spent waiting, in seconds."""
+        start = time.monotonic()
+        while not self._take():
+            if self._refill_lock is None:
+                self._refill_lock = asyncio.Lock()
+            async with self._refill_lock:
+                if self._take():
+                    break
+                if await self._refill():
+                    continue
+
+            # Budget for this minute is gone; wait for the next window
+            waited = time.monotonic() - start
+            until_next_window = self.WINDOW_SECONDS - time.time() % self.WINDOW_SECONDS
+            if waited + until_next_window > self.max_wait:
+                self._timeouts += 1
+                raise RateLimitTimeout(f"Gemini request budget for {self.bucket} exhausted")
+            await asyncio.sleep(until_next_window)
+
+        waited = time.monotonic() - start
+        self._acquired += 1
+        self._waits.append(waited)
+        if waited > 0.01:
+            logger.info(f"Rate limiter {self.bucket} queued request for {waited * 1000:.0f}ms")
+        return waited
+
+    def _take(self) -> bool:
+        if self._window != self._current_window() or self._tokens <= 0:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def _refill(self) -> bool:
+        """Lease a chunk for the current window from the shared store. False if none is left."""
+        window = self._current_window()
+        try:
+            granted = await async_runtime.run_blocking(
+                self.store.lease, self.bucket, window, self.chunk_size, self.limit_per_minute
+            )
+        except Exception as e:
+            # Fail open: a store outage shouldn't stop generation outright
+            logger.error(f"Failed to lease rate limit budget for {self.bucket}: {str(e)}")
+            granted = self.chunk_size
+
+        if window != self._window:
+            self._tokens = 0
+        self._window = window
+        self._tokens += granted
+        return granted > 0
+
+    def metrics(self) -> Dict[str, float]:
+        """Queue wait percentiles (ms) over recent acquisitions, plus counters."""
+        waits = sorted(self._waits)
+        def percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1)
+        return {
+            'acquired': self._acquired,
+            'timeouts': self._timeouts,
+            'waitP50Ms': percentile(0.5),
+            'waitP95Ms': percentile(0.95),
+            'waitMaxMs': percentile(1.0),
+        }
@@ -0,0 +1,53 @@
+"""Keeps each user's role mirrored in their Firebase Auth custom claims."""
+from firebase_admin import auth, firestore
+import logging
+
+logger = logging.getLogger(__name__)
+
+# premium_list only moves users between these roles; admins are never changed
+LISTED_ROLE = 'premium'
+UNLISTED_ROLE = 'normal'
+
+
+def sync_role_claim(uid: str, role: str) -> None:
+    """Set the 'role' claim, keeping any other claims the user has."""
+    try:
+        claims = auth.get_user(uid).custom_claims or {}
+    except auth.UserNotFoundError:
+        logger.warning(f"Cannot set role claim, no auth user {uid}")
+        return
+
+    if claims.get('role') == role:
+        return
+    auth.set_custom_user_claims(uid, {**claims, 'role': role})
+    logger.info(f"Role claim for user {uid} set to {role}")
+
+
+def update_premium_listing(db, email: str, listed: bool) -> None:
+    """
+    Add email to or remove it from premium_list, and move an existing user onto or
+    off the premium role to match, updating their claim. Users who haven't signed up
+    yet get their role from premium_list in handle_first_time_user.
+    """
+    entries = list(db.collection('premium_list').where('email', '==', email).stream())
+    if listed and not entries:
+        db.collection('premium_list').add({'email': email, 'addedAt': firestore.SERVER_TIMESTAMP})
+    elif not listed:
+        for entry in entries:
+            entry.reference.delete()
+
+    try:
+        uid = auth.get_user_by_email(email).uid
+    except auth.UserNotFoundError:
+        return
+
+    user_ref = db.collection('users').document(uid)
+    user = user_ref.get()
+    if not user.exists:
+        return
+
+    current, target = user.to_dict().get('role', UNLISTED_ROLE), LISTED_ROLE if listed else UNLISTED_ROLE
+    if current in (LISTED_ROLE, UNLISTED_ROLE) and current != target:
+        user_ref.update({'role': target})
+        sync_role_claim(uid, target)
+        logger.info(f"User {uid} ({email}) moved from {current} to {target} by premium_list")
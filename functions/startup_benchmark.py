@@ -0,0 +1,81 @@
+"""Cold-start benchmark: import time of main.py and first-call latency per entry point.
+
+Each run starts a fresh interpreter, imports main, then times the lazy
+dependency loaders the entry point calls on its first request.
+
+    python startup_benchmark.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Lazy loaders in main.py that each entry point calls on its first request
+ENTRY_POINTS = {
+    'generate_image': ['_firestore_service', '_gemini_client'],
+    'generate_prompt_suggestions': ['_gemini_client'],
+    'generate_pack_images': ['_firestore_service', '_gemini_client'],
+    'handle_first_time_user': ['_firestore_service'],
+    'superwall_webhook': ['_firestore_service'],
+    'set_premium_listing': ['_firestore_service'],
+}
+
+CHILD_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+error = None
+try:
+    for loader in sys.argv[1:]:
+        getattr(main, loader)()
+except Exception as e:
+    error = str(e)
+first_call = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_call_ms': (first_call - imported) * 1000,
+    'error': error,
+}))
+"""
+
+
+def _run_once(loaders):
+    env = dict(os.environ)
+    # Building clients doesn't hit the network, but needs a key and project to exist
+    env.setdefault('GOOGLE_AI_API_KEY', 'benchmark')
+    env.setdefault('GOOGLE_CLOUD_PROJECT', 'demo-benchmark')
+    env.setdefault('FIRESTORE_EMULATOR_HOST', 'localhost:8080')
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT, *loaders],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--entry-point', choices=sorted(ENTRY_POINTS))
+    args = parser.parse_args()
+
+    names = [args.entry_point] if args.entry_point else list(ENTRY_POINTS)
+    print(f"{'entry point':<30}{'import ms':>12}{'first call ms':>16}")
+    for name in names:
+        samples = [_run_once(ENTRY_POINTS[name]) for _ in range(args.runs)]
+        import_ms = statistics.median(s['import_ms'] for s in samples)
+        first_call_ms = statistics.median(s['first_call_ms'] for s in samples)
+        print(f"{name:<30}{import_ms:>12.1f}{first_call_ms:>16.1f}")
+        errors = {s['error'] for s in samples if s['error']}
+        for error in errors:
+            print(f"  first call failed: {error}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Image inputs given as Cloud Storage references instead of base64 payloads."""
+from firebase_functions import https_fn
+from google.api_core import exceptions as google_exceptions
+from typing import TYPE_CHECKING, Any, Union
+import logging
+import os
+
+from image_processing import sniff_mime_type
+
+if TYPE_CHECKING:
+    # Only for the annotation: generate_prompt_suggestions imports this module and shouldn't load Firestore
+    from firestore_service import FirestoreService
+
+logger = logging.getLogger(__name__)
+
+MAX_INPUT_IMAGE_BYTES = int(os.environ.get('MAX_INPUT_IMAGE_BYTES', 20 * 1024 * 1024))
+
+# Storage folders clients may reference, each followed by the owner's uid
+UPLOAD_PREFIXES = ['uploads', 'user_images']
+
+
+def is_storage_reference(value: Any) -> bool:
+    return isinstance(value, dict) or (isinstance(value, str) and value.startswith('gs://'))
+
+
+def resolve_image_input(firestore_service: 'FirestoreService', uid: str, value: Any) -> Union[str, bytes, None]:
+    """
+    Return the image bytes for a Storage reference ('gs://bucket/path' or {'bucket', 'path'}),
+    or value unchanged for base64 strings. Referenced objects must be in the default bucket,
+    under one of UPLOAD_PREFIXES for this uid, at most MAX_INPUT_IMAGE_BYTES, and an image.
+    """
+    if not value or not is_storage_reference(value):
+        return value
+
+    if isinstance(value, dict):
+        bucket_name, path = value.get('bucket'), value.get('path')
+    else:
+        bucket_name, _, path = value[len('gs://'):].partition('/')
+
+    bucket = firestore_service.bucket
+    if not path or (bucket_name and bucket_name != bucket.name):
+        raise https_fn.HttpsError('invalid-argument', 'Invalid image reference')
+
+    if '..' in path.split('/') or not any(path.startswith(f"{prefix}/{uid}/") for prefix in UPLOAD_PREFIXES):
+        logger.warning(f"User {uid} referenced an image outside their folders: {path}")
+        raise https_fn.HttpsError('permission-denied', 'Image reference is not owned by the caller')
+
+    try:
+        # One byte past the limit tells us the object is too large without downloading all of it
+        data = bucket.blob(path).download_as_bytes(start=0, end=MAX_INPUT_IMAGE_BYTES)
+    except google_exceptions.NotFound:
+        raise https_fn.HttpsError('not-found', 'Referenced image not found')
+
+    if len(data) > MAX_INPUT_IMAGE_BYTES:
+        raise https_fn.HttpsError('invalid-argument', f'Image exceeds {MAX_INPUT_IMAGE_BYTES} bytes')
+    if not sniff_mime_type(data, default='').startswith('image/'):
+        raise https_fn.HttpsError('invalid-argument', 'Referenced object is not an image')
+    return data
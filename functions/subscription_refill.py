@@ -0,0 +1,147 @@
+"""Weekly token refill for every active subscriber, run from a schedule."""
+from firebase_admin import firestore
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+from datetime import datetime, timezone
+from typing import List
+import logging
+import threading
+
+from deadline import Deadline
+from firestore_service import FirestoreService, REFILL_INTERVAL, SUBSCRIPTION_WEEKLY_TOKENS, is_refill_due
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 500
+MAX_WRITES_PER_SECOND = 500
+
+
+class SubscriptionRefill:
+    """
+    Finds the active subscribers whose last grant is over a week old with an indexed
+    query on lastTokenAdd (composite index in firestore.indexes.json), plus one for
+    subscribers whose lastTokenAdd is null, so a run only reads users that are due.
+    Each refill is conditional on the user document not having changed since it was
+    read, so a concurrent renewal or an overlapping run can't grant twice. A refill
+    moves lastTokenAdd past the cutoff, so a run that stops at its deadline leaves
+    the rest for the next one without a saved cursor.
+
+    Documents with no lastTokenAdd field at all match neither query, so until a full
+    pass over every active subscriber has finished (job_checkpoints/subscription_refill
+    has backfillDone), runs page through them by document id instead, saving the cursor
+    after every page. That pass writes lastTokenAdd on every subscriber it refills.
+    """
+
+    CHECKPOINT = ('job_checkpoints', 'subscription_refill')
+
+    def __init__(self, firestore_service: FirestoreService):
+        self.db = firestore_service.db
+        self.checkpoint_ref = self.db.collection(self.CHECKPOINT[0]).document(self.CHECKPOINT[1])
+
+    def run(self, deadline: Deadline) -> int:
+        """Refill every due subscriber, or as many as the deadline allows. Returns users refilled."""
+        checkpoint = self.checkpoint_ref.get()
+        checkpoint = checkpoint.to_dict() if checkpoint.exists else {}
+        if not checkpoint.get('backfillDone'):
+            return self._backfill(checkpoint.get('cursor'), deadline)
+
+        active = self.db.collection('users').where('subscriptionStatus', '==', 'active')
+        cutoff = datetime.now(timezone.utc) - REFILL_INTERVAL
+        refilled = self._refill_query(
+            active.where('lastTokenAdd', '<', cutoff).order_by('lastTokenAdd'), deadline
+        )
+        refilled += self._refill_query(
+            active.where('lastTokenAdd', '==', None).order_by('__name__'), deadline
+        )
+
+        logger.info(f"Subscription refill granted tokens to {refilled} users")
+        return refilled
+
+    def _refill_query(self, query, deadline: Deadline) -> int:
+        """Refill every user the query returns, a page at a time. Returns users refilled."""
+        refilled = 0
+        last = None
+        while not deadline.expired:
+            page_query = query.select(['lastTokenAdd']).limit(PAGE_SIZE)
+            if last is not None:
+                # Skipped users (changed since read) still match, so continue after the page rather than re-querying
+                page_query = page_query.start_after(last)
+            page = list(page_query.stream())
+            refilled += self._refill(page)
+            if len(page) < PAGE_SIZE:
+                break
+            last = page[-1]
+        return refilled
+
+    def _backfill(self, cursor, deadline: Deadline) -> int:
+        """Page through every active subscriber by document id, refilling those that are due. Returns users refilled."""
+        refilled = 0
+
+        while not deadline.expired:
+            query = (
+                self.db.collection('users')
+                .where('subscriptionStatus', '==', 'active')
+                .order_by('__name__')
+                .select(['lastTokenAdd'])
+                .limit(PAGE_SIZE)
+            )
+            if cursor:
+                query = query.start_after({'__name__': cursor})
+            page = list(query.stream())
+
+            due = [doc for doc in page if is_refill_due(doc.to_dict().get('lastTokenAdd'))]
+            refilled += self._refill(due)
+
+            # End of the subscriber list: from now on the indexed queries find everyone due
+            cursor = page[-1].id if len(page) == PAGE_SIZE else None
+            self.checkpoint_ref.set({
+                'cursor': cursor,
+                'backfillDone': cursor is None,
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            })
+            if cursor is None:
+                break
+
+        logger.info(f"Subscription refill backfill granted tokens to {refilled} users, resume cursor: {cursor}")
+        return refilled
+
+    def _refill(self, docs: List) -> int:
+        """Grant the weekly tokens to docs with BulkWriter, then record a ledger entry for each grant that landed."""
+        if not docs:
+            return 0
+
+        now = datetime.utcnow()
+        granted = []
+        lock = threading.Lock()
+
+        def on_result(reference, result, bulk_writer):
+            if reference.parent.id == 'users':
+                with lock:
+                    granted.append(reference)
+
+        def on_error(error, bulk_writer) -> bool:
+            # Changed since read (e.g. refilled or renewed meanwhile): skip it rather than retry
+            if error.code == google_exceptions.FailedPrecondition.grpc_status_code.value[0]:
+                return False
+            return error.attempts < 5
+
+        bulk_writer = self.db.bulk_writer(options=BulkWriterOptions(max_ops_per_second=MAX_WRITES_PER_SECOND))
+        bulk_writer.on_write_result(on_result)
+        bulk_writer.on_write_error(on_error)
+        for doc in docs:
+            bulk_writer.update(doc.reference, {
+                'balance': firestore.Increment(SUBSCRIPTION_WEEKLY_TOKENS),
+                'lastTokenAdd': now,
+                'lastUpdated': now
+            }, option=self.db.write_option(last_update_time=doc.update_time))
+        bulk_writer.flush()
+
+        for user_ref in granted:
+            bulk_writer.set(user_ref.collection('transactions').document(), {
+                'event': 'subscription_refill',
+                'amount': SUBSCRIPTION_WEEKLY_TOKENS,
+                'description': 'Weekly subscription token refill',
+                'timestamp': now
+            })
+        bulk_writer.close()
+        return len(granted)
@@ -0,0 +1,124 @@
+"""Two-tier cache for prompt suggestions with in-flight request coalescing."""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+Suggestions = List[Dict[str, str]]
+
+
+def cache_key(image_bytes: bytes, version: str) -> str:
+    """Key suggestions by image content and the prompt/schema/model version."""
+    return f"{version}_{hashlib.sha256(image_bytes).hexdigest()}"
+
+
+def cache_version(*parts: Any) -> str:
+    """Short stable hash of everything that shapes the suggestions besides the image."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]
+
+
+class SuggestionsCache:
+    """
+    In-memory LRU in front of a Firestore tier (suggestion_cache/{key}).
+    Entries expire after ttl_seconds; the Firestore documents carry expiresAt
+    so a TTL policy on that field can delete them. Concurrent misses for the
+    same key share a single compute call.
+    """
+
+    COLLECTION = 'suggestion_cache'
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()
+        self._in_flight: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: str, compute: Callable[[], Optional[Suggestions]]) -> Optional[Suggestions]:
+        """
+        Return cached suggestions or call compute() once for all concurrent callers.
+        None results (failures) are returned but not cached.
+        """
+        with self._lock:
+            suggestions = self._get_memory(key)
+            if suggestions is not None:
+                return suggestions
+
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            suggestions = self._get_firestore(key)
+            if suggestions is None:
+                suggestions = compute()
+                if suggestions is not None:
+                    self._put_firestore(key, suggestions)
+            if suggestions is not None:
+                with self._lock:
+                    self._put_memory(key, suggestions)
+            future.set_result(suggestions)
+            return suggestions
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _get_memory(self, key: str) -> Optional[Suggestions]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, suggestions = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return suggestions
+
+    def _put_memory(self, key: str, suggestions: Suggestions) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, suggestions)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _collection(self):
+        # Imported here so the suggestions endpoint only loads Firestore on a memory miss
+        from firestore_service import get_firestore_service
+        return get_firestore_service().db.collection(self.COLLECTION)
+
+    def _get_firestore(self, key: str) -> Optional[Suggestions]:
+        try:
+            doc = self._collection().document(key).get()
+            if not doc.exists:
+                return None
+            data = doc.to_dict()
+            if data['expiresAt'] < datetime.now(timezone.utc):
+                return None
+            return data['suggestions']
+        except Exception as e:
+            logger.warning(f"Failed to read suggestion cache {key}: {str(e)}")
+            return None
+
+    def _put_firestore(self, key: str, suggestions: Suggestions) -> None:
+        try:
+            self._collection().document(key).set({
+                'suggestions': suggestions,
+                'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds),
+            })
+        except Exception as e:
+            logger.warning(f"Failed to write suggestion cache {key}: {str(e)}")
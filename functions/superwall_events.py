@@ -0,0 +1,175 @@
+"""Superwall webhook events: stored on receipt, applied exactly once per event in per-user order."""
+from firebase_admin import firestore
+from google.api_core import exceptions as google_exceptions
+from datetime import datetime, timezone
+from typing import Dict, Any, Tuple
+import hashlib
+import json
+import logging
+
+from firestore_service import FirestoreService
+
+logger = logging.getLogger(__name__)
+
+# Map product IDs to token amounts (update these with your actual product IDs)
+TOKEN_PACK_AMOUNTS = {
+    'reeys.tokens.200': 200,
+    'reeys.tokens.500': 500,
+    'reeys.tokens.2000': 2000,
+    # Add your actual token pack product IDs here
+}
+
+SUBSCRIPTION_STATUS_EVENTS = {
+    'subscription_start': 'active',
+    'initial_purchase': 'active',
+    'trial_start': 'active',
+    'renewal': 'active',
+    'cancellation': 'canceled',
+    'subscription_cancel': 'canceled',
+    'expiration': 'expired',
+    'subscription_expire': 'expired',
+}
+
+
+def parse_event(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Pull the fields needed for processing out of a raw webhook payload. Raises ValueError if it has no user."""
+    event_data = payload.get('data') or {}
+
+    # Extract user ID from originalAppUserId and remove Superwall alias prefix
+    user_id = (event_data.get('originalAppUserId') or '').replace('$SuperwallAlias:', '', 1)
+    if not user_id:
+        raise ValueError('No user ID')
+
+    # Redeliveries carry the same id; payloads without one are keyed by their content
+    event_id = payload.get('id') or event_data.get('id')
+    if not event_id:
+        event_id = hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # Superwall timestamps are epoch milliseconds
+    timestamp = payload.get('timestamp') or event_data.get('ts')
+    event_at = datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc) if timestamp else datetime.now(timezone.utc)
+
+    return {
+        'eventId': str(event_id),
+        'type': payload.get('type'),
+        'userId': user_id,
+        'productId': event_data.get('productId', ''),
+        'eventAt': event_at,
+    }
+
+
+class SuperwallEvents:
+    """
+    Event layout: superwall_events/{eventId} holds the raw payload plus status
+    ('pending', then 'applied', 'stale' or 'ignored'). An event's effects and its status
+    change are written in one transaction, so redelivered or re-processed events
+    never apply twice. Subscription changes older than the last one applied to the
+    user (users/{uid}.subscriptionEventAt) are marked stale instead of applied.
+    """
+
+    COLLECTION = 'superwall_events'
+
+    def __init__(self, firestore_service: FirestoreService):
+        self.firestore_service = firestore_service
+        self.db = firestore_service.db
+
+    def record(self, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """Store a received event. Returns (event, pending): pending is False for redeliveries already applied."""
+        event = parse_event(payload)
+        doc_ref = self.db.collection(self.COLLECTION).document(event['eventId'])
+        try:
+            doc_ref.create({
+                **event,
+                'payload': payload,
+                'status': 'pending',
+                'receivedAt': firestore.SERVER_TIMESTAMP,
+            })
+            return event, True
+        except google_exceptions.AlreadyExists:
+            stored = doc_ref.get()
+            logger.info(f"Duplicate Superwall event {event['eventId']} ({stored.get('status')})")
+            return event, stored.get('status') == 'pending'
+
+    def process_user(self, uid: str) -> int:
+        """Apply the user's pending events oldest first. Returns how many were applied."""
+        docs = (
+            self.db.collection(self.COLLECTION)
+            .where('userId', '==', uid)
+            .where('status', '==', 'pending')
+            .stream()
+        )
+        applied = 0
+        for doc in sorted(docs, key=lambda doc: doc.get('eventAt')):
+            # An exception ends the loop and fails the task, so later events wait for the retry instead of overtaking it
+            if self._apply(doc.reference):
+                applied += 1
+        return applied
+
+    def _apply(self, event_ref) -> bool:
+        @firestore.transactional
+        def apply(transaction):
+            snapshot = event_ref.get(transaction=transaction)
+            if not snapshot.exists or snapshot.get('status') != 'pending':
+                return False
+            event = snapshot.to_dict()
+            user_ref = self.db.collection('users').document(event['userId'])
+            user_snapshot = user_ref.get(transaction=transaction)
+            last_event_at = (user_snapshot.to_dict() or {}).get('subscriptionEventAt')
+
+            subscription_change = event['type'] in SUBSCRIPTION_STATUS_EVENTS or (
+                event['type'] == 'refund' and event['productId'] not in TOKEN_PACK_AMOUNTS
+            )
+            if subscription_change and last_event_at is not None and event['eventAt'] < last_event_at:
+                status = 'stale'
+            else:
+                status = self._apply_event(event, transaction)
+                if status == 'applied' and subscription_change:
+                    transaction.update(user_ref, {'subscriptionEventAt': event['eventAt']})
+
+            transaction.update(event_ref, {'status': status, 'processedAt': firestore.SERVER_TIMESTAMP})
+            logger.info(f"Superwall event {event_ref.id} ({event['type']}) for user {event['userId']}: {status}")
+            return status == 'applied'
+
+        return apply(self.db.transaction())
+
+    def _apply_event(self, event: Dict[str, Any], transaction) -> str:
+        """Stage the event's effects on transaction. Returns the event's new status."""
+        event_type = event['type']
+        user_id = event['userId']
+        product_id = event['productId']
+
+        if event_type in SUBSCRIPTION_STATUS_EVENTS:
+            status = SUBSCRIPTION_STATUS_EVENTS[event_type]
+            # New subscriptions, trials and renewals grant tokens
+            self.firestore_service.update_subscription_status(
+                uid=user_id,
+                status=status,
+                product_id=product_id if status == 'active' else None,
+                grant_tokens=status == 'active',
+                batch=transaction
+            )
+            return 'applied'
+
+        if event_type in ['non_consumable_purchase', 'consumable_purchase']:
+            token_amount = TOKEN_PACK_AMOUNTS.get(product_id, 0)
+            if token_amount <= 0:
+                logger.warning(f"Unknown product ID for token pack: {product_id}")
+                return 'ignored'
+            self.firestore_service.add_tokens(uid=user_id, amount=token_amount, source='token_pack', batch=transaction)
+            return 'applied'
+
+        if event_type == 'refund':
+            if product_id in TOKEN_PACK_AMOUNTS:
+                # Token pack refunds are logged only; tokens are not clawed back
+                logger.info(f"Token pack refunded: {product_id}")
+                return 'ignored'
+            self.firestore_service.update_subscription_status(
+                uid=user_id,
+                status='refunded',
+                grant_tokens=False,
+                batch=transaction
+            )
+            return 'applied'
+
+        logger.warning(f"Unknown event type: {event_type}")
+        return 'ignored'
@@ -0,0 +1,30 @@
+"""Make the functions source importable the way main.py imports it (flat modules)."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """A FakeFirestore returned by firestore.client(), with firestore.transactional running against it."""
+    firestore = pytest.importorskip('firebase_admin.firestore', reason='needs the packages in requirements.txt')
+    pytest.importorskip('firebase_functions', reason='needs the packages in requirements.txt')
+    from fake_firestore import FakeFirestore, transactional
+
+    db = FakeFirestore()
+    monkeypatch.setattr(firestore, 'client', lambda: db)
+    monkeypatch.setattr(firestore, 'transactional', transactional)
+    return db
+
+
+@pytest.fixture
+def firestore_service(fake_db):
+    from fake_firestore import FakeBucket
+    from firestore_service import FirestoreService
+
+    service = FirestoreService()
+    service._bucket = FakeBucket()
+    return service
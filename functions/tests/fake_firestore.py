@@ -0,0 +1,534 @@
+"""In-memory stand-in for the parts of the Firestore client the functions use.
+
+It follows the server's rules where the money paths depend on them: transactions
+commit all-or-nothing and may not read after writing, create() fails on an existing
+document, update() on a missing one, writes with a last_update_time precondition fail
+once the document has changed, range filters and orders skip documents missing the
+field (or holding null), and naive datetimes come back as UTC-aware ones.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from functools import cmp_to_key
+from typing import Any, Dict, List, Optional
+import copy
+import uuid
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1._helpers import ReadAfterWriteError
+
+AggregationResult = namedtuple('AggregationResult', ['alias', 'value', 'read_time'])
+WriteResult = namedtuple('WriteResult', ['update_time'])
+
+_MISSING = object()
+_RANGE_OPERATORS = {'<', '<=', '>', '>='}
+
+
+def _normalize(value: Any) -> Any:
+    """Store values the way the server returns them: datetimes in UTC."""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def _get_path(data: Dict[str, Any], field_path: str) -> Any:
+    for part in field_path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+def _comparable(a: Any, b: Any) -> bool:
+    """Firestore only orders values of the same type against each other."""
+    numbers = (int, float)
+    if isinstance(a, numbers) and isinstance(b, numbers):
+        return not isinstance(a, bool) and not isinstance(b, bool)
+    return type(a) is type(b) or (isinstance(a, datetime) and isinstance(b, datetime))
+
+
+def _compare(a: Any, b: Any) -> int:
+    return (a > b) - (a < b)
+
+
+def _matches(value: Any, op: str, expected: Any) -> bool:
+    if value is _MISSING:
+        return False
+    if op == '==':
+        return value is None if expected is None else value is not None and _comparable(value, expected) and value == expected
+    if op == 'in':
+        return any(_matches(value, '==', option) for option in expected)
+    if op == 'array_contains':
+        return isinstance(value, list) and expected in value
+    if value is None or not _comparable(value, expected):
+        return False
+    return {'<': value < expected, '<=': value <= expected, '>': value > expected, '>=': value >= expected}[op]
+
+
+class FakeWriteOption:
+    def __init__(self, last_update_time: datetime):
+        self.last_update_time = last_update_time
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: 'FakeDocumentReference', data: Optional[Dict[str, Any]],
+                 create_time: Optional[datetime] = None, update_time: Optional[datetime] = None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str) -> Any:
+        value = _get_path(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(f"'{field_path}' is not contained in the data")
+        return copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, db: 'FakeFirestore', path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    def __repr__(self) -> str:
+        return f'FakeDocumentReference({self.path!r})'
+
+    @property
+    def parent(self) -> 'FakeCollectionReference':
+        return FakeCollectionReference(self._db, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name: str) -> 'FakeCollectionReference':
+        return FakeCollectionReference(self._db, f'{self.path}/{name}')
+
+    def get(self, transaction: Optional['FakeTransaction'] = None) -> FakeDocumentSnapshot:
+        if transaction is not None:
+            transaction._check_read()
+        return self._db._snapshot(self)
+
+    def set(self, data: Dict[str, Any], merge: bool = False) -> WriteResult:
+        return self._db._commit([('set', self, data, merge, None)])
+
+    def create(self, data: Dict[str, Any]) -> WriteResult:
+        return self._db._commit([('create', self, data, False, None)])
+
+    def update(self, data: Dict[str, Any], option: Optional[FakeWriteOption] = None) -> WriteResult:
+        return self._db._commit([('update', self, data, False, option)])
+
+    def delete(self, option: Optional[FakeWriteOption] = None) -> WriteResult:
+        return self._db._commit([('delete', self, None, False, option)])
+
+
+class FakeQuery:
+    def __init__(self, db: 'FakeFirestore', path: str, filters=(), orders=(), projection=None, limit=None, cursor=None):
+        self._db = db
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._projection = projection
+        self._limit = limit
+        self._cursor = cursor
+
+    def _copy(self, **changes) -> 'FakeQuery':
+        fields = dict(filters=self._filters, orders=self._orders, projection=self._projection,
+                      limit=self._limit, cursor=self._cursor)
+        fields.update(changes)
+        return FakeQuery(self._db, self._path, **fields)
+
+    def where(self, field_path: str, op_string: str, value: Any) -> 'FakeQuery':
+        return self._copy(filters=self._filters + ((field_path, op_string, _normalize(value)),))
+
+    def order_by(self, field_path: str, direction: str = 'ASCENDING') -> 'FakeQuery':
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def select(self, field_paths: List[str]) -> 'FakeQuery':
+        return self._copy(projection=list(field_paths))
+
+    def limit(self, count: int) -> 'FakeQuery':
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot) -> 'FakeQuery':
+        # Same inputs as the SDK accepts: a snapshot from this collection, a dict or a list of values
+        cursor = document_fields_or_snapshot
+        if isinstance(cursor, FakeDocumentSnapshot):
+            if cursor.reference.path.rsplit('/', 1)[0] != self._path:
+                raise ValueError('Cannot use snapshot from another collection as a cursor.')
+        elif not isinstance(cursor, (dict, list, tuple)):
+            raise TypeError(f'Unsupported cursor {cursor!r}')
+        return self._copy(cursor=cursor)
+
+    def _normalized_orders(self) -> List[tuple]:
+        orders = list(self._orders)
+        if isinstance(self._cursor, FakeDocumentSnapshot):
+            direction = orders[-1][1] if orders else 'ASCENDING'
+            ordered = [field for field, _ in orders]
+            for field, op, _ in self._filters:
+                if op in _RANGE_OPERATORS and field not in ordered:
+                    orders.append((field, direction))
+            if '__name__' not in [field for field, _ in orders]:
+                orders.append(('__name__', direction))
+        return orders
+
+    def _cursor_values(self, orders: List[tuple]) -> List[Any]:
+        if not orders:
+            raise ValueError('Attempting to create a cursor with no fields to order on.')
+        cursor = self._cursor
+        if isinstance(cursor, FakeDocumentSnapshot):
+            data = dict(cursor._data or {}, __name__=cursor.id)
+            values = [data[field] if field in data else _get_path(data, field) for field, _ in orders]
+            if _MISSING in values:
+                raise ValueError('Cursor snapshot is missing an ordered field')
+        elif isinstance(cursor, dict):
+            values = []
+            for field, _ in orders[:len(cursor)]:
+                value = cursor[field] if field in cursor else _get_path(cursor, field)
+                if value is _MISSING:
+                    raise ValueError(f'The cursor does not contain the order by field {field}')
+                values.append(value)
+        else:
+            values = list(cursor)
+        return [value.id if isinstance(value, FakeDocumentReference) else _normalize(value) for value in values]
+
+    def _documents(self, transaction=None) -> List[FakeDocumentSnapshot]:
+        if transaction is not None:
+            transaction._check_read()
+        snapshots = [
+            self._db._snapshot(FakeDocumentReference(self._db, path))
+            for path in list(self._db._docs)
+            if path.rsplit('/', 1)[0] == self._path
+        ]
+        snapshots = [
+            snapshot for snapshot in snapshots
+            if all(_matches(_get_path(snapshot._data, field), op, value) for field, op, value in self._filters)
+        ]
+
+        orders = self._normalized_orders()
+        if not orders:
+            # Without an explicit order the server sorts by a range filter's field, then by id
+            orders = [(field, 'ASCENDING') for field, op, _ in self._filters if op in _RANGE_OPERATORS][:1]
+        sort_orders = orders + [('__name__', orders[-1][1] if orders else 'ASCENDING')]
+
+        def key(snapshot, field):
+            return snapshot.id if field == '__name__' else _get_path(snapshot._data, field)
+
+        # Ordering by a field leaves out documents that don't have it
+        snapshots = [s for s in snapshots if all(key(s, field) is not _MISSING for field, _ in orders)]
+
+        def compare_values(values_a, values_b, order_list) -> int:
+            for (field, direction), a, b in zip(order_list, values_a, values_b):
+                result = _compare(a, b) if a is not None and b is not None else _compare(a is not None, b is not None)
+                if result:
+                    return -result if direction == 'DESCENDING' else result
+            return 0
+
+        snapshots.sort(key=cmp_to_key(lambda a, b: compare_values(
+            [key(a, field) for field, _ in sort_orders], [key(b, field) for field, _ in sort_orders], sort_orders
+        )))
+
+        if self._cursor is not None:
+            cursor = self._cursor_values(orders)
+            cursor_orders = orders[:len(cursor)]
+            snapshots = [
+                s for s in snapshots
+                if compare_values([key(s, field) for field, _ in cursor_orders], cursor, cursor_orders) > 0
+            ]
+
+        if self._limit is not None:
+            snapshots = snapshots[:self._limit]
+        if self._projection is not None:
+            for snapshot in snapshots:
+                projected = {}
+                for field in self._projection:
+                    value = _get_path(snapshot._data, field)
+                    if value is not _MISSING:
+                        projected[field] = value
+                snapshot._data = projected
+        return snapshots
+
+    def stream(self, transaction: Optional['FakeTransaction'] = None):
+        return iter(self._documents(transaction))
+
+    def get(self, transaction: Optional['FakeTransaction'] = None) -> List[FakeDocumentSnapshot]:
+        return self._documents(transaction)
+
+    def sum(self, field_ref: str, alias: Optional[str] = None) -> 'FakeAggregationQuery':
+        return FakeAggregationQuery(self, field_ref, alias)
+
+
+class FakeAggregationQuery:
+    def __init__(self, query: FakeQuery, field_path: str, alias: Optional[str]):
+        self._query = query
+        self._field_path = field_path
+        self._alias = alias
+
+    def get(self, transaction: Optional['FakeTransaction'] = None) -> List[List[AggregationResult]]:
+        total = 0
+        for snapshot in self._query._documents(transaction):
+            value = _get_path(snapshot._data, self._field_path)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total += value
+        return [[AggregationResult(self._alias, total, datetime.now(timezone.utc))]]
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db: 'FakeFirestore', path: str):
+        super().__init__(db, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._db, f'{self._path}/{document_id or uuid.uuid4().hex[:20]}')
+
+
+class FakeWriteBatch:
+    """Writes staged with set/create/update/delete and applied together by commit()."""
+
+    def __init__(self, db: 'FakeFirestore'):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge, None))
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, False, None))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, False, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, False, option))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return self._db._commit(writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Reads go through document and query get/stream with transaction=; all of them must come first."""
+
+    def _check_read(self):
+        if self._writes:
+            raise ReadAfterWriteError('Attempted read after write in a transaction.')
+
+
+def transactional(func):
+    """Replacement for firestore.transactional: run once, then commit the staged writes (dropped if it raises)."""
+    def run(transaction: FakeTransaction, *args, **kwargs):
+        result = func(transaction, *args, **kwargs)
+        transaction.commit()
+        return result
+    return run
+
+
+class FakeBulkWriteFailure:
+    def __init__(self, reference, code: int, message: str, attempts: int):
+        self.reference = reference
+        self.code = code
+        self.message = message
+        self.attempts = attempts
+
+
+class FakeBulkWriter:
+    """Applies each write on its own at flush(), reporting results and failures through the callbacks."""
+
+    MAX_ATTEMPTS = 15
+
+    def __init__(self, db: 'FakeFirestore', options=None):
+        self._db = db
+        self._writes = []
+        self._closed = False
+        self._on_result = None
+        self._on_error = lambda error, bulk_writer: error.attempts < self.MAX_ATTEMPTS
+
+    def on_write_result(self, callback):
+        self._on_result = callback
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def _add(self, write):
+        if self._closed:
+            raise Exception('BulkWriter is closed')
+        self._writes.append(write)
+
+    def set(self, reference, document_data, merge=False):
+        self._add(('set', reference, document_data, merge, None))
+
+    def create(self, reference, document_data):
+        self._add(('create', reference, document_data, False, None))
+
+    def update(self, reference, field_updates, option=None):
+        self._add(('update', reference, field_updates, False, option))
+
+    def delete(self, reference, option=None):
+        self._add(('delete', reference, None, False, option))
+
+    def flush(self):
+        writes, self._writes = self._writes, []
+        for write in writes:
+            attempts = 0
+            while True:
+                attempts += 1
+                try:
+                    result = self._db._commit([write])
+                except google_exceptions.GoogleAPICallError as e:
+                    code = e.grpc_status_code.value[0]
+                    if self._on_error(FakeBulkWriteFailure(write[1], code, e.message, attempts), self):
+                        continue
+                    break
+                if self._on_result:
+                    self._on_result(write[1], result, self)
+                break
+
+    def close(self):
+        self.flush()
+        self._closed = True
+
+
+class FakeFirestore:
+    """The client: documents live in _docs keyed by path as (data, create_time, update_time)."""
+
+    def __init__(self):
+        self._docs: Dict[str, tuple] = {}
+        self._clock = datetime.now(timezone.utc)
+        self.commits = 0
+
+    def _tick(self) -> datetime:
+        # Strictly increasing, so every write gets its own update_time as on the server
+        self._clock = max(self._clock + timedelta(microseconds=1), datetime.now(timezone.utc))
+        return self._clock
+
+    def collection(self, path: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, path)
+
+    def document(self, path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, path)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def bulk_writer(self, options=None) -> FakeBulkWriter:
+        return FakeBulkWriter(self, options)
+
+    def write_option(self, last_update_time: datetime) -> FakeWriteOption:
+        return FakeWriteOption(last_update_time)
+
+    def _snapshot(self, reference: FakeDocumentReference) -> FakeDocumentSnapshot:
+        data, create_time, update_time = self._docs.get(reference.path, (None, None, None))
+        return FakeDocumentSnapshot(reference, copy.deepcopy(data), create_time, update_time)
+
+    def _commit(self, writes) -> WriteResult:
+        """Apply writes atomically: if any of them fails, none is applied."""
+        now = self._tick()
+        staged: Dict[str, Optional[Dict[str, Any]]] = {}
+        for kind, reference, data, merge, option in writes:
+            path = reference.path
+            current = staged[path] if path in staged else self._docs.get(path, (None,))[0]
+            if option is not None:
+                stored = self._docs.get(path)
+                if stored is None or stored[2] != option.last_update_time:
+                    raise google_exceptions.FailedPrecondition(f'{path} was modified since it was read')
+            if kind == 'create' and current is not None:
+                raise google_exceptions.AlreadyExists(f'Document already exists: {path}')
+            if kind == 'update' and current is None:
+                raise google_exceptions.NotFound(f'No document to update: {path}')
+
+            if kind == 'delete':
+                staged[path] = None
+            elif kind == 'update':
+                updated = copy.deepcopy(current)
+                for field_path, value in data.items():
+                    *parents, name = field_path.split('.')
+                    target = updated
+                    for parent in parents:
+                        target = target.setdefault(parent, {})
+                    _apply_value(target, name, value, now)
+                staged[path] = updated
+            else:
+                staged[path] = _merge(copy.deepcopy(current) if merge and current else {}, data, now)
+
+        for path, data in staged.items():
+            if data is None:
+                self._docs.pop(path, None)
+            else:
+                create_time = self._docs[path][1] if path in self._docs else now
+                self._docs[path] = (data, create_time, now)
+        self.commits += 1
+        return WriteResult(now)
+
+
+def _apply_value(target: Dict[str, Any], name: str, value: Any, now: datetime) -> None:
+    if value is transforms.DELETE_FIELD:
+        target.pop(name, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[name] = now
+    elif isinstance(value, transforms.Increment):
+        base = target.get(name)
+        target[name] = (base if isinstance(base, (int, float)) else 0) + value.value
+    else:
+        target[name] = _normalize(copy.deepcopy(value))
+
+
+def _merge(target: Dict[str, Any], data: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    """set() semantics: nested maps merge into existing maps, everything else replaces."""
+    for name, value in data.items():
+        if isinstance(value, dict) and value and isinstance(target.get(name), dict):
+            _merge(target[name], value, now)
+        elif isinstance(value, dict) and value:
+            target[name] = _merge({}, value, now)
+        else:
+            _apply_value(target, name, value, now)
+    return target
+
+
+class FakeBlob:
+    def __init__(self, bucket: 'FakeBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_string(self, data, content_type: Optional[str] = None, **kwargs) -> None:
+        self.bucket.objects[self.name] = data.encode('utf-8') if isinstance(data, str) else bytes(data)
+
+    def download_as_bytes(self) -> bytes:
+        if self.name not in self.bucket.objects:
+            raise google_exceptions.NotFound(f'No such object: {self.name}')
+        return self.bucket.objects[self.name]
+
+    def exists(self) -> bool:
+        return self.name in self.bucket.objects
+
+    def delete(self) -> None:
+        if self.bucket.objects.pop(self.name, None) is None:
+            raise google_exceptions.NotFound(f'No such object: {self.name}')
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
@@ -0,0 +1,110 @@
+import types
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker, 'time', types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def make_breaker():
+    return CircuitBreaker('model', failure_rate=0.5, slow_call_seconds=10.0, window=10, min_calls=4, open_seconds=30.0)
+
+
+def open_breaker(breaker):
+    for _ in range(4):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == 'open'
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == 'closed'
+
+
+def test_opens_at_failure_rate(clock):
+    breaker = make_breaker()
+    breaker.record(True, 1.0)
+    breaker.record(True, 1.0)
+    breaker.record(False)
+    assert breaker.state == 'closed'
+    breaker.record(False)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_slow_calls_count_as_bad(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(True, 11.0)
+    assert breaker.state == 'open'
+
+
+def test_half_open_lets_one_trial_through_and_closes_on_success(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+
+    clock.now += 30
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record(True, 1.0)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'open'
+
+
+def test_release_frees_the_trial_slot(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+
+
+def test_unreported_trial_is_given_up_after_open_seconds(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_outcomes_reported_while_open_are_ignored(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+
+    breaker.record(True, 1.0)
+    assert breaker.state == 'open'
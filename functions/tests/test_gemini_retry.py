@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+google_exceptions = pytest.importorskip('google.api_core.exceptions', reason='needs the packages in requirements.txt')
+
+from deadline import Deadline
+from gemini_retry import LatencyTracker, TransientResponseError, backoff_delay, hedged, with_retries
+
+
+class Calls:
+    """A call() that raises or returns the scripted outcomes in order, optionally after a delay."""
+
+    def __init__(self, *outcomes, delays=()):
+        self.outcomes = list(outcomes)
+        self.delays = list(delays)
+        self.count = 0
+        self.cancelled = 0
+
+    async def __call__(self):
+        index = self.count
+        self.count += 1
+        try:
+            await asyncio.sleep(self.delays[index] if index < len(self.delays) else 0)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        outcome = self.outcomes[index]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def retry(call, **kwargs):
+    return asyncio.run(with_retries(call, max_attempts=3, base_delay=0, max_delay=0, **kwargs))
+
+
+def test_backoff_delay_is_capped():
+    assert all(0 <= backoff_delay(attempt, 1.0, 4.0) <= 4.0 for attempt in range(10))
+
+
+def test_retries_retryable_errors():
+    call = Calls(google_exceptions.ServiceUnavailable('down'), TransientResponseError('text only'), 'image')
+
+    assert retry(call) == 'image'
+    assert call.count == 3
+
+
+def test_does_not_retry_client_errors():
+    call = Calls(google_exceptions.InvalidArgument('bad image'), 'image')
+
+    with pytest.raises(google_exceptions.InvalidArgument):
+        retry(call)
+    assert call.count == 1
+
+
+def test_raises_last_error_when_attempts_run_out():
+    call = Calls(*[google_exceptions.ResourceExhausted('quota')] * 3)
+
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        retry(call)
+    assert call.count == 3
+
+
+def test_stops_retrying_when_backoff_would_pass_the_deadline():
+    call = Calls(google_exceptions.ServiceUnavailable('down'), 'image')
+
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        asyncio.run(with_retries(call, max_attempts=3, base_delay=10, max_delay=10, deadline=Deadline(0.01)))
+    assert call.count == 1
+
+
+def test_records_latency_of_successful_calls():
+    latency = LatencyTracker(min_samples=2)
+    retry(Calls('a'), latency=latency)
+    assert latency.p95() is None
+    retry(Calls('b'), latency=latency)
+    assert latency.p95() is not None
+
+
+def test_hedge_returns_the_faster_copy_and_cancels_the_other():
+    call = Calls('slow', 'fast', delays=[1.0, 0])
+
+    assert asyncio.run(hedged(call, hedge_after=0.05)) == 'fast'
+    assert call.count == 2
+    assert call.cancelled == 1
+
+
+def test_hedge_survives_one_failed_copy():
+    call = Calls(google_exceptions.ServiceUnavailable('down'), 'image', delays=[0.1, 0.2])
+
+    assert asyncio.run(hedged(call, hedge_after=0.05)) == 'image'
+
+
+def test_hedge_raises_when_both_copies_fail():
+    call = Calls(google_exceptions.ServiceUnavailable('one'), google_exceptions.ServiceUnavailable('two'), delays=[0.1, 0.1])
+
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        asyncio.run(hedged(call, hedge_after=0.05))
+
+
+def test_no_hedge_without_a_delay():
+    call = Calls('image', delays=[0.1])
+
+    assert asyncio.run(hedged(call, hedge_after=None)) == 'image'
+    assert call.count == 1
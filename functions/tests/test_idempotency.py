@@ -0,0 +1,130 @@
+import base64
+import types
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('firebase_admin', reason='needs the packages in requirements.txt')
+pytest.importorskip('firebase_functions', reason='needs the packages in requirements.txt')
+
+from firebase_functions import https_fn
+
+import idempotency
+from deadline import Deadline
+from idempotency import IdempotentCall, request_hash
+
+PARAMS = {'idempotencyKey': 'key-1', 'prompt': 'a cat'}
+
+
+def call(service, params=PARAMS, seconds=5.0, stale_after=70):
+    return IdempotentCall(service, 'u1', 'generate_image', params, deadline=Deadline(seconds), stale_after=stale_after)
+
+
+def record(service, params=PARAMS):
+    return call(service, params).doc_ref.get().to_dict()
+
+
+def test_request_hash_ignores_the_key():
+    assert request_hash({'idempotencyKey': 'a', 'prompt': 'x'}) == request_hash({'idempotencyKey': 'b', 'prompt': 'x'})
+    assert request_hash({'prompt': 'x'}) != request_hash({'prompt': 'y'})
+
+
+def test_without_a_key_nothing_is_recorded(fake_db, firestore_service):
+    original = call(firestore_service, {'prompt': 'a cat'})
+
+    assert original.begin() is None
+    original.complete({'success': True})
+
+    assert list(fake_db.collection('idempotency_keys').stream()) == []
+
+
+def test_first_call_owns_the_key(firestore_service):
+    original = call(firestore_service)
+
+    assert original.begin() is None
+    assert original.owned
+    assert record(firestore_service)['status'] == 'pending'
+
+
+def test_duplicate_returns_the_stored_result_with_its_image(firestore_service):
+    original = call(firestore_service)
+    original.begin()
+    original.complete({'success': True, 'imageData': 'inline'}, image_bytes=b'png-bytes')
+
+    stored = record(firestore_service)
+    assert stored['status'] == 'completed'
+    assert 'imageData' not in stored['result']
+
+    duplicate = call(firestore_service)
+    result = duplicate.begin()
+
+    assert result == {'success': True, 'imageData': base64.b64encode(b'png-bytes').decode('utf-8')}
+    assert not duplicate.owned
+
+
+def test_duplicate_waits_for_the_call_in_flight(monkeypatch, firestore_service):
+    original = call(firestore_service)
+    original.begin()
+    # The original finishes while the duplicate is polling
+    monkeypatch.setattr(idempotency, 'time', types.SimpleNamespace(sleep=lambda seconds: original.complete({'success': True})))
+
+    assert call(firestore_service).begin() == {'success': True}
+
+
+def test_duplicate_gives_up_when_its_deadline_runs_out(monkeypatch, firestore_service):
+    monkeypatch.setattr(idempotency, 'POLL_SECONDS', 0.01)
+    call(firestore_service).begin()
+
+    with pytest.raises(https_fn.HttpsError) as error:
+        call(firestore_service, seconds=0.05).begin()
+
+    assert error.value.code == 'aborted'
+
+
+def test_reusing_a_key_with_other_parameters_is_rejected(firestore_service):
+    call(firestore_service).begin()
+
+    with pytest.raises(https_fn.HttpsError) as error:
+        call(firestore_service, {**PARAMS, 'prompt': 'a dog'}).begin()
+
+    assert error.value.code == 'invalid-argument'
+
+
+def test_abandoned_call_lets_a_retry_run(firestore_service):
+    original = call(firestore_service)
+    original.begin()
+    original.abandon()
+    assert record(firestore_service)['status'] == 'failed'
+
+    retry = call(firestore_service)
+
+    assert retry.begin() is None
+    assert retry.owned
+    assert record(firestore_service)['status'] == 'pending'
+
+
+def test_stale_pending_record_is_taken_over(firestore_service):
+    original = call(firestore_service)
+    original.begin()
+    # The original was killed by the platform long ago
+    original.doc_ref.update({'createdAt': datetime.now(timezone.utc) - timedelta(seconds=120)})
+
+    retry = call(firestore_service, stale_after=70)
+
+    assert retry.begin() is None
+    assert retry.owned
+    assert record(firestore_service)['createdAt'] > datetime.now(timezone.utc) - timedelta(seconds=10)
+
+
+def test_only_the_owner_records_an_outcome(firestore_service):
+    original = call(firestore_service)
+    original.begin()
+    original.complete({'success': True})
+
+    duplicate = call(firestore_service)
+    duplicate.begin()
+    duplicate.abandon()
+    duplicate.complete({'success': False})
+
+    assert record(firestore_service)['status'] == 'completed'
+    assert record(firestore_service)['result'] == {'success': True}
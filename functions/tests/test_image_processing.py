@@ -0,0 +1,107 @@
+import io
+import random
+
+from PIL import Image
+
+from image_processing import (
+    _base83,
+    blurhash_encode,
+    create_previews,
+    extension_for,
+    normalize_image,
+    sniff_mime_type,
+    transcode_image,
+)
+
+
+def encode(image, format):
+    output = io.BytesIO()
+    image.save(output, format=format)
+    return output.getvalue()
+
+
+def gradient(size=(320, 200), mode='RGB'):
+    image = Image.new(mode, size)
+    image.putdata([(x % 256, y % 256, (x + y) % 256) + ((128,) if mode == 'RGBA' else ()) for y in range(size[1]) for x in range(size[0])])
+    return image
+
+
+def photo(size=(320, 200)):
+    # Noise compresses like a photo: badly as PNG, well as lossy WebP
+    return Image.frombytes('RGB', size, random.Random(0).randbytes(size[0] * size[1] * 3))
+
+
+def test_sniff_mime_type():
+    assert sniff_mime_type(encode(gradient(), 'PNG')) == 'image/png'
+    assert sniff_mime_type(encode(gradient(), 'JPEG')) == 'image/jpeg'
+    assert sniff_mime_type(encode(gradient(), 'WEBP')) == 'image/webp'
+    assert sniff_mime_type(b'not an image', default='') == ''
+
+
+def test_extension_for():
+    assert extension_for('image/webp') == 'webp'
+    assert extension_for('image/jpeg') == 'jpg'
+    assert extension_for('application/octet-stream') == 'bin'
+
+
+def test_transcode_png_to_webp():
+    png = encode(photo(), 'PNG')
+
+    data, mime_type = transcode_image(png, 'webp', 85)
+
+    assert mime_type == 'image/webp'
+    assert sniff_mime_type(data) == 'image/webp'
+    assert len(data) < len(png)
+
+
+def test_transcode_keeps_original_and_matching_format():
+    png = encode(gradient(), 'PNG')
+    webp = encode(gradient(), 'WEBP')
+
+    assert transcode_image(png, 'original', 85) == (png, 'image/png')
+    assert transcode_image(webp, 'webp', 85) == (webp, 'image/webp')
+
+
+def test_transcode_passes_unreadable_bytes_through():
+    data = b'\x00' * 64
+    assert transcode_image(data, 'webp', 85) == (data, 'application/octet-stream')
+
+
+def test_transcode_to_jpeg_keeps_transparency_as_png():
+    png = encode(gradient(mode='RGBA'), 'PNG')
+
+    data, mime_type = transcode_image(png, 'jpeg', 85)
+
+    assert mime_type == 'image/png'
+    assert Image.open(io.BytesIO(data)).mode == 'RGBA'
+
+
+def test_normalize_downscales_to_max_edge():
+    data, mime_type = normalize_image(encode(gradient((2000, 1000)), 'PNG'), 1024, 85)
+
+    assert mime_type == 'image/jpeg'
+    assert Image.open(io.BytesIO(data)).size == (1024, 512)
+
+
+def test_create_previews():
+    previews = create_previews(encode(gradient(), 'PNG'), [64, 256], 80, 'webp')
+
+    assert (previews['width'], previews['height']) == (320, 200)
+    assert set(previews['thumbnails']) == {64, 256}
+    for size, (data, mime_type) in previews['thumbnails'].items():
+        assert mime_type == 'image/webp'
+        assert max(Image.open(io.BytesIO(data)).size) == size
+    assert len(previews['blurhash']) == 28
+
+
+def test_create_previews_of_unreadable_bytes():
+    assert create_previews(b'not an image', [64], 80) is None
+
+
+def test_blurhash_layout():
+    blurhash = blurhash_encode(Image.new('RGB', (10, 10), (255, 0, 0)))
+
+    # Size flag for 4x3 components, max AC, the average colour, then 11 AC components of 2 chars
+    assert len(blurhash) == 28
+    assert blurhash[0] == _base83(3 + 2 * 9, 1)
+    assert blurhash[2:6] == _base83(0xFF0000, 4)
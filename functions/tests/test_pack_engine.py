@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('gemini_client', reason='needs the packages in requirements.txt')
+
+from deadline import Deadline
+from pack_engine import AdaptiveConcurrencyLimiter, PackGeneration
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_limiter_slow_start_grows_by_one_per_success():
+    limiter = AdaptiveConcurrencyLimiter(initial=2, maximum=4)
+
+    async def calls():
+        for _ in range(3):
+            await limiter.acquire()
+            limiter.release(1.0)
+
+    run(calls())
+    assert limiter.limit == 4
+
+
+def test_limiter_halves_on_overload_and_shrinks_on_latency():
+    limiter = AdaptiveConcurrencyLimiter(initial=8, maximum=32)
+
+    async def calls():
+        await limiter.acquire()
+        limiter.release(None, overloaded=True)
+        assert limiter.limit == 4
+        await limiter.acquire()
+        limiter.release(1.0)
+        await limiter.acquire()
+        limiter.release(5.0)
+
+    run(calls())
+    assert limiter.limit == 3
+
+
+def test_limiter_queues_callers_beyond_the_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial=1, maximum=1)
+
+    async def calls():
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        limiter.release(1.0)
+        await asyncio.wait_for(waiter, 1)
+
+    run(calls())
+
+
+def test_results_in_prompt_order_with_skips_and_errors():
+    async def generate(index, prompt):
+        await asyncio.sleep(0.01 * (3 - index))
+        if prompt == 'bad':
+            raise ValueError('bad prompt')
+        return prompt.upper()
+
+    async def save(index, prompt, value):
+        return f"saved {value}"
+
+    generation = PackGeneration(
+        ['a', 'bad', 'c', 'd'], generate, save, limiter=AdaptiveConcurrencyLimiter(initial=4), skip=[3]
+    )
+    results = run(generation.run())
+
+    assert [result.index for result in results] == [0, 1, 2]
+    assert [result.value for result in results] == ['saved A', None, 'saved C']
+    assert [result.ok for result in results] == [True, False, True]
+    assert isinstance(results[1].error, ValueError)
+
+
+def test_cancel_one_prompt():
+    async def generate(index, prompt):
+        await asyncio.sleep(0.2 if index == 1 else 0)
+        return prompt
+
+    async def main():
+        generation = PackGeneration(['a', 'b'], generate, limiter=AdaptiveConcurrencyLimiter(initial=2))
+        task = asyncio.ensure_future(generation.run())
+        await asyncio.sleep(0.05)
+        generation.cancel(1)
+        return await task
+
+    results = run(main())
+    assert results[0].ok
+    assert results[1].cancelled and not results[1].timed_out
+
+
+def test_deadline_cancels_generation_but_lets_saves_finish():
+    saved = []
+
+    async def generate(index, prompt):
+        await asyncio.sleep(0 if prompt == 'fast' else 10)
+        return prompt
+
+    async def save(index, prompt, value):
+        await asyncio.sleep(0.2)
+        saved.append(value)
+        return value
+
+    generation = PackGeneration(
+        ['fast', 'slow'], generate, save, limiter=AdaptiveConcurrencyLimiter(initial=2), deadline=Deadline(0.1)
+    )
+    results = run(generation.run())
+
+    assert saved == ['fast']
+    assert results[0].ok and not results[0].timed_out
+    assert results[1].cancelled and results[1].timed_out
+
+
+def test_prompts_not_started_without_time_for_the_estimate():
+    started = []
+
+    async def generate(index, prompt):
+        started.append(index)
+        return prompt
+
+    generation = PackGeneration(
+        ['a', 'b'], generate, limiter=AdaptiveConcurrencyLimiter(initial=2),
+        deadline=Deadline(5), estimated_seconds=30
+    )
+    results = run(generation.run())
+
+    assert started == []
+    assert all(result.timed_out and not result.ok for result in results)
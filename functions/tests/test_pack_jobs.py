@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('firebase_admin', reason='needs the packages in requirements.txt')
+pytest.importorskip('gemini_client', reason='needs the packages in requirements.txt')
+
+from gemini_client import ImagePart
+from pack_jobs import JobLeasedError, PackJobs
+
+LEASE_SEC = 540
+PROMPTS = ['beach', 'forest', 'city']
+
+
+@pytest.fixture
+def jobs(fake_db, firestore_service):
+    fake_db.collection('users').document('u1').set({'balance': 10, 'role': 'normal'})
+    return PackJobs(firestore_service)
+
+
+def create_job(firestore_service, jobs):
+    user = firestore_service.get_user_context('u1')
+    reservation = firestore_service.reserve_tokens(user, len(PROMPTS), 6 * 3600)
+    return jobs.create('u1', 'pack-1', 'Travel', PROMPTS, ImagePart('image/jpeg', b'source'), reservation)
+
+
+def job_data(db, job_id):
+    return db.collection('pack_jobs').document(job_id).get().to_dict()
+
+
+def balance(db):
+    return db.collection('users').document('u1').get().get('balance')
+
+
+def test_create_stores_the_source_and_queues_the_job(fake_db, firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+
+    job = job_data(fake_db, job_id)
+    assert job['status'] == 'queued'
+    assert job['holdImages'] == 3 and job['holdTokens'] == 3
+    assert jobs.load_source(job) == ImagePart('image/jpeg', b'source')
+    assert balance(fake_db) == 7
+
+
+def test_claim_leases_the_job_once(fake_db, firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+
+    assert jobs.claim(job_id, LEASE_SEC)['prompts'] == PROMPTS
+    with pytest.raises(JobLeasedError):
+        jobs.claim(job_id, LEASE_SEC)
+
+    job = job_data(fake_db, job_id)
+    assert job['status'] == 'running' and job['attempts'] == 1
+
+
+def test_released_job_can_be_claimed_again(fake_db, firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+    jobs.claim(job_id, LEASE_SEC)
+
+    jobs.release(job_id)
+
+    assert jobs.claim(job_id, LEASE_SEC) is not None
+    assert job_data(fake_db, job_id)['attempts'] == 2
+
+
+def test_expired_lease_can_be_claimed(fake_db, firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+    jobs.claim(job_id, -1)
+
+    assert jobs.claim(job_id, LEASE_SEC) is not None
+
+
+def test_missing_and_finished_jobs_are_not_claimed(firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+    job = jobs.claim(job_id, LEASE_SEC)
+    jobs.finish(job, job_id, 3)
+
+    assert jobs.claim(job_id, LEASE_SEC) is None
+    assert jobs.claim('missing', LEASE_SEC) is None
+
+
+def test_resumed_job_sees_images_from_earlier_attempts(fake_db, firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+    jobs.claim(job_id, LEASE_SEC)
+    image_ref = fake_db.collection('user_images').document('img-0')
+    jobs.record_image(job_id, {'index': 0, 'imageUrl': 'https://example.com/0'}, [(image_ref, {'userId': 'u1'})])
+    jobs.release(job_id)
+
+    jobs.claim(job_id, LEASE_SEC)
+    done = jobs.completed_images(job_id)
+
+    assert list(done) == [0]
+    assert done[0]['imageUrl'] == 'https://example.com/0'
+    assert image_ref.get().exists
+    assert job_data(fake_db, job_id)['completedCount'] == 1
+
+
+def test_finish_bills_generated_images_and_refunds_the_rest(fake_db, firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+    job = jobs.claim(job_id, LEASE_SEC)
+
+    new_balance = jobs.finish(job, job_id, 2)
+
+    assert new_balance == 8 == balance(fake_db)
+    job = job_data(fake_db, job_id)
+    assert job['status'] == 'completed'
+    assert job['generatedCount'] == 2 and job['tokensRemaining'] == 8
+    assert job['leaseExpiresAt'] is None
+    assert not firestore_service.bucket.blob(job['sourcePath']).exists()
+
+
+def test_stale_job_is_settled_for_the_images_it_published(fake_db, firestore_service, jobs):
+    stale_id = create_job(firestore_service, jobs)
+    fresh_id = create_job(firestore_service, jobs)
+    fake_db.collection('pack_jobs').document(stale_id).update({
+        'createdAt': datetime.now(timezone.utc) - timedelta(hours=4)
+    })
+    jobs.record_image(stale_id, {'index': 1, 'imageUrl': 'https://example.com/1'})
+    assert balance(fake_db) == 4
+
+    # What settle_stale_pack_jobs does for each stale job
+    assert jobs.stale_job_ids(3 * 3600) == [stale_id]
+    job = jobs.claim(stale_id, LEASE_SEC)
+    jobs.finish(job, stale_id, len(jobs.completed_images(stale_id)))
+
+    assert balance(fake_db) == 6
+    assert job_data(fake_db, stale_id)['status'] == 'completed'
+    assert job_data(fake_db, fresh_id)['status'] == 'queued'
+    assert jobs.stale_job_ids(3 * 3600) == []
+
+
+def test_stale_job_with_nothing_published_fails_and_refunds_in_full(fake_db, firestore_service, jobs):
+    job_id = create_job(firestore_service, jobs)
+    job = jobs.claim(job_id, LEASE_SEC)
+
+    jobs.finish(job, job_id, 0)
+
+    assert balance(fake_db) == 10
+    assert job_data(fake_db, job_id)['status'] == 'failed'
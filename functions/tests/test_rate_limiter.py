@@ -0,0 +1,80 @@
+import asyncio
+import time
+import types
+
+import pytest
+
+import rate_limiter
+from rate_limiter import InMemoryBudgetStore, RateLimiter, RateLimitTimeout
+
+
+class CountingStore(InMemoryBudgetStore):
+    def __init__(self):
+        super().__init__()
+        self.leases = []
+
+    def lease(self, bucket, window, requested, limit):
+        granted = super().lease(bucket, window, requested, limit)
+        self.leases.append(granted)
+        return granted
+
+
+class FailingStore:
+    def lease(self, bucket, window, requested, limit):
+        raise RuntimeError('store down')
+
+
+@pytest.fixture(autouse=True)
+def fixed_window(monkeypatch):
+    # Ten seconds into a minute, so no test straddles a window boundary
+    monkeypatch.setattr(rate_limiter, 'time', types.SimpleNamespace(time=lambda: 600010.0, monotonic=time.monotonic))
+
+
+async def acquire_many(limiter, count):
+    for _ in range(count):
+        await limiter.acquire()
+
+
+def test_leases_budget_in_chunks():
+    store = CountingStore()
+    limiter = RateLimiter('test', limit_per_minute=25, store=store, chunk_size=10)
+
+    asyncio.run(acquire_many(limiter, 25))
+
+    assert store.leases == [10, 10, 5]
+    assert limiter.metrics()['acquired'] == 25
+
+
+def test_raises_when_budget_exhausted_longer_than_max_wait():
+    limiter = RateLimiter('test', limit_per_minute=3, store=InMemoryBudgetStore(), chunk_size=10, max_wait=0)
+
+    asyncio.run(acquire_many(limiter, 3))
+    with pytest.raises(RateLimitTimeout):
+        asyncio.run(limiter.acquire())
+    assert limiter.metrics()['timeouts'] == 1
+
+
+def test_instances_share_one_budget():
+    store = InMemoryBudgetStore()
+    first = RateLimiter('test', limit_per_minute=15, store=store, chunk_size=10, max_wait=0)
+    second = RateLimiter('test', limit_per_minute=15, store=store, chunk_size=10, max_wait=0)
+
+    asyncio.run(acquire_many(first, 10))
+    asyncio.run(acquire_many(second, 5))
+    with pytest.raises(RateLimitTimeout):
+        asyncio.run(second.acquire())
+
+
+def test_buckets_have_separate_budgets():
+    store = InMemoryBudgetStore()
+    assert store.lease('a', 1, 10, 10) == 10
+    assert store.lease('b', 1, 10, 10) == 10
+    assert store.lease('a', 2, 10, 10) == 10
+    assert store.lease('a', 1, 10, 10) == 0
+
+
+def test_store_failure_fails_open():
+    limiter = RateLimiter('test', limit_per_minute=5, store=FailingStore(), chunk_size=2, max_wait=0)
+
+    asyncio.run(acquire_many(limiter, 5))
+    assert limiter.metrics()['acquired'] == 5
@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('firebase_admin', reason='needs the packages in requirements.txt')
+
+import subscription_refill
+from deadline import Deadline
+from firestore_service import SUBSCRIPTION_WEEKLY_TOKENS
+from subscription_refill import SubscriptionRefill
+
+NOW = datetime.now(timezone.utc)
+DUE = NOW - timedelta(days=8)
+RECENT = NOW - timedelta(days=1)
+
+
+class ExpiresAfter:
+    """Deadline that runs out after the given number of checks."""
+
+    def __init__(self, checks):
+        self.checks = checks
+
+    @property
+    def expired(self):
+        self.checks -= 1
+        return self.checks < 0
+
+
+def add_user(db, uid, status='active', **fields):
+    db.collection('users').document(uid).set({'balance': 0, 'subscriptionStatus': status, **fields})
+
+
+def balance(db, uid):
+    return db.collection('users').document(uid).get().get('balance')
+
+
+def grants(db, uid):
+    docs = db.collection('users').document(uid).collection('transactions').stream()
+    return [doc.to_dict()['amount'] for doc in docs if doc.to_dict()['event'] == 'subscription_refill']
+
+
+def checkpoint(db):
+    return db.collection('job_checkpoints').document('subscription_refill').get().to_dict()
+
+
+@pytest.fixture
+def refill(fake_db, firestore_service):
+    return SubscriptionRefill(firestore_service)
+
+
+@pytest.fixture
+def backfilled(fake_db):
+    fake_db.collection('job_checkpoints').document('subscription_refill').set({'backfillDone': True})
+
+
+def test_backfill_refills_every_due_subscriber_and_finishes(fake_db, refill):
+    add_user(fake_db, 'due', lastTokenAdd=DUE)
+    add_user(fake_db, 'recent', lastTokenAdd=RECENT)
+    add_user(fake_db, 'null', lastTokenAdd=None)
+    add_user(fake_db, 'missing')
+    add_user(fake_db, 'canceled', status='canceled', lastTokenAdd=DUE)
+
+    assert refill.run(Deadline(60)) == 3
+
+    assert [balance(fake_db, uid) for uid in ['due', 'recent', 'null', 'missing', 'canceled']] == [
+        SUBSCRIPTION_WEEKLY_TOKENS, 0, SUBSCRIPTION_WEEKLY_TOKENS, SUBSCRIPTION_WEEKLY_TOKENS, 0
+    ]
+    assert grants(fake_db, 'missing') == [SUBSCRIPTION_WEEKLY_TOKENS]
+    assert checkpoint(fake_db)['backfillDone'] is True
+    assert checkpoint(fake_db)['cursor'] is None
+
+
+def test_backfill_resumes_from_its_checkpoint(monkeypatch, fake_db, refill):
+    monkeypatch.setattr(subscription_refill, 'PAGE_SIZE', 2)
+    uids = ['a', 'b', 'c', 'd', 'e']
+    for uid in uids:
+        add_user(fake_db, uid)
+
+    assert refill.run(ExpiresAfter(1)) == 2
+    assert checkpoint(fake_db)['cursor'] == 'b'
+    assert checkpoint(fake_db)['backfillDone'] is False
+
+    assert refill.run(Deadline(60)) == 3
+
+    assert [balance(fake_db, uid) for uid in uids] == [SUBSCRIPTION_WEEKLY_TOKENS] * 5
+    assert checkpoint(fake_db)['backfillDone'] is True
+
+
+def test_indexed_run_refills_only_due_subscribers(fake_db, refill, backfilled):
+    add_user(fake_db, 'due', lastTokenAdd=DUE)
+    add_user(fake_db, 'recent', lastTokenAdd=RECENT)
+    add_user(fake_db, 'null', lastTokenAdd=None)
+    add_user(fake_db, 'canceled', status='canceled', lastTokenAdd=DUE)
+
+    assert refill.run(Deadline(60)) == 2
+
+    assert balance(fake_db, 'due') == SUBSCRIPTION_WEEKLY_TOKENS
+    assert balance(fake_db, 'null') == SUBSCRIPTION_WEEKLY_TOKENS
+    assert balance(fake_db, 'recent') == 0
+    assert balance(fake_db, 'canceled') == 0
+
+
+def test_indexed_run_pages_through_every_due_subscriber(monkeypatch, fake_db, refill, backfilled):
+    monkeypatch.setattr(subscription_refill, 'PAGE_SIZE', 1)
+    for index in range(3):
+        add_user(fake_db, f'due-{index}', lastTokenAdd=DUE - timedelta(hours=index))
+        add_user(fake_db, f'null-{index}', lastTokenAdd=None)
+
+    assert refill.run(Deadline(60)) == 6
+
+
+def test_runs_never_grant_twice(fake_db, refill, backfilled):
+    add_user(fake_db, 'due', lastTokenAdd=DUE)
+
+    refill.run(Deadline(60))
+    assert refill.run(Deadline(60)) == 0
+
+    assert balance(fake_db, 'due') == SUBSCRIPTION_WEEKLY_TOKENS
+    assert grants(fake_db, 'due') == [SUBSCRIPTION_WEEKLY_TOKENS]
+
+
+def test_user_changed_since_read_is_skipped(monkeypatch, fake_db, refill, backfilled):
+    add_user(fake_db, 'renewed', lastTokenAdd=DUE)
+    add_user(fake_db, 'due', lastTokenAdd=DUE)
+    refill_docs = SubscriptionRefill._refill
+    renewals = []
+
+    def renew_then_refill(self, docs):
+        # A renewal grants the tokens between the query and the BulkWriter update
+        if docs and not renewals:
+            fake_db.collection('users').document('renewed').update({'balance': 140, 'lastTokenAdd': NOW})
+            renewals.append('renewed')
+        return refill_docs(self, docs)
+
+    monkeypatch.setattr(SubscriptionRefill, '_refill', renew_then_refill)
+
+    assert refill.run(Deadline(60)) == 1
+
+    assert balance(fake_db, 'renewed') == 140
+    assert grants(fake_db, 'renewed') == []
+    assert balance(fake_db, 'due') == SUBSCRIPTION_WEEKLY_TOKENS
@@ -0,0 +1,136 @@
+import pytest
+
+pytest.importorskip('firebase_admin', reason='needs the packages in requirements.txt')
+pytest.importorskip('firebase_functions', reason='needs the packages in requirements.txt')
+
+from firestore_service import SUBSCRIPTION_WEEKLY_TOKENS
+from superwall_events import SuperwallEvents, parse_event
+
+T0 = 1_760_000_000_000
+
+
+def payload(event_id, event_type, timestamp, product_id='pro.weekly'):
+    return {
+        'id': event_id,
+        'type': event_type,
+        'timestamp': timestamp,
+        'data': {'originalAppUserId': '$SuperwallAlias:u1', 'productId': product_id},
+    }
+
+
+@pytest.fixture
+def events(fake_db, firestore_service):
+    fake_db.collection('users').document('u1').set({'balance': 5, 'subscriptionStatus': 'none'})
+    return SuperwallEvents(firestore_service)
+
+
+def user_data(db):
+    return db.collection('users').document('u1').get().to_dict()
+
+
+def status(db, event_id):
+    return db.collection('superwall_events').document(event_id).get().get('status')
+
+
+def ledger(db):
+    return [doc.to_dict()['event'] for doc in db.collection('users').document('u1').collection('transactions').stream()]
+
+
+def test_parse_event_strips_the_alias_and_keys_by_id():
+    event = parse_event(payload('evt-1', 'renewal', T0))
+
+    assert event['userId'] == 'u1'
+    assert event['eventId'] == 'evt-1'
+    assert event['eventAt'].timestamp() == T0 / 1000
+
+
+def test_events_without_an_id_are_keyed_by_content():
+    first = payload(None, 'renewal', T0)
+
+    assert parse_event(first)['eventId'] == parse_event(dict(first))['eventId']
+    assert parse_event(first)['eventId'] != parse_event(payload(None, 'renewal', T0 + 1))['eventId']
+
+
+def test_renewal_grants_tokens_exactly_once(fake_db, events):
+    events.record(payload('evt-1', 'renewal', T0))
+
+    assert events.process_user('u1') == 1
+    assert events.process_user('u1') == 0
+
+    assert user_data(fake_db)['balance'] == 5 + SUBSCRIPTION_WEEKLY_TOKENS
+    assert user_data(fake_db)['subscriptionStatus'] == 'active'
+    assert status(fake_db, 'evt-1') == 'applied'
+    assert ledger(fake_db) == ['subscription']
+
+
+def test_redelivery_is_not_applied_again(fake_db, events):
+    event, pending = events.record(payload('evt-1', 'renewal', T0))
+    assert pending
+    events.process_user('u1')
+
+    _, pending = events.record(payload('evt-1', 'renewal', T0))
+    events.process_user('u1')
+
+    assert not pending
+    assert user_data(fake_db)['balance'] == 5 + SUBSCRIPTION_WEEKLY_TOKENS
+
+
+def test_redelivery_before_processing_stays_pending(fake_db, events):
+    events.record(payload('evt-1', 'renewal', T0))
+
+    _, pending = events.record(payload('evt-1', 'renewal', T0))
+
+    assert pending
+    assert events.process_user('u1') == 1
+
+
+def test_events_apply_oldest_first(fake_db, events):
+    events.record(payload('evt-2', 'expiration', T0 + 1000))
+    events.record(payload('evt-1', 'renewal', T0))
+
+    assert events.process_user('u1') == 2
+
+    assert user_data(fake_db)['subscriptionStatus'] == 'expired'
+    assert user_data(fake_db)['subscriptionEventAt'].timestamp() == (T0 + 1000) / 1000
+
+
+def test_older_subscription_event_is_marked_stale(fake_db, events):
+    events.record(payload('evt-2', 'renewal', T0 + 1000))
+    events.process_user('u1')
+
+    # Delivered late: the cancellation predates the renewal already applied
+    events.record(payload('evt-1', 'cancellation', T0))
+    assert events.process_user('u1') == 0
+
+    assert status(fake_db, 'evt-1') == 'stale'
+    assert user_data(fake_db)['subscriptionStatus'] == 'active'
+
+
+def test_token_pack_purchase_adds_tokens(fake_db, events):
+    events.record(payload('evt-1', 'consumable_purchase', T0, product_id='reeys.tokens.200'))
+
+    events.process_user('u1')
+
+    assert user_data(fake_db)['balance'] == 205
+    assert ledger(fake_db) == ['token_pack']
+
+
+def test_unknown_products_and_types_are_ignored(fake_db, events):
+    events.record(payload('evt-1', 'consumable_purchase', T0, product_id='unknown.pack'))
+    events.record(payload('evt-2', 'paywall_open', T0 + 1))
+
+    assert events.process_user('u1') == 0
+
+    assert status(fake_db, 'evt-1') == 'ignored'
+    assert status(fake_db, 'evt-2') == 'ignored'
+    assert user_data(fake_db)['balance'] == 5
+
+
+def test_events_for_a_new_user_create_the_user(fake_db, firestore_service):
+    events = SuperwallEvents(firestore_service)
+    events.record(payload('evt-1', 'initial_purchase', T0))
+
+    events.process_user('u1')
+
+    assert user_data(fake_db)['balance'] == SUBSCRIPTION_WEEKLY_TOKENS
+    assert user_data(fake_db)['subscriptionStatus'] == 'active'
@@ -0,0 +1,154 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('firebase_admin', reason='needs the packages in requirements.txt')
+pytest.importorskip('firebase_functions', reason='needs the packages in requirements.txt')
+
+from firebase_functions import https_fn
+
+from user_context import iso_week
+
+
+def add_user(db, uid='u1', **fields):
+    data = {'balance': 10, 'role': 'normal', 'weeklyGenerated': 0, 'generationWeek': iso_week(), **fields}
+    db.collection('users').document(uid).set(data)
+    return db.collection('users').document(uid)
+
+
+def user_data(db, uid='u1'):
+    return db.collection('users').document(uid).get().to_dict()
+
+
+def holds(db, uid='u1'):
+    return list(db.collection('users').document(uid).collection('token_holds').stream())
+
+
+def transactions(db, uid='u1'):
+    return [doc.to_dict() for doc in db.collection('users').document(uid).collection('transactions').stream()]
+
+
+def reserve(service, images, uid='u1', hold_seconds=60):
+    return service.reserve_tokens(service.get_user_context(uid), images, hold_seconds)
+
+
+def test_reserve_takes_tokens_and_places_a_hold(fake_db, firestore_service):
+    add_user(fake_db, balance=10)
+
+    reservation = reserve(firestore_service, 3)
+
+    assert reservation.tokens == 3
+    assert user_data(fake_db)['balance'] == 7
+    [hold] = holds(fake_db)
+    assert hold.id == reservation.hold_id
+    assert hold.to_dict()['images'] == 3 and hold.to_dict()['tokens'] == 3
+
+
+def test_commit_charges_generated_images_and_refunds_the_rest(fake_db, firestore_service):
+    add_user(fake_db, balance=10)
+    reservation = reserve(firestore_service, 3)
+
+    new_balance = firestore_service.commit_reservation(reservation, 2)
+
+    assert new_balance == 8
+    assert user_data(fake_db)['balance'] == 8
+    assert user_data(fake_db)['totalGenerated'] == 2
+    assert holds(fake_db) == []
+    [entry] = transactions(fake_db)
+    assert entry['event'] == 'deduction' and entry['amount'] == -2
+
+
+def test_commit_writes_pending_writes_in_the_same_transaction(fake_db, firestore_service):
+    add_user(fake_db)
+    reservation = reserve(firestore_service, 1)
+    image_ref = fake_db.collection('user_images').document('img1')
+    reservation.user.pending_writes.append((image_ref, {'userId': 'u1'}))
+
+    firestore_service.commit_reservation(reservation, 1)
+
+    assert image_ref.get().to_dict() == {'userId': 'u1'}
+    assert reservation.user.pending_writes == []
+
+
+def test_settling_a_hold_twice_is_a_no_op(fake_db, firestore_service):
+    add_user(fake_db, balance=10)
+    reservation = reserve(firestore_service, 2)
+    firestore_service.commit_reservation(reservation, 2)
+
+    firestore_service.commit_reservation(reservation, 2)
+    firestore_service.release_reservation(reservation)
+
+    assert user_data(fake_db)['balance'] == 8
+    assert len(transactions(fake_db)) == 1
+
+
+def test_release_returns_the_whole_hold(fake_db, firestore_service):
+    add_user(fake_db, balance=10)
+    reservation = reserve(firestore_service, 4)
+
+    firestore_service.release_reservation(reservation)
+
+    assert user_data(fake_db)['balance'] == 10
+    assert holds(fake_db) == []
+    assert transactions(fake_db) == []
+
+
+def test_insufficient_tokens_places_no_hold(fake_db, firestore_service):
+    add_user(fake_db, balance=2)
+
+    with pytest.raises(https_fn.HttpsError) as error:
+        reserve(firestore_service, 3)
+
+    assert error.value.details == {'needsTokens': True, 'balance': 2, 'required': 3}
+    assert user_data(fake_db)['balance'] == 2
+    assert holds(fake_db) == []
+
+
+@pytest.mark.parametrize('role', ['premium', 'admin'])
+def test_premium_and_admin_generate_without_tokens(fake_db, firestore_service, role):
+    add_user(fake_db, balance=0, role=role)
+
+    reservation = reserve(firestore_service, 2)
+    firestore_service.commit_reservation(reservation, 2)
+
+    assert reservation.tokens == 0
+    assert user_data(fake_db)['balance'] == 0
+    assert transactions(fake_db) == []
+
+
+def test_reserve_refunds_expired_holds_first(fake_db, firestore_service):
+    user_ref = add_user(fake_db, balance=0, weeklyGenerated=2)
+    now = datetime.now(timezone.utc)
+    user_ref.collection('token_holds').document('dead').set({
+        'images': 2, 'tokens': 2, 'week': iso_week(),
+        'createdAt': now - timedelta(hours=2), 'expiresAt': now - timedelta(hours=1),
+    })
+
+    # Only affordable with the dead request's tokens back
+    reservation = reserve(firestore_service, 2)
+
+    assert [hold.id for hold in holds(fake_db)] == [reservation.hold_id]
+    assert user_data(fake_db)['balance'] == 0
+    assert user_data(fake_db)['weeklyGenerated'] == 2
+
+
+def test_unexpired_holds_are_left_alone(fake_db, firestore_service):
+    add_user(fake_db, balance=10)
+    first = reserve(firestore_service, 3, hold_seconds=600)
+
+    reserve(firestore_service, 1)
+
+    assert first.hold_id in [hold.id for hold in holds(fake_db)]
+    assert user_data(fake_db)['balance'] == 6
+
+
+def test_release_expired_holds_refunds_without_a_new_reservation(fake_db, firestore_service):
+    add_user(fake_db, balance=10)
+    reserve(firestore_service, 3, hold_seconds=-1)
+    assert user_data(fake_db)['balance'] == 7
+
+    firestore_service.release_expired_holds(firestore_service.get_user_context('u1'))
+
+    assert user_data(fake_db)['balance'] == 10
+    assert user_data(fake_db)['weeklyGenerated'] == 0
+    assert holds(fake_db) == []
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('firebase_admin', reason='needs the packages in requirements.txt')
+pytest.importorskip('firebase_functions', reason='needs the packages in requirements.txt')
+
+from firebase_functions import https_fn
+
+from user_context import WEEKLY_GENERATION_LIMIT, iso_week
+
+LAST_WEEK = iso_week(datetime.now(timezone.utc) - timedelta(days=7))
+
+
+def add_user(db, **fields):
+    db.collection('users').document('u1').set({'balance': 1000, 'role': 'normal', **fields})
+    return db.collection('users').document('u1')
+
+
+def user_data(db):
+    return db.collection('users').document('u1').get().to_dict()
+
+
+def reserve(service, images, hold_seconds=60):
+    return service.reserve_tokens(service.get_user_context('u1'), images, hold_seconds)
+
+
+def add_expired_hold(user_ref, images, week):
+    now = datetime.now(timezone.utc)
+    user_ref.collection('token_holds').document(f'dead-{week}').set({
+        'images': images, 'tokens': images, 'week': week,
+        'createdAt': now - timedelta(hours=2), 'expiresAt': now - timedelta(hours=1),
+    })
+
+
+def test_iso_week_key():
+    assert iso_week(datetime(2026, 1, 1, tzinfo=timezone.utc)) == '2026-W01'
+    assert iso_week(datetime(2027, 1, 1, tzinfo=timezone.utc)) == '2026-W53'
+
+
+def test_reserve_counts_images_in_the_current_week(fake_db, firestore_service):
+    add_user(fake_db, weeklyGenerated=5, generationWeek=iso_week())
+
+    reserve(firestore_service, 3)
+
+    assert user_data(fake_db)['weeklyGenerated'] == 8
+    assert user_data(fake_db)['generationWeek'] == iso_week()
+
+
+def test_a_new_week_starts_from_zero_without_a_reset(fake_db, firestore_service):
+    add_user(fake_db, weeklyGenerated=WEEKLY_GENERATION_LIMIT, generationWeek=LAST_WEEK)
+
+    reserve(firestore_service, 3)
+
+    assert user_data(fake_db)['weeklyGenerated'] == 3
+    assert user_data(fake_db)['generationWeek'] == iso_week()
+
+
+def test_weekly_limit_is_enforced_in_the_reservation(fake_db, firestore_service):
+    add_user(fake_db, weeklyGenerated=WEEKLY_GENERATION_LIMIT - 1, generationWeek=iso_week())
+
+    with pytest.raises(https_fn.HttpsError) as error:
+        reserve(firestore_service, 2)
+
+    assert error.value.details['weeklyLimitExceeded'] is True
+    assert user_data(fake_db)['weeklyGenerated'] == WEEKLY_GENERATION_LIMIT - 1
+    assert user_data(fake_db)['balance'] == 1000
+
+
+def test_admins_have_no_weekly_limit(fake_db, firestore_service):
+    add_user(fake_db, role='admin', weeklyGenerated=WEEKLY_GENERATION_LIMIT, generationWeek=iso_week())
+
+    reserve(firestore_service, 2)
+
+    assert user_data(fake_db)['weeklyGenerated'] == WEEKLY_GENERATION_LIMIT + 2
+
+
+def test_unused_images_go_back_to_their_week(fake_db, firestore_service):
+    add_user(fake_db, weeklyGenerated=0, generationWeek=iso_week())
+    reservation = reserve(firestore_service, 4)
+
+    firestore_service.commit_reservation(reservation, 1)
+
+    assert user_data(fake_db)['weeklyGenerated'] == 1
+
+
+def test_unused_images_from_a_finished_week_are_not_refunded(fake_db, firestore_service):
+    user_ref = add_user(fake_db, weeklyGenerated=0, generationWeek=iso_week())
+    reservation = reserve(firestore_service, 4)
+    # The hold was placed last week; this week's count started over since
+    reservation.hold_ref.update({'week': LAST_WEEK})
+    user_ref.update({'weeklyGenerated': 2})
+
+    firestore_service.commit_reservation(reservation, 0)
+
+    assert user_data(fake_db)['weeklyGenerated'] == 2
+    assert user_data(fake_db)['balance'] == 1000
+
+
+def test_expired_hold_refunds_the_weekly_count_only_for_its_own_week(fake_db, firestore_service):
+    user_ref = add_user(fake_db, balance=0, weeklyGenerated=5, generationWeek=iso_week())
+    add_expired_hold(user_ref, 2, iso_week())
+    add_expired_hold(user_ref, 3, LAST_WEEK)
+
+    firestore_service.release_expired_holds(firestore_service.get_user_context('u1'))
+
+    assert user_data(fake_db)['balance'] == 5
+    assert user_data(fake_db)['weeklyGenerated'] == 3
@@ -0,0 +1,133 @@
+"""Request-scoped snapshot of a user document."""
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+WEEKLY_GENERATION_LIMIT = 300
+
+
+def iso_week(moment: Optional[datetime] = None) -> str:
+    """ISO week key such as '2026-W42' (UTC) that weekly generation counts are bucketed by."""
+    year, week, _ = (moment or datetime.now(timezone.utc)).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+class UserContext:
+    """Reads users/{uid} once per request and buffers writes until commit()."""
+
+    def __init__(self, db, uid: str):
+        self.db = db
+        self.uid = uid
+        self.doc_ref = db.collection('users').document(uid)
+        self.reads = 0
+        self.writes = 0
+        self._data: Optional[Dict[str, Any]] = None
+        self._exists = False
+        self._new_document: Optional[Dict[str, Any]] = None
+        self._transactions: List[Dict[str, Any]] = []
+        # (document reference, data) pairs written together with the request's ledger update
+        self.pending_writes: List[Tuple[Any, Dict[str, Any]]] = []
+
+    def load(self) -> 'UserContext':
+        """Read the user document if it hasn't been read yet in this request."""
+        if self._data is None:
+            self.refresh(self.doc_ref.get())
+        return self
+
+    def refresh(self, snapshot) -> None:
+        """Replace the snapshot with a document read elsewhere, e.g. inside a transaction."""
+        self.reads += 1
+        self._exists = snapshot.exists
+        self._data = snapshot.to_dict() if snapshot.exists else {}
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        return self.load()._data
+
+    @property
+    def exists(self) -> bool:
+        return self.load()._exists
+
+    @property
+    def role(self) -> str:
+        return self.data.get('role', 'normal')
+
+    @property
+    def balance(self) -> int:
+        return self.data.get('balance', 0)
+
+    @property
+    def weekly_generated(self) -> int:
+        """Images generated in the current ISO week; counts from earlier weeks don't carry over."""
+        if self.data.get('generationWeek') != iso_week():
+            return 0
+        return self.data.get('weeklyGenerated', 0)
+
+    @property
+    def subscription_status(self) -> str:
+        return self.data.get('subscriptionStatus', 'none')
+
+    @property
+    def subscription_product_id(self) -> Optional[str]:
+        return self.data.get('subscriptionProductId')
+
+    @property
+    def last_token_add(self) -> Optional[datetime]:
+        return self.data.get('lastTokenAdd')
+
+    def is_premium_listed(self, email: str) -> bool:
+        """Check whether the email appears in premium_list."""
+        premium_query = self.db.collection('premium_list').where('email', '==', email).limit(1).get()
+        self.reads += 1
+        return bool(premium_query)
+
+    def create(self, user_data: Dict[str, Any]) -> None:
+        """Stage creation of the user document."""
+        self._new_document = dict(user_data)
+        self._data = dict(user_data)
+        self._exists = True
+
+    def record_transaction(self, event: str, amount: int, description: str = None) -> None:
+        """Stage a record in the user's transaction history."""
+        transaction_data = {
+            'event': event,
+            'amount': amount,
+            'timestamp': datetime.utcnow()
+        }
+
+        if description:
+            transaction_data['description'] = description
+
+        self._transactions.append(transaction_data)
+
+    def commit(self) -> None:
+        """Write every staged change in a single batch."""
+        if self._new_document is None and not self._transactions and not self.pending_writes:
+            return
+
+        batch = self.db.batch()
+        writes = 0
+
+        if self._new_document is not None:
+            batch.set(self.doc_ref, self._new_document)
+            writes += 1
+
+        for transaction_data in self._transactions:
+            batch.set(self.doc_ref.collection('transactions').document(), transaction_data)
+            writes += 1
+
+        for doc_ref, data in self.pending_writes:
+            batch.set(doc_ref, data)
+            writes += 1
+
+        batch.commit()
+        self.writes += writes
+        self._new_document = None
+        self._transactions = []
+        self.pending_writes = []
+
+    def log_io(self, operation: str) -> None:
+        """Log the Firestore reads and writes this request made for the user."""
+        logger.info(f"{operation} for user {self.uid}: {self.reads} reads, {self.writes} writes")
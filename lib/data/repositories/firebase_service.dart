@@ -101,11 +101,20 @@ class FirebaseService {
   /// Delete image from Storage and Firestore
   Future<void> deleteImage(String documentId, String fileName) async {
     try {
-      // Delete from Storage
+      final docRef = _firestore.collection('user_images').doc(documentId);
+      
+      // Thumbnails are stored next to the image and listed on its document
+      final doc = await docRef.get();
+      final thumbnailPaths = List<String>.from(doc.data()?['thumbnailPaths'] ?? const []);
+      
+      // Delete from Storage; a thumbnail that is already gone doesn't stop the delete
       await _storage.ref().child(fileName).delete();
+      await Future.wait(thumbnailPaths.map(
+        (path) => _storage.ref().child(path).delete().catchError((_) {}),
+      ));
       
       // Delete from Firestore
-      await _firestore.collection('user_images').doc(documentId).delete();
+      await docRef.delete();
     } catch (e) {
       throw Exception('Failed to delete image: $e');
     }